@@ -376,29 +376,35 @@ import hashlib
 import tempfile
 import json
 import pickle
+import struct  # 实体紧凑序列化
 import ctypes
 import shutil  # 用于清理文件
 import re 
 import asyncio
 import imaplib  # 邮件协议处理
 import functools
+from contextlib import asynccontextmanager
 import urllib.parse
 import psutil  # 系统资源监控
 import threading  # 多线程支持
 from typing import List, Tuple, Dict, Any, Optional  # 类型注解
+from dataclasses import dataclass  # 轻量数据结构
 from time import monotonic
+from difflib import SequenceMatcher  # 最长公共子串（替代纯Python二维DP）
 from email import policy
 import unicodedata
 from datetime import datetime, timezone, timedelta
 from email.utils import parsedate_to_datetime
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 import base64  # 编码处理
 import sqlite3  # 数据库支持
 import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
+import multiprocessing  # PDF渲染进程池
 from pathlib import Path  # 路径处理
 from imapclient import imap_utf7  # 邮件编码处理
 from email.parser import BytesParser  # 邮件解析
+from email.header import decode_header  # RFC 2047 编码字解码
 from email import policy as email_policy  # 邮件解析策略
 
 
@@ -451,6 +457,51 @@ sys.modules["fitz"] = _LazyModule("fitz")
 import fitz  # 实际使用时才会真正导入
 
 
+# ---------------------------- PDF渲染进程池 ----------------------------
+# 渲染是纯CPU工作，线程池受GIL限制无法并行；放到子进程中执行。
+# 脚本以 __main__ 运行，spawn/forkserver 会重新执行整个脚本，因此只能用 fork；
+# 为避免子进程继承其他线程持有的锁、Telegram 连接和数据库句柄，进程池在此处（启动任何线程和连接之前）
+# 一次性 fork 出全部工作进程，运行期间不再新建；不支持 fork 或进程池损坏时退回到当前线程渲染。
+PDF_POOL_WORKERS = min(os.cpu_count() or 1, 4)
+_pdf_pool_lock = threading.Lock()
+
+def _render_pdf_worker(pdf_bytes: bytes, img_path: str) -> str:
+    """子进程执行：渲染PDF第一页并直接写入PNG文件，返回页面文本（PNG不经进程间管道回传）"""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        page = doc.load_page(0)
+        # matrix 会覆盖 dpi，两者只保留一个；回单只用于展示，200DPI足够
+        page.get_pixmap(dpi=200, alpha=False).save(img_path)
+        return page.get_text()
+    finally:
+        doc.close()
+
+def _start_pdf_pool() -> Optional[concurrent.futures.ProcessPoolExecutor]:
+    """创建进程池并立即拉起全部工作进程（首个任务提交时一次性 fork）"""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    try:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS,
+            mp_context=multiprocessing.get_context('fork')
+        )
+        pool.submit(os.getpid).result()
+        return pool
+    except Exception as e:
+        logger.warning(f"[PDF] 渲染进程池启动失败，改为在当前线程渲染: {e}")
+        return None
+
+def shutdown_pdf_pool() -> None:
+    """程序退出时关闭渲染进程池"""
+    global _PDF_POOL
+    with _pdf_pool_lock:
+        pool, _PDF_POOL = _PDF_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+_PDF_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = _start_pdf_pool()
+
+
 # ---------------------------- Telegram 相关（Telethon库） ----------------------------
 from telethon import TelegramClient, events, errors, utils
 from telethon.events import NewMessage
@@ -459,16 +510,19 @@ from telethon.tl.types import (
     InputPeerUser, InputPeerChannel, ChatBannedRights,
     ChannelParticipantsSearch, InputPeerChat,
     DocumentAttributeImageSize, ChatAdminRights,
-    Channel, Chat, User
+    Channel, Chat, User, InputUser
 )
 from telethon.tl.functions.channels import (
     InviteToChannelRequest, EditBannedRequest,
     CreateChannelRequest, EditAdminRequest,
-    LeaveChannelRequest, DeleteChannelRequest
+    LeaveChannelRequest, DeleteChannelRequest,
+    GetParticipantRequest
 )
 from telethon.tl.functions.messages import (
-    ExportChatInviteRequest, AddChatUserRequest
+    ExportChatInviteRequest, AddChatUserRequest,
+    GetFullChatRequest
 )
+from telethon.tl.functions.users import GetUsersRequest
 from telethon.utils import get_peer_id, get_display_name
 from telethon.errors import (
     ChatAdminRequiredError, UsernameNotOccupiedError,
@@ -682,13 +736,30 @@ async def get_group_ids_by_type(group_type):
         return [row[0] for row in await cursor.fetchall()]
 
 #---------------------------- 数据库操作：附文匹配（按文本关键词） ----------------------------
-async def get_appendix_for_text(text):
+APPENDIX_CACHE: Dict[str, str] = {}  # 附文缓存：{关键词: 内容}（启动时加载，增删改关键词后刷新）
+_appendix_search = None  # 全部关键词合并的预编译正则，单次扫描判断文本是否含任一关键词
+
+async def reload_appendices():
+    """从数据库重新加载附文缓存，并重建关键词匹配正则"""
+    global _appendix_search
     db = await DB.get_conn()
-    async with db.execute("SELECT keyword, content FROM appendices") as cursor:
-        appendices = await cursor.fetchall()
-        for keyword, content in appendices:
-            if keyword in text:
-                return content
+    rows = await db.execute_fetchall("SELECT keyword, content FROM appendices")
+    APPENDIX_CACHE.clear()
+    APPENDIX_CACHE.update(rows)
+    _appendix_search = (
+        re.compile("|".join(map(re.escape, APPENDIX_CACHE))).search if APPENDIX_CACHE else None
+    )
+
+def match_appendix_keywords(text) -> List[str]:
+    """返回文本中包含的全部关键词（绝大多数不含关键词的消息在正则扫描处直接返回）"""
+    if not text or _appendix_search is None or not _appendix_search(text):
+        return []
+    return [keyword for keyword in APPENDIX_CACHE if keyword in text]
+
+async def get_appendix_for_text(text):
+    matched = match_appendix_keywords(text)
+    if matched:
+        return APPENDIX_CACHE[matched[0]]
     return ""  # 如果没有匹配的附文，返回空字符串
 
 # ---------------------------- 数据库核心工具类（封装通用操作） ----------------------------
@@ -764,9 +835,13 @@ class AdminDAO:
             "INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)",
             (user_id, username),
         )
+        invalidate_admin_cache(user_id)
+        ADMIN_IDS.add(user_id)
 
     async def remove_admin(self, user_id: int):
         await self.db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+        invalidate_admin_cache(user_id)
+        ADMIN_IDS.discard(user_id)
 
     async def is_admin_by_id(self, user_id: int) -> bool:
         rows = await self.db.fetch_all(
@@ -832,10 +907,11 @@ class DatabasePool:
 
     async def _new_conn(self) -> aiosqlite.Connection:
         """创建新连接并切 WAL"""
-        conn = await aiosqlite.connect(self.db_file)
+        conn = await aiosqlite.connect(self.db_file, cached_statements=DB_CACHED_STATEMENTS)
         await conn.execute("PRAGMA journal_mode=WAL;")        # ★ 关键
-        # 可选：写性能再提升
-        # await conn.execute("PRAGMA synchronous=NORMAL;")
+        await conn.execute("PRAGMA busy_timeout=5000;")       # 与写连接并发时等待而非立即报错
+        # 写性能再提升：WAL 下 NORMAL 已足够安全，避免每次提交都 fsync
+        await conn.execute("PRAGMA synchronous=NORMAL;")
         return conn
 
     async def get_connection(self) -> aiosqlite.Connection:
@@ -851,6 +927,15 @@ class DatabasePool:
             else:
                 await conn.close()
 
+    @asynccontextmanager
+    async def acquire(self):
+        """借出一个读连接，用完自动归还：async with db_pool.acquire() as db"""
+        conn = await self.get_connection()
+        try:
+            yield conn
+        finally:
+            await self.release_connection(conn)
+
 db_pool = DatabasePool("database.db", pool_size=5)   # ← 若用其他文件名改这里
 
 # 通用查询工具函数
@@ -879,6 +964,11 @@ async def execute_write(query: str, *params) -> None:
 # 保持旧名兼容
 execute_query = fetch_all   # type: ignore
 
+async def fetchone(db, sql: str, params=()):
+    """在指定连接上查询单行（execute_fetchall 一次往返，省去游标上下文）"""
+    rows = await db.execute_fetchall(sql, params)
+    return rows[0] if rows else None
+
 # ---------------------------- Google 验证密钥数据访问（GASecretDAO） ----------------------------
 class GASecretDAO:
     """ga_secrets CRUD + Rename（Name/Secret 都去重）"""
@@ -1006,7 +1096,27 @@ os.makedirs("temp", exist_ok=True)
 # 全局缓存：记录最近处理过的 (群ID, order_id) 及对应时间
 recent_payback_requests = {}
 PAYBACK_DEDUPE_INTERVAL = 30  # 30 秒内重复忽略
-_pdf_text_cache = {} 
+# PDF文本/解析结果缓存：按PDF路径存放，LRU 上限防止长时间运行后无限增长
+# 附件处理在线程池中执行，读写都需加锁
+PDF_TEXT_CACHE_MAXSIZE = 512
+_pdf_text_cache = OrderedDict()
+_pdf_text_cache_lock = threading.Lock()
+
+def _pdf_cache_get(key: str) -> Optional[dict]:
+    """读取缓存项，命中时移到末尾（最近使用）"""
+    with _pdf_text_cache_lock:
+        entry = _pdf_text_cache.get(key)
+        if entry is not None:
+            _pdf_text_cache.move_to_end(key)
+        return entry
+
+def _pdf_cache_set(key: str, data) -> None:
+    """写入缓存项，超出上限时淘汰最久未使用的项"""
+    with _pdf_text_cache_lock:
+        _pdf_text_cache[key] = {'data': data, 'timestamp': time.time()}
+        _pdf_text_cache.move_to_end(key)
+        while len(_pdf_text_cache) > PDF_TEXT_CACHE_MAXSIZE:
+            _pdf_text_cache.popitem(last=False)
 # 缓存所有“代付”分组的群ID，启动时加载 & “设置代付”时维护
 payback_groups = set()
 
@@ -1068,6 +1178,7 @@ async def log_received_message(event):
 
 # ---------------------------- 全局配置变量 ----------------------------
 DB_TIMEOUT = 30  # 数据库操作超时时间（秒）
+DB_CACHED_STATEMENTS = 256  # 每个连接缓存的预编译SQL语句数量
 DB_PATH = "database.db"  # 数据库文件存储路径
 bot_info = None  # 机器人信息存储变量（预留，可用于存储机器人详细信息）
 BOT_USER_ID: int | None = None  # 机器人用户ID（登录后初始化）
@@ -1084,10 +1195,13 @@ class DB:
     async def get_conn(cls):
         async with cls._lock:
             if not cls._conn:
-                cls._conn = await aiosqlite.connect(DB_PATH, timeout=DB_TIMEOUT)
+                cls._conn = await aiosqlite.connect(
+                    DB_PATH, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS
+                )
                 await cls._conn.execute("PRAGMA journal_mode=WAL")
                 await cls._conn.execute("PRAGMA synchronous=NORMAL")
                 await cls._conn.execute("PRAGMA busy_timeout=5000")  # 数据库繁忙时等待5秒
+                await cls._conn.execute("PRAGMA temp_store=MEMORY")  # 临时表/排序放内存
             return cls._conn
 
 # ---------------------------- 线程池配置 ----------------------------
@@ -1116,6 +1230,8 @@ async def init_all_tables():
 
             # 群组配置表：存储群组ID和群组类型
             await db.execute("CREATE TABLE IF NOT EXISTS group_config (chat_id INTEGER PRIMARY KEY, group_type TEXT)")
+            # chat_id 已是主键；群发按类型取群组需要 group_type 索引
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_group_config_type ON group_config(group_type)")
 
             # 绑定关系表：存储转发绑定关系（去重处理）
             await db.execute("CREATE TABLE IF NOT EXISTS bindings (from_id INTEGER, to_id INTEGER, user_id INTEGER)")
@@ -1127,9 +1243,25 @@ async def init_all_tables():
             """)  # 清理重复绑定关系
             await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bind_unique ON bindings(from_id, to_id)")
 
-            # 提及用户表：存储群组ID及对应的多个逗号分隔用户
+            # 提及用户表：一个群组的每个通知用户一行，主键保证同群不重复（rowid 保留添加顺序）
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS mention_users (
+                    group_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    PRIMARY KEY (group_id, username)
+                )
+            """)
+            # 旧版提及用户表（一个群组一行、逗号分隔），仅用于迁移历史数据
             await db.execute("CREATE TABLE IF NOT EXISTS mentions (group_id INTEGER, usernames TEXT)")
             await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_mentions_unique ON mentions(group_id)")
+            legacy_mentions = await db.execute_fetchall("SELECT group_id, usernames FROM mentions")
+            if legacy_mentions:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO mention_users (group_id, username) VALUES (?, ?)",
+                    [(gid, u) for gid, usernames in legacy_mentions for u in split_usernames(usernames)]
+                )
+                await db.execute("DELETE FROM mentions")
+                logger.info(f"[数据库] 已将 {len(legacy_mentions)} 个群组的通知用户迁移到 mention_users 表")
 
             # 员工信息表：存储用户ID、哈希值、用户名及更新时间
             await db.execute("""
@@ -1233,6 +1365,14 @@ async def init_all_tables():
             await db.execute("CREATE INDEX IF NOT EXISTS idx_sent_order ON sent_messages(order_identifier)")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_sent_chat ON sent_messages(chat_id)")
 
+            # 群发记录归档表：内存中被LRU淘汰的群发记录 {群组ID: 消息ID}
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS archived_sent_messages (
+                    msg_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL
+                )
+            """)
+
             # 提交所有表结构更改
             await db.commit()
             logger.info("✅ 数据库初始化完成")
@@ -1310,6 +1450,8 @@ async def set_first_admin(event):
                     (user_id, username)
                 )
                 await db.commit()
+                invalidate_admin_cache(user_id)
+                ADMIN_IDS.add(user_id)
 
                 await event.reply("✅ 已将你设置为管理员")
                 logger.info(f"用户 {username} (ID: {user_id}) 已设置为初始管理员")
@@ -1355,6 +1497,8 @@ async def add_admin(event):
 
     await db.execute("INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)", (user_id, username))
     await db.commit()
+    invalidate_admin_cache(user_id)
+    ADMIN_IDS.add(user_id)
 
     logger.info(f"管理员 {event.sender_id} 添加了管理员 @{username} (ID: {user_id})")
 
@@ -1386,6 +1530,8 @@ async def remove_admin(event):
 
     await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
     await db.commit()
+    invalidate_admin_cache(user_id)
+    ADMIN_IDS.discard(user_id)
 
     logger.info(f"管理员 {event.sender_id} 删除了管理员 {username}")
 
@@ -2695,7 +2841,11 @@ pending_images = defaultdict(list)  # 待处理图片队列：{提示消息ID: [
 PENDING_SEND_DELAY = 2.0  # 图片发送延迟时间（秒）
 REPLY_PAYBACK_DELAY = 1.5  # 代付回复延迟时间（秒）
 active_send_tasks = set()  # 活跃的图片发送任务集合
-recent_payback_records = dict()  # 近期代付操作记录：{键: 时间戳}
+merge_send_timers = dict()  # 图片合并发送的防抖任务：{提示消息ID: Task}
+MERGE_QUIET_SECONDS = 0.5  # 最后一张图片到达后的静默等待时间（秒）
+_bg_tasks = set()  # 后台任务登记：保持强引用，退出时统一取消
+recent_payback_records = dict()  # 近期代付去重记录：{(群ID, 订单号/消息ID): 时间戳}
+payback_tip_records = dict()  # 代付提示消息记录：{提示消息ID: PaybackRecord}
 recent_cd_responses = dict()  # 近期查单回复记录：{键: 时间戳}
 
 # 新增优化相关变量
@@ -2705,6 +2855,15 @@ blacklist_cache = set()      # 黑词缓存集合
 blacklist_last_refresh = 0   # 黑词缓存最后刷新时间戳
 BLACKLIST_REFRESH_INTERVAL = 300  # 黑词缓存刷新间隔（秒）
 
+# 单条代付提示消息的缓存信息（替代原先按 (提示消息ID, 字段名) 拆分的多个键）
+@dataclass(slots=True)
+class PaybackRecord:
+    orders: list  # 关联订单号列表（单个订单也以列表保存）
+    group: int  # 所在群组ID
+    is_bot_sender: bool  # 是否由Bot发起
+    first_trigger_msg_id: int  # 触发提示的原始消息ID
+    create_time: float  # 创建时间（monotonic）
+
 # 订单号与指令正则表达式
 _order_pattern = re.compile(r"(?<![@A-Za-z0-9])\b([A-Za-z0-9_]{10,})\b")  # 匹配订单号
 _c_pattern = re.compile(r'^c\s+([A-Za-z0-9_]{10,})\s*$', re.IGNORECASE)  # 匹配查单指令
@@ -2739,15 +2898,19 @@ async def clean_expired_cache():
                 for key in expired_keys:
                     del recent_payback_records[key]
                 
-                # 清理过期的图片缓存
-                expired_tip_ids = []
-                for tip_id in pending_images:
-                    create_time = recent_payback_records.get((tip_id, "create_time"), 0)
-                    if current_time - create_time > CACHE_EXPIRE_SECONDS:
-                        expired_tip_ids.append(tip_id)
+                # 清理过期的提示消息记录及图片缓存
+                expired_tip_ids = [
+                    tip_id for tip_id, rec in payback_tip_records.items()
+                    if current_time - rec.create_time > CACHE_EXPIRE_SECONDS
+                ]
+                expired_tip_ids.extend(
+                    tip_id for tip_id in pending_images
+                    if tip_id not in payback_tip_records
+                )
                 
                 for tip_id in expired_tip_ids:
-                    del pending_images[tip_id]
+                    payback_tip_records.pop(tip_id, None)
+                    pending_images.pop(tip_id, None)
             
             # 每小时清理一次
             await asyncio.sleep(3600)
@@ -2899,11 +3062,13 @@ async def catch_payback_request(event):
         tip_msg_id = sent.id
         pending_images[tip_msg_id] = []
         async with cache_lock:
-            recent_payback_records[(tip_msg_id, "orders")] = valid_orders
-            recent_payback_records[(tip_msg_id, "group")] = chat_id
-            recent_payback_records[(tip_msg_id, "first_trigger_msg_id")] = event.id
-            recent_payback_records[(tip_msg_id, "is_bot_sender")] = is_bot_sender
-            recent_payback_records[(tip_msg_id, "create_time")] = monotonic()  # 记录创建时间
+            payback_tip_records[tip_msg_id] = PaybackRecord(
+                orders=valid_orders,
+                group=chat_id,
+                is_bot_sender=is_bot_sender,
+                first_trigger_msg_id=event.id,
+                create_time=monotonic(),  # 记录创建时间
+            )
 
     else:
         order_id = order_ids[0] if order_ids else None
@@ -2930,11 +3095,13 @@ async def catch_payback_request(event):
         tip_msg_id = sent.id
         pending_images[tip_msg_id] = []
         async with cache_lock:
-            recent_payback_records[(tip_msg_id, "order")] = order_id
-            recent_payback_records[(tip_msg_id, "group")] = chat_id
-            recent_payback_records[(tip_msg_id, "first_trigger_msg_id")] = event.id
-            recent_payback_records[(tip_msg_id, "is_bot_sender")] = is_bot_sender
-            recent_payback_records[(tip_msg_id, "create_time")] = monotonic()  # 记录创建时间
+            payback_tip_records[tip_msg_id] = PaybackRecord(
+                orders=[order_id],
+                group=chat_id,
+                is_bot_sender=is_bot_sender,
+                first_trigger_msg_id=event.id,
+                create_time=monotonic(),  # 记录创建时间
+            )
 
         logger.info(
             f"[代付] 在群组 [{chat_id:>14}] {instruction} {order_id}（{'Bot' if is_bot_sender else '用户'}）"
@@ -3046,11 +3213,13 @@ async def handle_payback_reply(event):
                 tip_msg_id = sent.id
                 pending_images[tip_msg_id] = []
                 async with cache_lock:
-                    recent_payback_records[(tip_msg_id, "order")] = order_id
-                    recent_payback_records[(tip_msg_id, "group")] = chat_id
-                    recent_payback_records[(tip_msg_id, "first_trigger_msg_id")] = event.id
-                    recent_payback_records[(tip_msg_id, "is_bot_sender")] = is_bot_sender
-                    recent_payback_records[(tip_msg_id, "create_time")] = monotonic()  # 记录创建时间
+                    payback_tip_records[tip_msg_id] = PaybackRecord(
+                        orders=[order_id],
+                        group=chat_id,
+                        is_bot_sender=is_bot_sender,
+                        first_trigger_msg_id=event.id,
+                        create_time=monotonic(),  # 记录创建时间
+                    )
                     recent_payback_records[order_key] = monotonic()
             
             return
@@ -3099,11 +3268,13 @@ async def handle_payback_reply(event):
             tip_msg_id = sent.id
             pending_images[tip_msg_id] = []
             async with cache_lock:
-                recent_payback_records[(tip_msg_id, "orders")] = valid_orders
-                recent_payback_records[(tip_msg_id, "group")] = chat_id
-                recent_payback_records[(tip_msg_id, "first_trigger_msg_id")] = event.id
-                recent_payback_records[(tip_msg_id, "is_bot_sender")] = is_bot_sender
-                recent_payback_records[(tip_msg_id, "create_time")] = monotonic()  # 记录创建时间
+                payback_tip_records[tip_msg_id] = PaybackRecord(
+                    orders=valid_orders,
+                    group=chat_id,
+                    is_bot_sender=is_bot_sender,
+                    first_trigger_msg_id=event.id,
+                    create_time=monotonic(),  # 记录创建时间
+                )
                 
     except Exception as e:
         safe_chat_id = chat_id if 'chat_id' in locals() else "未知群组"
@@ -3159,6 +3330,12 @@ async def auto_reply_cd_messages(event):
     except Exception as e:
         logger.error(f"[代付] 在群组 [{chat_id:>14}] 处理{'cd' if cd_match else 'c'}消息回复失败: {e}")
 
+# 读取提示消息关联的代付记录
+async def _get_payback_record(tip_msg_id):
+    """加锁读取提示消息对应的 PaybackRecord，不存在时返回 None"""
+    async with cache_lock:
+        return payback_tip_records.get(tip_msg_id)
+
 # 捕捉所有图片消息
 @client.on(events.NewMessage(incoming=True, func=lambda e: e.is_group and e.message.photo is not None))
 async def catch_all_images(event):
@@ -3169,16 +3346,19 @@ async def catch_all_images(event):
 
     is_album = hasattr(event.message, 'grouped_id')
     order_ids = []
+    group_id = None
+    is_bot_sender = False
     reply_to = await event.get_reply_message()
     tip_msg_id = None
     
     if reply_to:
         tip_msg_id = reply_to.id
-        async with cache_lock:
-            order_ids = recent_payback_records.get((tip_msg_id, "orders"), [])
-            if not order_ids:
-                order_ids = [recent_payback_records.get((tip_msg_id, "order"))]
-            order_ids = [oid for oid in order_ids if oid is not None]
+        # 一次加锁取出记录快照，后续分支统一使用
+        rec = await _get_payback_record(tip_msg_id)
+        if rec:
+            order_ids = rec.orders
+            group_id = rec.group
+            is_bot_sender = rec.is_bot_sender
 
     if not order_ids:
         logger.info(f"[代付] 在群组 [{chat_id:>14}] 已收到无关联订单的图片，将不进行缓存处理")
@@ -3201,21 +3381,11 @@ async def catch_all_images(event):
         logger.debug(f"[代付] 在群组 [{chat_id:>14}] 收到图片但回复对象不在缓存，清理缓存")
         return
 
-    async with cache_lock:
-        is_bot_sender = recent_payback_records.get((tip_msg_id, "is_bot_sender"), False)
-    
     if not is_bot_sender:
         logger.info(f"[代付] 在群组 [{chat_id:>14}] 收到图片由用户发起请求，将跳过图片处理")
         await _cleanup_pending_images(tip_msg_id)
         return
 
-    async with cache_lock:
-        order_ids = recent_payback_records.get((tip_msg_id, "orders"), [])
-        if not order_ids:
-            order_ids = [recent_payback_records.get((tip_msg_id, "order"))]
-        order_ids = [oid for oid in order_ids if oid is not None]
-        group_id = recent_payback_records.get((tip_msg_id, "group"))
-    
     if not order_ids or not group_id:
         logger.warning(f"[代付] 在群组 [{chat_id:>14}] 收到图片但未找到有效订单或群信息，清理缓存")
         await _cleanup_pending_images(tip_msg_id)
@@ -3232,11 +3402,14 @@ async def catch_all_images(event):
     pending_images[tip_msg_id].append(local_path)
     image_count = len(pending_images[tip_msg_id])
     
-    if image_count == 1:
-        asyncio.create_task(send_merged_images(tip_msg_id))
-    elif image_count == 2:
-        asyncio.create_task(send_merged_images(tip_msg_id))
-    else:
+    # 防抖：每收到一张图片重置计时，相册N张只触发一次发送
+    if tip_msg_id not in active_send_tasks:
+        timer = merge_send_timers.get(tip_msg_id)
+        if timer and not timer.done():
+            timer.cancel()
+        merge_send_timers[tip_msg_id] = _spawn_bg_task(_debounced_send_merged_images(tip_msg_id))
+    
+    if image_count > 2:
         if len(order_ids) == 1:
             order_desc = f"订单{order_ids[0]}"
         else:
@@ -3257,15 +3430,33 @@ async def _cleanup_pending_images(tip_msg_id):
                 logger.error(f"[代付] 清理图片文件失败：{e}")
         async with cache_lock:
             pending_images.pop(tip_msg_id, None)
-            recent_payback_records.pop((tip_msg_id, "orders"), None)
-            recent_payback_records.pop((tip_msg_id, "order"), None)
-            recent_payback_records.pop((tip_msg_id, "group"), None)
-            recent_payback_records.pop((tip_msg_id, "first_trigger_msg_id"), None)
-            recent_payback_records.pop((tip_msg_id, "is_bot_sender"), None)
-            recent_payback_records.pop((tip_msg_id, "create_time"), None)
+            payback_tip_records.pop(tip_msg_id, None)
         logger.debug(f"[代付] 已清理tip_msg_id {tip_msg_id} 的缓存")
 
 
+# 登记后台任务（异常写日志，完成后自动移除）
+def _on_bg_task_done(task):
+    _bg_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"[代付] 后台任务异常：{task.exception()}")
+
+def _spawn_bg_task(coro):
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_on_bg_task_done)
+    return task
+
+# 静默期结束后发送合并图片
+async def _debounced_send_merged_images(tip_msg_id: int):
+    """等待静默期（期间有新图片会被取消重排），再发送合并图片"""
+    try:
+        await asyncio.sleep(MERGE_QUIET_SECONDS)
+    except asyncio.CancelledError:
+        return
+    merge_send_timers.pop(tip_msg_id, None)
+    await send_merged_images(tip_msg_id)
+
+
 # 发送合并的图片
 async def send_merged_images(tip_msg_id: int):
     """发送并合并缓存的图片"""
@@ -3275,20 +3466,15 @@ async def send_merged_images(tip_msg_id: int):
     active_send_tasks.add(tip_msg_id)
 
     try:
-        await asyncio.sleep(0.5)
         if tip_msg_id not in pending_images:
             return
 
-        async with cache_lock:
-            order_ids = recent_payback_records.get((tip_msg_id, "orders"), [])
-            if not order_ids:
-                order_ids = [recent_payback_records.get((tip_msg_id, "order"))]
-            order_ids = [oid for oid in order_ids if oid is not None]
-            group_id = recent_payback_records.get((tip_msg_id, "group"))
-            is_bot_sender = recent_payback_records.get((tip_msg_id, "is_bot_sender"), False)
-        
-        if not order_ids or not group_id:
+        rec = await _get_payback_record(tip_msg_id)
+        if not rec or not rec.orders or not rec.group:
             return
+        order_ids = rec.orders
+        group_id = rec.group
+        is_bot_sender = rec.is_bot_sender
 
         if not is_bot_sender:
             logger.info(f"[代付] 在群组 [{group_id:>14}] 用户订单（{len(order_ids)}个），跳过发送")
@@ -3299,7 +3485,7 @@ async def send_merged_images(tip_msg_id: int):
             logger.warning(f"[代付] 在群组 [{group_id:>14}] 订单（{len(order_ids)}个）无图片，跳过")
             return
 
-        first_trigger_msg_id = recent_payback_records.get((tip_msg_id, "first_trigger_msg_id"))
+        first_trigger_msg_id = rec.first_trigger_msg_id
         caption = ""  
         try:
             await client.send_file(
@@ -3322,12 +3508,7 @@ async def send_merged_images(tip_msg_id: int):
         
         async with cache_lock:
             pending_images.pop(tip_msg_id, None)
-            recent_payback_records.pop((tip_msg_id, "orders"), None)
-            recent_payback_records.pop((tip_msg_id, "order"), None)
-            recent_payback_records.pop((tip_msg_id, "group"), None)
-            recent_payback_records.pop((tip_msg_id, "first_trigger_msg_id"), None)
-            recent_payback_records.pop((tip_msg_id, "is_bot_sender"), None)
-            recent_payback_records.pop((tip_msg_id, "create_time"), None)
+            payback_tip_records.pop(tip_msg_id, None)
         
         active_send_tasks.discard(tip_msg_id)
     
@@ -3370,6 +3551,30 @@ async def get_group_id(event):
 
 
 # ✅ 三方辅助机器人 - Part 9：群组互通功能模块（下载+重新上传，保留媒体和格式）
+# 互通指令预编译正则（每条群消息都会经过，避免重复字符串扫描）
+_BIND_COMMANDS = ('绑定群组', '解绑群组', '查看绑定')
+_CMD_RE = re.compile(r'^(?:' + '|'.join(_BIND_COMMANDS) + r')')  # 匹配绑定类指令前缀
+_has_order_kw = re.compile(r'回单|撤单|驳回').search  # 匹配回单/撤单关键词
+
+# 双向绑定查询（固定SQL文本，便于SQLite语句缓存命中）
+_SQL_TWO_WAY = '''
+    SELECT b1.to_id
+    FROM bindings AS b1
+    JOIN bindings AS b2
+      ON b1.to_id = b2.from_id
+     AND b2.to_id = b1.from_id
+    WHERE b1.from_id = ?
+'''
+
+
+async def _delete_binding_pair(db, group_a, group_b):
+    """解除两个群组间的双向绑定：两条均命中 idx_bind_unique 的删除，同一事务提交"""
+    await db.executemany(
+        "DELETE FROM bindings WHERE from_id = ? AND to_id = ?",
+        ((group_a, group_b), (group_b, group_a))
+    )
+    await db.commit()
+
 # --------- 1. 绑定群组 ---------
 @client.on(events.NewMessage(pattern=r'^绑定群组\s+(-?\d+)$'))
 async def bind_group_handler(event):
@@ -3409,38 +3614,25 @@ async def view_bindings_handler(event):
 
     from_id = event.chat_id
 
-    # 1) 查询所有本群“单向”绑定出去的记录（from_id -> to_id）
-    db = await DB.get_conn()
-    async with db.execute(
-        "SELECT to_id FROM bindings WHERE from_id = ?", (from_id,)
-    ) as cursor:
-        all_rows = await cursor.fetchall()
-    all_to = set(r[0] for r in all_rows)  # 本群绑定出去的所有目标群 ID
-
-    # 2) 查询本群与哪些群是双向绑定关系
-    sql_two_way = """
-        SELECT b1.to_id
+    # 1) 一次查询本群绑定出去的所有目标群，并标记是否为双向绑定（单向在前）
+    sql = """
+        SELECT b1.to_id,
+               EXISTS(
+                   SELECT 1 FROM bindings AS b2
+                   WHERE b2.from_id = b1.to_id AND b2.to_id = b1.from_id
+               ) AS two_way
         FROM bindings AS b1
-        JOIN bindings AS b2
-          ON b1.to_id = b2.from_id
-         AND b2.to_id = b1.from_id
         WHERE b1.from_id = ?
+        ORDER BY two_way, b1.to_id
     """
-    async with db.execute(sql_two_way, (from_id,)) as cursor:
-        two_way_rows = await cursor.fetchall()
-    two_to = set(r[0] for r in two_way_rows)  # 本群所有双向绑定的群 ID
-
-    # 3) 计算单向绑定（存在 all_to 但不在 two_to）
-    one_way_to = all_to - two_to
+    db = await DB.get_conn()
+    async with db.execute(sql, (from_id,)) as cursor:
+        rows = await cursor.fetchall()
 
-    # 4) 拼接输出行：单向 ➡️，双向 ↔️
-    lines = []
-    for tid in sorted(one_way_to):
-        lines.append(f"{from_id}➡️{tid}")
-    for tid in sorted(two_to):
-        lines.append(f"{from_id}↔️{tid}")
+    # 2) 拼接输出行：单向 ➡️，双向 ↔️
+    lines = [f"{from_id}{'↔️' if two_way else '➡️'}{tid}" for tid, two_way in rows]
 
-    # 5) 回复
+    # 3) 回复
     if not lines:
         await event.reply('ℹ️ 本群尚未绑定任何群组。')
         logger.info(f"管理员 {event.sender_id} 在群 {from_id} 查询绑定关系，结果无绑定群组")
@@ -3459,15 +3651,7 @@ async def unbind_group_handler(event):
     db = await DB.get_conn()
     try:
         # 删除双向绑定记录
-        await db.execute(
-            '''
-            DELETE FROM bindings
-            WHERE (from_id = ? AND to_id = ?)
-               OR (from_id = ? AND to_id = ?)
-            ''',
-            (from_id, target_id, target_id, from_id)
-        )
-        await db.commit()
+        await _delete_binding_pair(db, from_id, target_id)
         await event.reply(f'✅ 已从本群（{from_id}）解除与群组 {target_id} 的双向绑定。')
         logger.info(f"管理员 {event.sender_id} 在群 {from_id} 成功解除与群组 {target_id} 的双向绑定")
     except Exception as e:
@@ -3482,28 +3666,21 @@ async def forward_between_groups(event):
     if not event.is_group or event.out or event.fwd_from:
         return
     text = (event.raw_text or '').strip()
-    if text.startswith(('绑定群组', '解绑群组', '查看绑定')):
+    if _CMD_RE.match(text):
         return
 
     from_id = event.chat_id
+    db = await DB.get_conn()
 
     # 2. 检查消息是否包含黑词
     if await contains_blacklist_keywords(text):  # 检查是否包含黑词
         # 继续同步到目标群
-        await sync_message_to_groups(event, from_id)
+        await sync_message_to_groups(event, from_id, db)
         return
 
     # 3. 查询双向绑定群组
-    sql = '''
-        SELECT b1.to_id
-        FROM bindings AS b1
-        JOIN bindings AS b2
-          ON b1.to_id = b2.from_id
-         AND b2.to_id = b1.from_id
-        WHERE b1.from_id = ?
-    '''
+    sql = _SQL_TWO_WAY
     try:
-        db = await DB.get_conn()
         async with db.execute(sql, (from_id,)) as cursor:
             rows = await cursor.fetchall()
     except Exception:
@@ -3521,12 +3698,8 @@ async def forward_between_groups(event):
     instr = None
     order_ids = []
 
-    if "回单" in text:
-        instr = "代付回单"
-        order_ids = _order_pattern.findall(text)
-
-    elif "撤单" in text or "驳回" in text:
-        instr = "代付撤单"
+    if _has_order_kw(text):
+        instr = "代付回单" if "回单" in text else "代付撤单"
         order_ids = _order_pattern.findall(text)
 
     if instr and order_ids:
@@ -3541,10 +3714,9 @@ async def forward_between_groups(event):
                         logger.warning(f"[代付] 在群组 [{from_id}] 延迟被中断，跳过")
                         continue
 
-                # 6. 串行执行 + 节流：补充传递 db 和 from_id 参数
+                # 6. 串行执行（节流由 send_to_group 内的令牌桶负责）
                 for tid in target_ids:
                     await send_to_group(tid, instr, [order_id], event, db, from_id)
-                    await asyncio.sleep(0.5)
 
             # 7. 总结日志
             status_msg = " 成功" if sync_success else " 失败"
@@ -3555,7 +3727,6 @@ async def forward_between_groups(event):
             # 撤单支持多个订单号，补充传递 db 和 from_id 参数
             for tid in target_ids:
                 await send_to_group(tid, instr, order_ids, event, db, from_id)
-                await asyncio.sleep(0.5)
 
             # 7. 总结日志
             status_msg = " 成功" if sync_success else " 失败"
@@ -3565,22 +3736,16 @@ async def forward_between_groups(event):
 
     else:
         # 其他信息的同步，保持原有的消息格式与逻辑
-        await sync_message_to_groups(event, from_id)
+        await sync_message_to_groups(event, from_id, db)
 
 
 # --------- 发送普通消息到群组 ---------
-async def sync_message_to_groups(event, from_id):
+async def sync_message_to_groups(event, from_id, db=None):
     # 查询双向绑定群组
-    sql = '''
-        SELECT b1.to_id
-        FROM bindings AS b1
-        JOIN bindings AS b2
-          ON b1.to_id = b2.from_id
-         AND b2.to_id = b1.from_id
-        WHERE b1.from_id = ?
-    '''
+    sql = _SQL_TWO_WAY
     try:
-        db = await DB.get_conn()
+        if db is None:
+            db = await DB.get_conn()
         async with db.execute(sql, (from_id,)) as cursor:
             rows = await cursor.fetchall()
     except Exception:
@@ -3595,11 +3760,12 @@ async def sync_message_to_groups(event, from_id):
     # 转发普通消息：补充传递 db 和 from_id 参数
     for tid in target_ids:
         await send_to_group(tid, None, [], event, db, from_id)
-        await asyncio.sleep(0.5)
     logger.info(f"[互通] 来自群 [{from_id}] 的消息，已成功同步群组：{target_ids}")
 
 
 # --------- 发送消息到指定群组（修正重复定义，保留唯一实现） ---------
+send_limiter = AsyncLimiter(max_rate=20, time_period=1)  # 互通发送令牌桶：全局每秒最多20条
+
 async def send_to_group(target_id, instr, order_ids, event, db, from_id):
     # 转发处理函数（支持回单与撤单的区分）
     async def _try_send():
@@ -3643,7 +3809,8 @@ async def send_to_group(target_id, instr, order_ids, event, db, from_id):
         )
 
     try:
-        await _try_send()
+        async with send_limiter:
+            await _try_send()
 
     except FloodWaitError as e:
         logger.warning(f"⚠️ 发送到群组 [{target_id}] 触发限流，等待 {e.seconds} 秒后重试")
@@ -3667,15 +3834,7 @@ async def send_to_group(target_id, instr, order_ids, event, db, from_id):
         sync_success = False
         logger.error(f"❌ 群组 [{target_id}] 无访问权限，尝试自动解除绑定")
         try:
-            await db.execute(
-                '''
-                DELETE FROM bindings
-                WHERE (from_id = ? AND to_id = ?)
-                   OR (from_id = ? AND to_id = ?)
-                ''',
-                (from_id, target_id, target_id, from_id)
-            )
-            await db.commit()
+            await _delete_binding_pair(db, from_id, target_id)
             logger.info(f"✅ 已自动解除 [{from_id}] 与 [{target_id}] 的绑定关系")
         except Exception as e_db:
             logger.error(f"⚠️ 自动解除绑定失败: {e_db}")
@@ -3684,15 +3843,7 @@ async def send_to_group(target_id, instr, order_ids, event, db, from_id):
         sync_success = False
         logger.error(f"❌ 无法找到群组 [{target_id}] 的实体：{e}，尝试自动解除绑定")
         try:
-            await db.execute(
-                '''
-                DELETE FROM bindings
-                WHERE (from_id = ? AND to_id = ?)
-                   OR (from_id = ? AND to_id = ?)
-                ''',
-                (from_id, target_id, target_id, from_id)
-            )
-            await db.commit()
+            await _delete_binding_pair(db, from_id, target_id)
             logger.info(f"✅ 已自动解除 [{from_id}] 与 [{target_id}] 的绑定关系")
         except Exception as e_db:
             logger.error(f"⚠️ 自动解除绑定失败: {e_db}")
@@ -3712,25 +3863,121 @@ async def send_to_group(target_id, instr, order_ids, event, db, from_id):
 
 
 
-# 全局存储结构：{原始消息ID: {群组ID: 机器人发送的消息ID}}
-sent_messages = defaultdict(dict)
+# 全局存储结构：{原始消息ID: {群组ID: 机器人发送的消息ID}}（LRU，超出上限的旧记录归档到数据库）
+sent_messages = OrderedDict()
+SENT_MESSAGES_MAX = 5000
+GROUP_SEND_CONCURRENCY = 10  # 群发/批量删除时的最大并发群组数
 # 全局实体缓存（优化：移至函数外部，避免重复解析实体）
 global_group_entities = {}
 
-# 新增：验证用户是否为管理员（从数据库读取）
+async def archive_old_sent_messages(db=None):
+    """内存记录超出上限时，把最久未使用的群发记录转存到归档表"""
+    if len(sent_messages) <= SENT_MESSAGES_MAX:
+        return
+    rows = []
+    while len(sent_messages) > SENT_MESSAGES_MAX:
+        old_id, data = sent_messages.popitem(last=False)
+        rows.append((old_id, pickle.dumps(data)))
+    db = db or await DB.get_conn()
+    await db.executemany(
+        "INSERT OR REPLACE INTO archived_sent_messages (msg_id, data) VALUES (?, ?)", rows
+    )
+    await db.commit()
+
+async def get_sent_record(original_message_id, db=None):
+    """按原始消息ID取群发记录：先查内存，未命中再查归档表并放回内存"""
+    record = sent_messages.get(original_message_id)
+    if record is not None:
+        sent_messages.move_to_end(original_message_id)
+        return record
+    db = db or await DB.get_conn()
+    row = await fetchone(db, "SELECT data FROM archived_sent_messages WHERE msg_id = ?", (original_message_id,))
+    if not row:
+        return None
+    record = pickle.loads(row[0])
+    sent_messages[original_message_id] = record
+    await archive_old_sent_messages(db)
+    return record
+
+async def drop_sent_record(original_message_id, db=None):
+    """同时清理内存与归档表中的群发记录"""
+    sent_messages.pop(original_message_id, None)
+    db = db or await DB.get_conn()
+    await db.execute("DELETE FROM archived_sent_messages WHERE msg_id = ?", (original_message_id,))
+    await db.commit()
+
+# 管理员校验结果短期缓存：{用户ID: (是否管理员, 过期时间)}
+_ADMIN_CACHE: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+ADMIN_CACHE_TTL = 60        # 缓存有效期（秒）
+ADMIN_CACHE_MAXSIZE = 4096  # 超出后淘汰最久未使用的记录
+
+# 内存管理员ID集合：启动时从数据库加载，增删管理员时同步更新，供高频指令同步预过滤
+ADMIN_IDS = set()
+
+async def load_admin_ids():
+    """从 admins 表加载全部管理员ID"""
+    db = await DB.get_conn()
+    rows = await db.execute_fetchall("SELECT user_id FROM admins")
+    ADMIN_IDS.clear()
+    ADMIN_IDS.update(row[0] for row in rows)
+
+def invalidate_admin_cache(user_id=None):
+    """管理员增删后失效缓存；不传用户ID则全部清空"""
+    if user_id is None:
+        _ADMIN_CACHE.clear()
+    else:
+        _ADMIN_CACHE.pop(user_id, None)
+
+# 新增：验证用户是否为管理员（从数据库读取，结果缓存 ADMIN_CACHE_TTL 秒）
 async def is_admin(user_id):
+    now = monotonic()
+    cached = _ADMIN_CACHE.get(user_id)
+    if cached and cached[1] > now:
+        _ADMIN_CACHE.move_to_end(user_id)
+        return cached[0]
     db = await DB.get_conn()
     async with db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)) as cursor:
         # 若查询到记录，则返回True（是管理员）
-        return await cursor.fetchone() is not None
+        result = await cursor.fetchone() is not None
+    _ADMIN_CACHE[user_id] = (result, now + ADMIN_CACHE_TTL)
+    _ADMIN_CACHE.move_to_end(user_id)
+    while len(_ADMIN_CACHE) > ADMIN_CACHE_MAXSIZE:
+        _ADMIN_CACHE.popitem(last=False)
+    return result
+
+# 群组实体紧凑序列化：类型标记(1字节) + 群组ID(8字节) + access_hash(8字节)
+_ENTITY_STRUCT = struct.Struct('<Bqq')
+_ENTITY_TAG_CHANNEL = 1
+_ENTITY_TAG_CHAT = 2
+
+def pack_entity(entity) -> bytes:
+    """只保留发送所需的 InputPeer 字段，打包为17字节"""
+    peer = utils.get_input_peer(entity)
+    if isinstance(peer, InputPeerChannel):
+        return _ENTITY_STRUCT.pack(_ENTITY_TAG_CHANNEL, peer.channel_id, peer.access_hash)
+    if isinstance(peer, InputPeerChat):
+        return _ENTITY_STRUCT.pack(_ENTITY_TAG_CHAT, peer.chat_id, 0)
+    raise TypeError(f"不支持的群组实体类型：{type(peer).__name__}")
+
+def unpack_entity(blob: bytes):
+    """还原为 InputPeerChannel/InputPeerChat；兼容旧版 pickle 数据"""
+    if len(blob) != _ENTITY_STRUCT.size:
+        return pickle.loads(blob)
+    tag, peer_id, access_hash = _ENTITY_STRUCT.unpack(blob)
+    if tag == _ENTITY_TAG_CHANNEL:
+        return InputPeerChannel(channel_id=peer_id, access_hash=access_hash)
+    if tag == _ENTITY_TAG_CHAT:
+        return InputPeerChat(chat_id=peer_id)
+    raise ValueError(f"未知的实体类型标记：{tag}")
 
 # 新增：将实体同步到数据库（持久化）
-async def save_entity_to_db(chat_id, entity):
-    """将实体序列化后存入数据库"""
+async def save_entity_to_db(chat_id, entity, db=None):
+    """将实体序列化后存入数据库（可传入调用方已持有的连接）"""
     try:
-        db = await DB.get_conn()
+        if db is None:
+            db = await DB.get_conn()
         # 序列化实体
-        entity_data = pickle.dumps(entity)
+        entity_data = pack_entity(entity)
         # 移除事务嵌套，使用自动提交模式
         await db.execute("""
             INSERT OR REPLACE INTO group_entities 
@@ -3759,11 +4006,9 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
     # 封装删除无效群组的公共函数
     async def _delete_invalid_group(group_id):
         try:
-            # 每个数据库操作使用独立连接
-            db = await DB.get_conn()
             # 移除事务嵌套，按顺序执行删除操作
             await db.execute("DELETE FROM group_config WHERE chat_id = ?", (group_id,))
-            await db.execute("DELETE FROM mentions WHERE group_id = ?", (group_id,))
+            await db.execute("DELETE FROM mention_users WHERE group_id = ?", (group_id,))
             await db.execute("DELETE FROM group_failure_log WHERE group_id = ?", (group_id,))
             await db.execute("DELETE FROM group_entities WHERE chat_id = ?", (group_id,))
             await db.commit()  # 新增：强制提交删除操作
@@ -3773,17 +4018,13 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
         except Exception as e:
             logger.error(f"删除群组配置失败 [群组ID:{group_id}]: {e}")
 
-    # 新增：记录失败次数并判断是否需要删除（优化：使用独立连接）
+    # 新增：记录失败次数并判断是否需要删除（复用外层连接）
     async def _record_failure_and_check(group_id):
         try:
-            # 每个数据库操作使用独立连接
-            db = await DB.get_conn()
             # 查询当前失败次数
-            async with db.execute(
-                "SELECT failure_count FROM group_failure_log WHERE group_id = ?", 
-                (group_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
+            row = await fetchone(
+                db, "SELECT failure_count FROM group_failure_log WHERE group_id = ?", (group_id,)
+            )
             
             if row:
                 failure_count = row[0] + 1
@@ -3830,28 +4071,24 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
                 logger.warning(f"群组 [{group_id}] 缓存实体无效，重新解析")
                 global_group_entities.pop(group_id, None)  # 删除无效缓存
                 # 同步删除数据库中的无效实体
-                db = await DB.get_conn()
                 await db.execute("DELETE FROM group_entities WHERE chat_id = ?", (group_id,))
                 await db.commit()  # 新增：强制提交删除
         
         # 缓存无有效实体时，从数据库加载
         if entity is None:
-            db = await DB.get_conn()
-            async with db.execute(
-                "SELECT entity_data FROM group_entities WHERE chat_id = ?", 
-                (group_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    try:
-                        entity = pickle.loads(row[0])
-                        global_group_entities[group_id] = entity
-                        logger.debug(f"从数据库加载群组 [{group_id}] 实体到内存")
-                    except Exception as e:
-                        logger.error(f"反序列化数据库实体失败 [群组ID:{group_id}]: {e}")
-                        # 删除数据库中的无效记录
-                        await db.execute("DELETE FROM group_entities WHERE chat_id = ?", (group_id,))
-                        await db.commit()  # 新增：强制提交删除
+            row = await fetchone(
+                db, "SELECT entity_data FROM group_entities WHERE chat_id = ?", (group_id,)
+            )
+            if row:
+                try:
+                    entity = unpack_entity(row[0])
+                    global_group_entities[group_id] = entity
+                    logger.debug(f"从数据库加载群组 [{group_id}] 实体到内存")
+                except Exception as e:
+                    logger.error(f"反序列化数据库实体失败 [群组ID:{group_id}]: {e}")
+                    # 删除数据库中的无效记录
+                    await db.execute("DELETE FROM group_entities WHERE chat_id = ?", (group_id,))
+                    await db.commit()  # 新增：强制提交删除
         
         # 数据库也无实体时，重新解析并持久化
         if entity is None:
@@ -3859,7 +4096,7 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
                 try:
                     entity = await client.get_entity(group_id)
                     global_group_entities[group_id] = entity
-                    await save_entity_to_db(group_id, entity)  # 持久化到数据库
+                    await save_entity_to_db(group_id, entity, db)  # 持久化到数据库
                     api_call_stats["entity_calls"] += 1
                     logger.debug(f"成功解析并持久化群组实体 [群组ID:{group_id}]")
                 except Exception as e:
@@ -3888,13 +4125,12 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
             
             # 发送成功，清除失败记录
             try:
-                db = await DB.get_conn()
                 await db.execute("DELETE FROM group_failure_log WHERE group_id = ?", (group_id,))
                 await db.commit()  # 新增：强制提交删除
             except Exception as e:
                 logger.error(f"清除群组 [{group_id}] 失败记录时出错: {e}")
                 
-            sent_messages[original_message_id][group_id] = sent_message.id
+            sent_messages.setdefault(original_message_id, {})[group_id] = sent_message.id
             await asyncio.sleep(0.05)
             return True
             
@@ -3920,7 +4156,7 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
                         new_entity = await client.get_entity(group_id)
                         # 更新内存缓存和数据库
                         global_group_entities[group_id] = new_entity
-                        await save_entity_to_db(group_id, new_entity)
+                        await save_entity_to_db(group_id, new_entity, db)
                         update_log_flag = True  # 更新成功，标记需要输出日志
                         
                         # 更新后重试发送一次，同样指定Markdown格式
@@ -3935,10 +4171,9 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
                                     parse_mode='markdown'
                                 )
                             # 发送成功处理
-                            db = await DB.get_conn()
                             await db.execute("DELETE FROM group_failure_log WHERE group_id = ?", (group_id,))
                             await db.commit()  # 新增：强制提交删除
-                            sent_messages[original_message_id][group_id] = sent_message.id
+                            sent_messages.setdefault(original_message_id, {})[group_id] = sent_message.id
                             await asyncio.sleep(0.05)
                             return True
                         except Exception as e2:
@@ -3991,10 +4226,11 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
     cleaned_text = text.replace("#", "")  # 去除所有的#符号
 
     # 如果文本中存在关键词，获取附文
-    for word in cleaned_text.split():  # 分割文本并逐个检查是否为关键词
-        appendix = await get_appendix_for_text(word)
-        if appendix:
-            keyword = word.strip('#').replace('*', '')  # 去掉关键词前后的 # 符号，并去掉 * 符号
+    for word in cleaned_text.split():  # 分割文本并逐个检查是否包含关键词（内存匹配，不访问数据库）
+        matched = match_appendix_keywords(word)
+        if matched:
+            keyword = matched[0]
+            appendix = APPENDIX_CACHE[keyword]
             break  # 找到第一个匹配的关键词就停止
 
     # 构建最终发送的文本（所有内容都自动加粗）
@@ -4003,21 +4239,25 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
     bolded_appendix = f"**{appendix}**" if appendix else ""  # 附文加粗
     
     if keyword:  # 有关键词时拼接附文和艾特
+        # 一次查询所有目标群组的通知用户（按添加顺序）
+        placeholders = ",".join("?" * len(target_groups))
+        mention_rows = await db.execute_fetchall(
+            f"SELECT group_id, username FROM mention_users WHERE group_id IN ({placeholders}) ORDER BY rowid",
+            list(target_groups)
+        )
+        mentions_map = defaultdict(list)
+        for gid, username in mention_rows:
+            mentions_map[gid].append(username)
+
+        # 各群相同的加粗正文与附文前缀只拼接一次
+        message_prefix = f"{bolded_text}\n\n{bolded_appendix}\n\n"
         for group_id in target_groups:
-            # 新表逻辑：查询usernames字段，按逗号拆分用户
-            async with db.execute("SELECT usernames FROM mentions WHERE group_id = ?", (group_id,)) as cursor:
-                row = await cursor.fetchone()
-                users = []
-                if row:
-                    # 拆分并过滤空值（避免@空用户）
-                    users = [u.strip() for u in row[0].split(',') if u.strip()]
-                # 生成艾特列表并统计总数
-                group_mentions = [f"@{u}" for u in users]
-                total_mentions += len(group_mentions)
-                
-                # 拼接最终消息，所有内容都已加粗
-                group_message = f"{bolded_text}\n\n{bolded_appendix}\n\n{' '.join(group_mentions)}"
-                final_messages.append((group_id, group_message))
+            # 生成艾特文本并统计总数
+            users = mentions_map.get(group_id, [])
+            total_mentions += len(users)
+            
+            # 拼接最终消息，所有内容都已加粗
+            final_messages.append((group_id, message_prefix + " ".join("@" + u for u in users)))
     else:
         # 没有关键词时，仅发送加粗的原始文本
         final_text = bolded_text
@@ -4026,15 +4266,30 @@ async def forward_to_groups(group_type, reply, sender_id, notify_event):
     success_count = 0
     original_message_id = reply.id
     
+    # 有界并发发送（信号量限制同时进行的群组数）
+    send_semaphore = asyncio.Semaphore(GROUP_SEND_CONCURRENCY)
+
+    async def _send_one(group_id, group_message):
+        async with send_semaphore:
+            return await send_to_group(group_id, group_message, original_message_id)
+    
     try:
-        if final_messages:
-            for group_id, group_message in final_messages:
-                if await send_to_group(group_id, group_message, original_message_id):
-                    success_count += 1
-        else:
-            for group_id in target_groups:
-                if await send_to_group(group_id, final_text, original_message_id):
-                    success_count += 1
+        if not final_messages:
+            final_messages = [(group_id, final_text) for group_id in target_groups]
+        results = await asyncio.gather(
+            *(_send_one(group_id, group_message) for group_id, group_message in final_messages),
+            return_exceptions=True
+        )
+        for (group_id, _), result in zip(final_messages, results):
+            if isinstance(result, Exception):
+                logger.error(f"[群发] 在群组 [{str(group_id):>14}] 发送任务异常：{result}")
+            elif result:
+                success_count += 1
+
+        # 本次群发记录标记为最近使用，并淘汰超出上限的旧记录
+        if original_message_id in sent_messages:
+            sent_messages.move_to_end(original_message_id)
+            await archive_old_sent_messages(db)
         
         logger.info(
             f"[完成]：发送 {success_count}/{len(target_groups)} 个群组 | "
@@ -4063,22 +4318,31 @@ async def delete_specific_message(event):
         replied_message = await event.get_reply_message()
         if replied_message:
             original_message_id = replied_message.id
-            if original_message_id not in sent_messages:
+            record = await get_sent_record(original_message_id)
+            if not record:
                 return await event.reply("❌ 未找到该消息的群发记录")
             
-            groups_to_delete = list(sent_messages[original_message_id].items())
-            total_groups = len(groups_to_delete)
+            total_groups = len(record)
             deleted_count = 0
             failed_count = 0
 
-            # 执行删除并统计结果
-            for group_id, message_id in groups_to_delete:
-                try:
-                    await client.delete_messages(group_id, message_id)  # client 需根据实际定义替换
-                    deleted_count += 1
-                except Exception as e:
-                    failed_count += 1
-                    logger.debug(f"[删除] 群组 {group_id} 消息删除失败，原因：{str(e)}")  #  debug 记录详细错误
+            # 有界并发执行删除并统计结果
+            delete_semaphore = asyncio.Semaphore(GROUP_SEND_CONCURRENCY)
+
+            async def _delete_one(group_id, message_id):
+                async with delete_semaphore:
+                    try:
+                        await client.delete_messages(group_id, message_id)
+                        return True
+                    except Exception as e:
+                        logger.debug(f"[删除] 群组 {group_id} 消息删除失败，原因：{str(e)}")  #  debug 记录详细错误
+                        return False
+
+            results = await asyncio.gather(
+                *(_delete_one(group_id, message_id) for group_id, message_id in record.items())
+            )
+            deleted_count = sum(results)
+            failed_count = total_groups - deleted_count
 
             # 构造统一格式的 INFO 日志
             logger.info(
@@ -4092,7 +4356,7 @@ async def delete_specific_message(event):
 
             # 清理已删除记录（删除成功才清理）
             if deleted_count > 0:
-                del sent_messages[original_message_id]
+                await drop_sent_record(original_message_id)
         else:
             await event.reply("❌ 无法获取被引用的消息")
     else:
@@ -4142,8 +4406,10 @@ generate_send_handler("发送码商", "码商")
 
 
 # ====================== 全局变量 ======================
-pinned_queue = deque()  
-last_failure_rate = 0.0  
+PIN_CONCURRENCY = 5        # 同时在途的置顶请求数
+PIN_MIN_INTERVAL = 5       # 相邻两次置顶请求的最短间隔（秒）
+PIN_PROGRESS_STEP = 20     # 每完成多少个群更新一次进度消息
+PIN_FLOOD_MAX_RETRIES = 3  # 单个群触发限速后的最大重试次数，超过即计为失败
 
 async def _preload_group_entities(group_data_list, progress_msg):
     """从数据库读取序列化的实体数据，无需调用API"""
@@ -4156,31 +4422,35 @@ async def _preload_group_entities(group_data_list, progress_msg):
     
     db = await DB.get_conn()
     
-    for group_id, _ in group_data_list:
+    # 一次查询取回所有群组的序列化实体数据
+    group_ids = [group_id for group_id, _ in group_data_list]
+    blob_map = {}
+    if group_ids:
+        placeholders = ",".join("?" * len(group_ids))
+        rows = await db.execute_fetchall(
+            f"SELECT chat_id, entity_data FROM group_entities WHERE chat_id IN ({placeholders})",
+            group_ids
+        )
+        blob_map = {chat_id: entity_data for chat_id, entity_data in rows}
+    
+    for group_id in group_ids:
+        blob = blob_map.get(group_id)
+        if not blob:
+            logger.warning(f"[置顶] 数据库中未找到群组 {group_id} 的实体数据")
+            entity_cache[group_id] = None
+            continue
         try:
-            # 从数据库查询序列化的实体数据
-            async with db.execute(
-                "SELECT entity_data FROM group_entities WHERE chat_id = ?",
-                (group_id,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                if not row or not row[0]:
-                    logger.warning(f"[置顶] 数据库中未找到群组 {group_id} 的实体数据")
-                    entity_cache[group_id] = None
-                    continue
-                    
-                # 反序列化实体数据
-                entity = pickle.loads(row[0])
-                entity_cache[group_id] = entity
-                loaded += 1
-                
-                # 更新进度
-                if loaded % 10 == 0 or loaded == total:
-                    await progress_msg.edit(f"📡 加载中...\n进度：{loaded}/{total}")
-                    
+            # 反序列化实体数据
+            entity_cache[group_id] = unpack_entity(blob)
+            loaded += 1
         except Exception as e:
             logger.warning(f"[置顶] 加载群组 {group_id} 实体失败：{e}")
             entity_cache[group_id] = None
+            continue
+        
+        # 更新进度
+        if loaded % 1000 == 0:
+            await progress_msg.edit(f"📡 加载中...\n进度：{loaded}/{total}")
     
     # 加载完成
     await progress_msg.edit(f"✅ 实体加载完成 | 成功: {loaded}/{total}\n即将开始置顶任务...")
@@ -4188,174 +4458,111 @@ async def _preload_group_entities(group_data_list, progress_msg):
 
 
 async def pin_message(event):
-    global pinned_queue, last_failure_rate  
-
     # 1. 基础校验（完全保留）
     if not event.is_reply:
         return await event.reply("❌ 请先引用需要置顶的消息")
     replied_msg = await event.get_reply_message()
     original_msg_id = replied_msg.id
-    if original_msg_id not in sent_messages:
+    record = await get_sent_record(original_msg_id)
+    if not record:
         return await event.reply(f"❌ 未找到该消息的群发记录（ID: {original_msg_id}）")
 
     # 2. 创建唯一进度消息（后续所有进度通过编辑这条消息更新）
     progress_msg = await event.reply("⏳ 置顶任务初始化中...")
 
-    # 3. 初始化冷却队列（完全保留）
-    all_group_data = list(sent_messages[original_msg_id].items())
-    total_groups = len(all_group_data)
-    pinned_queue.clear()
-    for group_id, msg_id in all_group_data:
-        pinned_queue.append( (group_id, msg_id, 0) )
+    all_group_data = record.items()  # 字典视图，不复制
+    total_groups = len(record)
 
-    # 4. 预解析群组实体（从数据库加载）
+    # 3. 预解析群组实体（从数据库加载）
     entity_cache = await _preload_group_entities(all_group_data, progress_msg)
     if not entity_cache:
         return await progress_msg.edit("❌ 群组实体加载失败，无法继续置顶")
 
-    # 5. 动态速率控制参数（优化：更保守的初始值）
-    rate_config = {
-        "base_time": 15,       # 单群操作间隔延长到15秒（原10秒）
-        "batch_size": 5,       # 每批处理5个群（原10个）
-        "silence_step": 90,    # 批次间隔延长到90秒（原60秒）
-    }
-
-    # 6. 发送任务启动通知（编辑进度消息）
+    # 4. 发送任务启动通知（编辑进度消息）
     await progress_msg.edit(
         f"✅ 置顶任务启动 | 共需处理 {total_groups} 个群\n"
-        "将优先处理「冷却时间短」的群组，实时更新进度"
+        "触发限速时全部暂停等待冷却，实时更新进度"
     )
 
-    # 7. 主处理循环（优化：动态调整速率 + 增强错误处理）
-    success_count = 0
-    failure_count = 0
-    batch_idx = 0
+    # 5. 每个群一个协程：信号量限制并发，限速器控制整体频率；
+    #    置顶限速按账号计算，任一群触发限速时记录统一的恢复时间，所有群都等到该时间后再继续
+    pin_semaphore = asyncio.Semaphore(PIN_CONCURRENCY)
+    pin_limiter = AsyncLimiter(max_rate=1, time_period=PIN_MIN_INTERVAL)
+    error_agg = defaultdict(int)
+    resume_at = 0.0  # 全局恢复时间（monotonic）
 
-    while pinned_queue:
-        batch_idx += 1
-        current_time = time.time()
-        current_batch = []
+    async def _wait_resume():
+        # 循环检查：等待期间其他群可能再次触发限速并推后恢复时间
+        while (delay := resume_at - monotonic()) > 0:
+            await asyncio.sleep(delay)
 
-        # 筛选本批可处理的群组（逻辑不变）
-        while pinned_queue and len(current_batch) < rate_config["batch_size"]:
-            group_id, msg_id, cooldown_end = pinned_queue.popleft()
-            if cooldown_end <= current_time:
-                current_batch.append( (group_id, msg_id) )
-            else:
-                pinned_queue.appendleft( (group_id, msg_id, cooldown_end) )
-                break
+    async def _pin_one(group_id, msg_id, entity):
+        nonlocal resume_at
+        if not entity:
+            error_agg["无效实体"] += 1
+            return False
+        for _ in range(PIN_FLOOD_MAX_RETRIES + 1):
+            await _wait_resume()
+            async with pin_semaphore:
+                try:
+                    await _wait_resume()
+                    async with pin_limiter:
+                        await client.pin_message(entity, msg_id, notify=False)
+                    logger.info(f"[置顶] 在群组 [{str(group_id):>14}] 成功置顶消息（ID: {msg_id}）")
+                    return True
+                except FloodWaitError as e:
+                    # 限速错误使用普通日志，不再使用ERROR级别
+                    wait_sec = e.seconds
+                    logger.info(f"[置顶] 在群组 [{str(group_id):>14}] 触发限速，全部暂停 {wait_sec} 秒（ID: {msg_id}）")
+                    error_agg[wait_sec] += 1
+                    resume_at = max(resume_at, monotonic() + wait_sec + 1)
+                except Exception as e:
+                    # 其他错误保持ERROR级别
+                    logger.error(f"[置顶] 在群组 [{str(group_id):>14}] 置顶失败（ID: {msg_id}）：{e}")
+                    return False
+        logger.warning(f"[置顶] 在群组 [{str(group_id):>14}] 限速重试 {PIN_FLOOD_MAX_RETRIES} 次仍失败，放弃（ID: {msg_id}）")
+        error_agg["限速重试超限"] += 1
+        return False
 
-        if not current_batch:
-            await asyncio.sleep(60)
-            continue
+    tasks = [
+        asyncio.create_task(_pin_one(group_id, msg_id, entity_cache.get(group_id)))
+        for group_id, msg_id in all_group_data
+    ]
 
-        # 动态调整速率（优化：结合失败率和最大等待时间）
-        if last_failure_rate > 0.5:
-            rate_config["base_time"] = min(rate_config["base_time"] * 1.5, 120)  # 最长120秒/群
-            rate_config["batch_size"] = max(rate_config["batch_size"] // 2, 2)    # 最小每批2个群
-            rate_config["silence_step"] = min(rate_config["silence_step"] * 1.5, 300)  # 最长300秒/批
+    # 6. 按完成顺序统计并定期编辑进度
+    success_count = 0
+    failure_count = 0
+    done_count = 0
+    for finished in asyncio.as_completed(tasks):
+        if await finished:
+            success_count += 1
         else:
-            rate_config["base_time"] = max(rate_config["base_time"] * 0.9, 5)     # 最短5秒/群
-            rate_config["silence_step"] = max(rate_config["silence_step"] * 0.9, 30)  # 最短30秒/批
-
-        # 本批处理（优化：准确获取FloodWait时间 + 记录最大等待）
-        batch_limiter = AsyncLimiter(max_rate=1, time_period=rate_config["base_time"])
-        batch_success = 0
-        batch_failure = 0
-        error_agg = defaultdict(int)
-        max_wait_in_batch = 0  # 记录本批遇到的最大等待时间
-
-        for group_id, msg_id in current_batch:
-            entity = entity_cache.get(group_id)
-            if not entity:
-                batch_failure += 1
-                error_agg["无效实体"] += 1
-                continue
-
-            try:
-                async with batch_limiter:
-                    await client.pin_message(entity, msg_id, notify=False)
-                    batch_success += 1
-                    success_count += 1
-                    logger.info(f"[置顶] 在群组 [{str(group_id):>14}] 成功置顶消息（ID: {msg_id}）")
-            except FloodWaitError as e:
-                # 限速错误使用普通日志，不再使用ERROR级别
-                wait_sec = e.seconds
-                logger.info(f"[置顶] 在群组 [{str(group_id):>14}] 触发限速，需等待 {wait_sec} 秒（ID: {msg_id}）")
-                
-                batch_failure += 1
-                failure_count += 1
-                max_wait_in_batch = max(max_wait_in_batch, wait_sec)  # 更新最大等待时间
-                new_cooldown = current_time + wait_sec
-                error_agg[wait_sec] += 1
-                _insert_sorted(pinned_queue, (group_id, msg_id, new_cooldown))
-            except Exception as e:
-                # 其他错误保持ERROR级别
-                batch_failure += 1
-                failure_count += 1
-                logger.error(f"[置顶] 在群组 [{str(group_id):>14}] 置顶失败（ID: {msg_id}）：{e}")
-
-        # 更新失败率（逻辑不变）
-        total_in_batch = batch_success + batch_failure
-        last_failure_rate = batch_failure / total_in_batch if total_in_batch != 0 else 0
-
-        # 根据最大等待时间再次调整速率（避免持续触发高等待限流）
-        if max_wait_in_batch > 300:  # 若存在需要等待>5分钟的群组
-            rate_config["base_time"] = min(rate_config["base_time"] * 2, 120)
-            rate_config["batch_size"] = max(rate_config["batch_size"] // 2, 2)
-            rate_config["silence_step"] = min(rate_config["silence_step"] * 2, 300)
-        elif max_wait_in_batch > 100:  # 等待1-5分钟
-            rate_config["base_time"] = min(rate_config["base_time"] * 1.5, 60)
-            rate_config["silence_step"] = min(rate_config["silence_step"] * 1.5, 180)
-
-        # 构建进度内容（编辑同一条消息）
-        progress_text = (
-            f"✅ 第 {batch_idx} 批处理完成\n"
-            f"本批成功: {batch_success} | 失败: {batch_failure}\n"
-            f"累计成功: {success_count}/{total_groups}"
-        )
-        if error_agg:
-            progress_text += "\n\n❌ 本批错误聚合:"
-            for err_type, count in error_agg.items():
-                if isinstance(err_type, int):
-                    progress_text += f"\n需等待 {err_type} 秒: {count} 个群"
-                else:
-                    progress_text += f"\n{err_type}: {count} 个群"
+            failure_count += 1
+        done_count += 1
 
-        # 编辑消息更新进度
-        await progress_msg.edit(progress_text)
-
-        # 批次间隔（逻辑不变）
-        if batch_idx < (total_groups // rate_config["batch_size"] + 1):
-            await asyncio.sleep(rate_config["silence_step"])
+        if done_count % PIN_PROGRESS_STEP == 0 and done_count < total_groups:
+            progress_text = (
+                f"⏳ 置顶进行中 | 已处理 {done_count}/{total_groups}\n"
+                f"累计成功: {success_count} | 失败: {failure_count}"
+            )
+            if error_agg:
+                progress_text += "\n\n❌ 错误聚合:"
+                for err_type, count in error_agg.items():
+                    if isinstance(err_type, int):
+                        progress_text += f"\n需等待 {err_type} 秒: {count} 次"
+                    else:
+                        progress_text += f"\n{err_type}: {count} 个群"
+            await progress_msg.edit(progress_text)
 
     # 最终结果（编辑同一条消息）
     await progress_msg.edit(
-        f"🏁 所有批次处理完成\n"
+        f"🏁 所有群组处理完成\n"
         f"总成功: {success_count}/{total_groups} | 总失败: {failure_count}"
     )
     # 新增总进度日志
     logger.info(f"[置顶] 全部任务完成 | 总成功: {success_count}/{total_groups} | 总失败: {failure_count}")
 
 
-# 优化队列插入逻辑（按冷却时间分组处理，短等待优先）
-def _insert_sorted(queue, item):
-    """优化：按冷却时间分段插入，短等待的群组优先处理"""
-    group_id, msg_id, new_cooldown = item
-    now = time.time()
-    # 区分“短等待（<300秒）”和“长等待（≥300秒）”
-    if new_cooldown - now < 300:
-        # 短等待：按原逻辑插入到队列前面（优先处理）
-        for i in range(len(queue)):
-            if queue[i][2] > new_cooldown:
-                queue.insert(i, item)
-                return
-        queue.append(item)
-    else:
-        # 长等待：直接放到队列末尾（避免阻塞短等待群组）
-        queue.append(item)
-
-
 # 指令监听（保持原逻辑不变，仅修改日志格式）
 @client.on(events.NewMessage(pattern="置顶", func=lambda e: e.is_private))
 async def handle_pin_command(event):
@@ -4365,6 +4572,13 @@ async def handle_pin_command(event):
     
     
 
+# 管理指令前缀（模块级常量，避免每条消息重复构造元组）
+_ADMIN_PREFIXES = (
+    "添加关键词", "删除关键词", "查看关键词", "更新关键词",
+    "发送代收", "发送代付", "发送码商", "置顶", "删除信息",
+    "邀请 ", "添加成员", "删除成员",
+)
+
 # —— 自动回复并@绑定用户 —— 
 @client.on(events.NewMessage(incoming=True))
 async def keyword_mention(event):
@@ -4377,8 +4591,8 @@ async def keyword_mention(event):
     chat_id = event.chat_id
     text = event.raw_text
 
-    # 过滤所有管理命令，避免触发自动回复
-    if text.startswith(("添加关键词", "删除关键词",  "查看关键词", "更新关键词")):
+    # 过滤所有管理命令，避免触发自动回复（在任何 await 之前短路）
+    if text.startswith(_ADMIN_PREFIXES):
         return
 
     # 如果正在删除关键词，不做自动回复
@@ -4394,53 +4608,43 @@ async def keyword_mention(event):
         logger.debug(f"跳过脚本启动之前的消息（消息时间：{message_time}, 启动时间：{start_time}）")
         return
 
+    # 先在内存中匹配关键词，未命中则直接返回，不访问数据库
+    matched_keywords = match_appendix_keywords(text)
+    if not matched_keywords:
+        return
+    content = APPENDIX_CACHE[matched_keywords[0]]
+
     # 机器人管理员校验（从数据库查询）
     sender_id = event.sender_id
     if not await is_admin(sender_id):
         logger.debug(f"[回复] 在群组 [{str(chat_id):>14}] 非管理员 {sender_id} 发送消息，不触发回复")
         return
 
-    # 检查群组类型是否有效，排除"码商"分组
+    # 一次查询同时取回群组类型与绑定用户（mention_users表：每个用户一行，按添加顺序）
     db = await DB.get_conn()
-    async with db.execute("SELECT group_type FROM group_config WHERE chat_id = ?", (chat_id,)) as cursor:
-        row = await cursor.fetchone()
-        if not row or row[0] == "码商":
-            return
-
-    # 获取附文（即关键词关联的内容）
-    content = await get_appendix_for_text(text)
-
-    # 获取数据库中存储的所有关键词
-    async with db.execute("SELECT keyword FROM appendices") as cursor:
-        keywords = [row[0] for row in await cursor.fetchall()]
-
-    # 检查文本中是否包含数据库中的关键词
-    matched_keywords = [keyword for keyword in keywords if keyword in text]
+    rows = await db.execute_fetchall(
+        "SELECT gc.group_type, m.username FROM group_config gc "
+        "LEFT JOIN mention_users m ON m.group_id = gc.chat_id WHERE gc.chat_id = ? ORDER BY m.rowid",
+        (chat_id,)
+    )
+    # 检查群组类型是否有效，排除"码商"分组
+    if not rows or rows[0][0] == "码商":
+        return
 
     if content:
-        # —— 适配新mentions表：读取逗号分隔的用户字符串并拆分 ——
-        async with db.execute("SELECT usernames FROM mentions WHERE group_id = ?", (chat_id,)) as cursor:
-            row = await cursor.fetchone()  # 新表：一个群组ID对应一行数据
-            users = []
-            if row:
-                # 按逗号拆分用户，过滤空值（避免@空用户）
-                username_str = row[0]
-                users = [
-                    f"@{u.strip()}" 
-                    for u in username_str.split(',') 
-                    if u.strip()  # 去除空格和空字符串
-                ]
+        # LEFT JOIN 无绑定用户时 username 为 NULL，过滤掉（避免@空用户）
+        users = [r[1] for r in rows if r[1]]
 
-            # 获取绑定用户数量
-            user_count = len(users)
-            if user_count > 0:
-                # 统一日志格式：绑定用户数量记录
-                logger.info(f"[回复] 在群组 [{str(chat_id):>14}] 成功获取到 {user_count} 位已绑定通知用户")
+        # 获取绑定用户数量
+        user_count = len(users)
+        if user_count > 0:
+            # 统一日志格式：绑定用户数量记录
+            logger.info(f"[回复] 在群组 [{str(chat_id):>14}] 成功获取到 {user_count} 位已绑定通知用户")
 
         # 拼接回复内容（使用**将内容加粗）
         if users:
             # 内容加粗，@用户保持原样
-            response_text = f"**{content}**\n{' '.join(users)}"
+            response_text = f"**{content}**\n" + " ".join("@" + u for u in users)
         else:
             # 只有内容时也加粗显示
             response_text = f"**{content}**"
@@ -4470,9 +4674,8 @@ async def add_keyword(event):
     db = await DB.get_conn()
 
     # 检查关键词是否已经存在
-    async with db.execute("SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)) as cursor:
-        if await cursor.fetchone():
-            return await event.reply(f"🔔 关键词 {keyword} 已存在啦～想更新内容可以用更新功能重新设置哟")
+    if await fetchone(db, "SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)):
+        return await event.reply(f"🔔 关键词 {keyword} 已存在啦～想更新内容可以用更新功能重新设置哟")
 
     # 插入或更新关键词及内容
     await db.execute(
@@ -4480,6 +4683,7 @@ async def add_keyword(event):
         (keyword, content)
     )
     await db.commit()
+    await reload_appendices()
 
     # 去除日志中的#符号
     clean_keyword = keyword.lstrip('#')
@@ -4497,17 +4701,16 @@ async def view_keywords(event):
         return await event.reply("❌ 你没有权限执行此操作")
 
     db = await DB.get_conn()
-    async with db.execute("SELECT keyword, content FROM appendices") as cursor:
-        rows = await cursor.fetchall()
-        if rows:
-            # 拼接所有关键词和内容，去除#符号
-            response_text = "\n".join([f"**{keyword.lstrip('#')}**: {content}" for keyword, content in rows])
-            # 统一日志格式
-            logger.info(f"[查看] 在群组 [{str(event.chat_id):>14}] 查询到关键词：{len(rows)} 条")
-        else:
-            response_text = "❌ 当前没有任何关键词记录"
-            # 统一日志格式
-            logger.info(f"[查看] 在群组 [{str(event.chat_id):>14}] 没有查询到任何关键词")
+    rows = await db.execute_fetchall("SELECT keyword, content FROM appendices")
+    if rows:
+        # 拼接所有关键词和内容，去除#符号
+        response_text = "\n".join([f"**{keyword.lstrip('#')}**: {content}" for keyword, content in rows])
+        # 统一日志格式
+        logger.info(f"[查看] 在群组 [{str(event.chat_id):>14}] 查询到关键词：{len(rows)} 条")
+    else:
+        response_text = "❌ 当前没有任何关键词记录"
+        # 统一日志格式
+        logger.info(f"[查看] 在群组 [{str(event.chat_id):>14}] 没有查询到任何关键词")
 
     await event.reply(response_text, parse_mode="markdown")
 
@@ -4526,9 +4729,8 @@ async def remove_keyword(event):
     db = await DB.get_conn()
 
     # 检查关键词是否存在
-    async with db.execute("SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)) as cursor:
-        if not await cursor.fetchone():
-            return await event.reply(f"❌ 关键词 `{keyword}` 不存在。")
+    if not await fetchone(db, "SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)):
+        return await event.reply(f"❌ 关键词 `{keyword}` 不存在。")
 
     # 设置标志，防止进行自动回复
     is_deleting_keyword = True
@@ -4536,6 +4738,7 @@ async def remove_keyword(event):
     # 删除关键词
     await db.execute("DELETE FROM appendices WHERE keyword = ?", (keyword,))
     await db.commit()
+    await reload_appendices()
 
     # 去除日志中的#符号
     clean_keyword = keyword.lstrip('#')
@@ -4563,9 +4766,8 @@ async def update_keyword(event):
     db = await DB.get_conn()
 
     # 检查关键词是否存在
-    async with db.execute("SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)) as cursor:
-        if not await cursor.fetchone():
-            return await event.reply(f"❌ 关键词 `{keyword}` 不存在，无法更新。")
+    if not await fetchone(db, "SELECT 1 FROM appendices WHERE keyword = ?", (keyword,)):
+        return await event.reply(f"❌ 关键词 `{keyword}` 不存在，无法更新。")
 
     # 更新关键词内容
     await db.execute(
@@ -4573,6 +4775,7 @@ async def update_keyword(event):
         (new_content, keyword)
     )
     await db.commit()
+    await reload_appendices()
 
     # 去除日志中的#符号
     clean_keyword = keyword.lstrip('#')
@@ -4613,7 +4816,135 @@ async def delete_forbidden_message(event):
 
 # ============================== 统一导入模块（仅保留确认可用的类）==============================
 
-@client.on(NewMessage(pattern=r'^邀请\s+@([\w\d_]+)$', incoming=True))
+# 成员管理指令正则（模块加载时编译一次，固定文本指令直接比较字符串）
+INVITE_USER_RE = re.compile(r'^邀请\s+@([\w\d_]+)$')
+ADD_MEMBER_RE = re.compile(r"^添加成员\s+(.+)$")
+REMOVE_MEMBER_RE = re.compile(r"^删除成员\s+@?(\w+)$")
+KICK_MEMBER_RE = re.compile(r"^踢成员\s+@?(\w+)$")
+
+
+class CircuitBreaker:
+    """Telegram 限流熔断器：窗口内连续限流达到阈值后打开，冷却期内直接拒绝指令；
+    冷却结束后放行一个探测请求（半开），探测成功则关闭，再次限流则重新打开"""
+
+    def __init__(self, threshold=5, window=300, cooldown=60):
+        self.threshold = threshold    # 连续限流次数阈值
+        self.window = window          # 统计窗口（秒）
+        self.cooldown = cooldown      # 最短冷却时间（秒）
+        self.state = "closed"
+        self.failures = 0
+        self._first_failure_at = 0.0
+        self._blocked_until = 0.0
+        self.flood_seq = 0            # 累计记录的限流次数，用于判断某次指令执行期间是否限流
+
+    def blocked(self):
+        """冷却期内返回 True；只做判断，不占用探测名额"""
+        return self.state != "closed" and monotonic() < self._blocked_until
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        now = monotonic()
+        if now < self._blocked_until:
+            return False
+        # 冷却结束：放行一个探测请求，探测结果返回前其余请求继续拒绝
+        self.state = "half_open"
+        self._blocked_until = now + self.cooldown
+        return True
+
+    def remaining(self):
+        return max(0, int(self._blocked_until - monotonic()))
+
+    def record_flood(self, seconds=0):
+        self.flood_seq += 1
+        now = monotonic()
+        if now - self._first_failure_at > self.window:
+            self.failures = 0
+            self._first_failure_at = now
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.state = "open"
+            self._blocked_until = now + max(self.cooldown, seconds)
+            logger.warning(f"[熔断] 连续限流 {self.failures} 次，暂停群组管理指令 {self.remaining()} 秒")
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("[熔断] 探测请求成功，恢复群组管理指令")
+        self.state = "closed"
+        self.failures = 0
+
+    def release_probe(self):
+        """探测指令未得出结论（如参数错误、其他异常）时归还探测名额，下一条指令可立即探测"""
+        if self.state == "half_open":
+            self.state = "open"
+            self._blocked_until = monotonic()
+
+telegram_breaker = CircuitBreaker()
+
+def with_breaker(handler):
+    """指令处理器熔断装饰器：熔断期间直接回复提示，不再发起新的 Telegram 请求"""
+    async def reject(event):
+        logger.info(f"[熔断] 拒绝用户 [{event.sender_id:>14}] 的指令：{handler.__name__}")
+        if event.sender_id in ADMIN_IDS:
+            return await event.reply(f"⚠️ 服务暂时限流，请 {telegram_breaker.remaining()} 秒后再试")
+
+    @functools.wraps(handler)
+    async def wrapper(event):
+        if telegram_breaker.blocked():
+            return await reject(event)
+        # 被包装的指令均仅限管理员：非管理员的消息交给处理器自行拒绝，不占用半开探测名额
+        if event.sender_id not in ADMIN_IDS:
+            return await handler(event)
+        if not telegram_breaker.allow():
+            return await reject(event)
+        seq = telegram_breaker.flood_seq
+        try:
+            result = await handler(event)
+        except FloodWaitError as e:
+            if telegram_breaker.flood_seq == seq:  # rpc_with_flood_retry 已记录的不重复计数
+                telegram_breaker.record_flood(e.seconds)
+            raise
+        except BaseException:
+            if telegram_breaker.flood_seq == seq:
+                telegram_breaker.release_probe()
+            raise
+        # 执行期间未发生限流（处理器内部捕获的限流也会被记录）即视为成功，关闭半开状态
+        if telegram_breaker.flood_seq == seq:
+            telegram_breaker.record_success()
+        return result
+    return wrapper
+
+# 群组 InputPeer 缓存：{chat_id: InputPeerChannel/InputPeerChat}，群组 access_hash 稳定不变
+_chat_peer_cache = {}
+
+async def get_chat_peer(chat_id):
+    """取群组的 InputPeer（超级群组/频道为 InputPeerChannel），首次解析后按 chat_id 缓存"""
+    peer = _chat_peer_cache.get(chat_id)
+    if peer is None:
+        peer = utils.get_input_peer(await client.get_entity(chat_id))
+        _chat_peer_cache[chat_id] = peer
+    return peer
+
+def invalidate_chat_peer(chat_id):
+    """群组失效/无权访问时清除缓存，下次重新解析"""
+    _chat_peer_cache.pop(chat_id, None)
+
+
+async def _is_chat_member(chat_entity, user_entity, target_user_id) -> bool:
+    """单次RPC判断用户是否在群内：超级群组用 GetParticipantRequest，基础群组用 GetFullChatRequest"""
+    if isinstance(chat_entity, (Channel, InputPeerChannel)):
+        try:
+            await client(GetParticipantRequest(channel=chat_entity, participant=user_entity))
+            return True
+        except UserNotParticipantError:
+            return False
+    full = await client(GetFullChatRequest(chat_id=getattr(chat_entity, 'chat_id', None) or chat_entity.id))
+    participants = getattr(full.full_chat.participants, 'participants', None) or []
+    return any(p.user_id == target_user_id for p in participants)
+
+
+@client.on(NewMessage(pattern=INVITE_USER_RE, incoming=True))
+@with_breaker
 async def invite_single_user(event: NewMessage.Event):
     # 权限校验
     if not await is_admin(event.sender_id):
@@ -4657,13 +4988,12 @@ async def invite_single_user(event: NewMessage.Event):
         else:
             raise ValueError("无法获取目标用户ID")
 
-        # 遍历所有成员进行ID精确匹配
-        async for member in client.iter_participants(chat_entity):
-            if member.id == target_user_id:
-                reply_msg = f"❌ 邀请失败：用户 @{username} 已经在该群组中"
-                await event.reply(reply_msg)
-                logger.info(f"[邀请] 在群组 [{chat_id:>14}] 邀请 @{username} 失败原因：用户已在群组中（ID匹配）")
-                return
+        # 单次查询目标用户的成员身份（不再遍历全部成员）
+        if await _is_chat_member(chat_entity, user_entity, target_user_id):
+            reply_msg = f"❌ 邀请失败：用户 @{username} 已经在该群组中"
+            await event.reply(reply_msg)
+            logger.info(f"[邀请] 在群组 [{chat_id:>14}] 邀请 @{username} 失败原因：用户已在群组中（ID匹配）")
+            return
 
     except RPCError as e:
         logger.warning(f"[邀请] 在群组 [{chat_id:>14}] 查询成员失败（{str(e)}），继续执行邀请逻辑")
@@ -4696,11 +5026,7 @@ async def invite_single_user(event: NewMessage.Event):
 
         # 5. 验证邀请结果（使用ID再次确认）
         await asyncio.sleep(3)
-        user_joined = False
-        async for member in client.iter_participants(chat_entity, limit=200):
-            if member.id == target_user_id:
-                user_joined = True
-                break
+        user_joined = await _is_chat_member(chat_entity, user_entity, target_user_id)
 
         if not user_joined:
             raise RPCError(400, "INVITE_FAILED", "邀请发送成功，但用户未加入（可能隐私限制）")
@@ -4712,6 +5038,7 @@ async def invite_single_user(event: NewMessage.Event):
 
     # 7. 错误处理（仅修复时间计算部分）
     except FloodWaitError as e:
+        telegram_breaker.record_flood(e.seconds)  # 此处捕获后不会再抛给熔断装饰器，需自行记录
         wait_time = e.seconds
         hours = wait_time // 3600
         minutes = (wait_time % 3600) // 60
@@ -4764,10 +5091,10 @@ async def invite_single_user(event: NewMessage.Event):
     
 
 
-@client.on(NewMessage(pattern=r"^添加成员\s+(.+)$", incoming=True))
+@client.on(NewMessage(pattern=ADD_MEMBER_RE, incoming=True))
 async def add_member(event):
     # 只有管理员可以使用
-    if not await is_admin(event.sender_id):
+    if event.sender_id not in ADMIN_IDS:
         logger.info(f"[添加] 权限拒绝：用户 [{event.sender_id:>14}] 尝试添加成员，但无管理员权限")
         return
 
@@ -4781,35 +5108,48 @@ async def add_member(event):
     existed = []    # 已存在的用户名
     invalid = []    # 无效/不存在的用户名
 
-    for m in mentions:
-        # 必须以@开头
-        if not m.startswith("@"):
-            invalid.append(m)
-            continue
+    # 必须以@开头
+    candidates = [m for m in mentions if m.startswith("@")]
+    invalid.extend(m for m in mentions if not m.startswith("@"))
 
-        # 解析用户实体（用通用Exception捕获所有解析失败）
-        try:
-            user = await client.get_entity(m)  # 获取完整用户实体（含username）
-        except Exception:
+    # 并发解析用户实体（解析失败的异常作为结果返回）
+    entities = await asyncio.gather(
+        *(user_entity_cache.get(m) for m in candidates), return_exceptions=True
+    )
+    resolved = []
+    for m, user in zip(candidates, entities):
+        if isinstance(user, Exception):
             invalid.append(m)
-            continue
-
-        # 检查是否已在staff表
-        async with db.execute("SELECT 1 FROM staff WHERE user_id = ?", (user.id,)) as cursor:
-            row = await cursor.fetchone()
+        else:
+            resolved.append((m, user))
+
+    # 一次查询取回已在staff表中的用户
+    existing_ids = set()
+    if resolved:
+        placeholders = ",".join("?" * len(resolved))
+        rows = await db.execute_fetchall(
+            f"SELECT user_id FROM staff WHERE user_id IN ({placeholders})",
+            [user.id for _, user in resolved]
+        )
+        existing_ids = {row[0] for row in rows}
 
-        if row:
+    new_rows = []
+    for m, user in resolved:
+        if user.id in existing_ids:
             existed.append(m)
         else:
+            existing_ids.add(user.id)  # 同一用户重复@时只添加一次
             # 插入完整数据（必须包含 username！）
-            await db.execute(
-                "INSERT INTO staff (user_id, access_hash, username) VALUES (?, ?, ?)",
-                (user.id, user.access_hash, user.username)  # 这里必须显式存入 username
-            )
+            new_rows.append((user.id, user.access_hash, user.username))
             added.append(m)
 
-    # 提交事务
-    await db.commit()
+    # 批量写入并提交事务
+    if new_rows:
+        await db.executemany(
+            "INSERT OR IGNORE INTO staff (user_id, access_hash, username) VALUES (?, ?, ?)",
+            new_rows
+        )
+        await db.commit()
 
     # 构建回复
     parts = []
@@ -4831,10 +5171,10 @@ async def add_member(event):
 
 
 # ============================== 2. 删除成员（一次@一位）==============================
-@client.on(NewMessage(pattern=r"^删除成员\s+@?(\w+)$", incoming=True))
+@client.on(NewMessage(pattern=REMOVE_MEMBER_RE, incoming=True))
 async def remove_member(event):
     # 只有管理员可以使用
-    if not await is_admin(event.sender_id):
+    if event.sender_id not in ADMIN_IDS:
         logger.info(f"[删除] 权限拒绝：用户 [{event.sender_id:>14}] 尝试删除成员，但无管理员权限")
         return
 
@@ -4844,161 +5184,343 @@ async def remove_member(event):
 
     # 解析用户实体（用通用Exception捕获）
     try:
-        user = await client.get_entity(username if username.startswith("@") else "@" + username)
+        user = await user_entity_cache.get(username if username.startswith("@") else "@" + username)
     except Exception:
         logger.info(f"[删除] 管理员 [{event.sender_id:>14}] 删除成员 @{username}：无法找到用户，删除失败")
         return await event.reply(f"❌ 无法找到用户 @{username}")
 
     db = await DB.get_conn()
-    # 检查是否在staff表
-    async with db.execute("SELECT 1 FROM staff WHERE user_id = ?", (user.id,)) as cursor:
-        row = await cursor.fetchone()
-    if not row:
+    # 直接按主键删除，受影响行数为0即表示不在staff表
+    async with db.execute("DELETE FROM staff WHERE user_id = ?", (user.id,)) as cursor:
+        deleted = cursor.rowcount
+    if not deleted:
         logger.info(f"[删除] 管理员 [{event.sender_id:>14}] 删除成员 @{username}（ID: {user.id}）：不在列表，删除失败")
         return await event.reply(f"⚠ 用户 @{username} 不在成员列表中")
-
-    # 执行删除
-    await db.execute("DELETE FROM staff WHERE user_id = ?", (user.id,))
     await db.commit()
 
     await event.reply(f"✅ 已删除成员 @{username}")
     logger.info(f"[删除] 管理员 [{event.sender_id:>14}] 删除成员（ID: {user.id} | @{username}）：删除成功")
 
 
+class TokenBucket:
+    """异步令牌桶：rate 为每秒补充的令牌数，burst 为桶容量；触发限流速率减半，成功后逐步恢复（AIMD）"""
+
+    def __init__(self, rate=0.5, burst=3, min_rate=0.05):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self._tokens = float(burst)
+        self._last = monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                # 令牌不足时只等待补足一个令牌所需的时间
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def on_flood(self):
+        """触发限流：速率减半并清空令牌"""
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0.0
+
+    def on_success(self):
+        """请求成功：速率线性恢复，不超过初始速率"""
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+# 邀请进群共用同一账号的限流额度，全局共享一个令牌桶（约0.5次/秒，可突发3次）
+invite_bucket = TokenBucket(rate=0.5, burst=3)
+INVITE_BATCH_SIZE = 20  # 单次 InviteToChannelRequest 邀请的人数
+
+
+class EntityCache:
+    """进程内用户实体缓存：按用户ID或 @用户名 缓存 get_entity 结果，TTL 过期后重新解析"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._d = {}  # {键: (实体, 写入时间)}
+
+    @staticmethod
+    def _key(key):
+        # 用户名统一为小写并去掉@，与用户ID区分开
+        return key.lstrip('@').lower() if isinstance(key, str) else key
+
+    def put(self, entity):
+        """写入已解析的实体（同时按ID和用户名索引）"""
+        now = monotonic()
+        self._d[entity.id] = (entity, now)
+        if getattr(entity, 'username', None):
+            self._d[self._key(entity.username)] = (entity, now)
+
+    def invalidate(self, key):
+        self._d.pop(self._key(key), None)
+
+    async def get(self, key):
+        k = self._key(key)
+        cached = self._d.get(k)
+        if cached and monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        try:
+            entity = await client.get_entity(key)
+        except RPCError as e:
+            # access_hash 失效或用户不存在时清除旧缓存
+            if getattr(e, 'code', None) == 400 and "NOT_FOUND" in str(e).upper():
+                self._d.pop(k, None)
+            raise
+        self.put(entity)
+        return entity
+
+user_entity_cache = EntityCache()
+
+
+# 批量解析用户：GetUsersRequest 单次最多200个
+USERS_BATCH_SIZE = 200
+USERNAME_RESOLVE_CONCURRENCY = 10  # username兜底解析的最大并发数
+
+async def _fetch_users_by_hash(pairs):
+    """按 (user_id, access_hash) 批量解析用户，返回 {user_id: User}；解析不到的用户不在结果中"""
+    users = {}
+    inputs = [InputUser(user_id=uid, access_hash=ah) for uid, ah in pairs]
+    for i in range(0, len(inputs), USERS_BATCH_SIZE):
+        try:
+            result = await client(GetUsersRequest(inputs[i:i + USERS_BATCH_SIZE]))
+        except RPCError as e:
+            logger.warning(f"[成员] 批量解析用户失败（第 {i // USERS_BATCH_SIZE + 1} 批）：{e}")
+            continue
+        for user in result:
+            if isinstance(user, User):
+                users[user.id] = user
+                user_entity_cache.put(user)
+    return users
+
+
 # ============================== 3. 查看成员（username兜底解析）==============================
-@client.on(NewMessage(pattern="查看成员", incoming=True))
+@client.on(NewMessage(func=lambda e: e.raw_text == "查看成员", incoming=True))
 async def view_members(event):
     # 只有管理员可以使用
-    if not await is_admin(event.sender_id):
+    if event.sender_id not in ADMIN_IDS:
         logger.info(f"[查看] 权限拒绝：用户 [{event.sender_id:>14}] 尝试查看成员，但无管理员权限")
         return await event.reply("❌ 你没有权限执行此操作")
 
     chat_id = event.chat_id
-    db = await DB.get_conn()
-    # 查询完整数据（user_id + access_hash + username）
-    async with db.execute("SELECT user_id, access_hash, username FROM staff") as cursor:
-        rows = await cursor.fetchall()
+    # 只读查询走连接池，不占用共享写连接
+    async with db_pool.acquire() as reader:
+        rows = await reader.execute_fetchall("SELECT user_id, access_hash, username FROM staff")
     total_members = len(rows)
 
     if not rows:
         logger.info(f"[查看] 在群组 [{chat_id:>14}] 查看成员列表（共 0 人）：查看成功（无成员）")
         return await event.reply("❌ 当前没有成员")
 
-    # 解析成员信息（优先access_hash，失败用username兜底）
-    members = []
-    for row in rows:
-        user_id, access_hash, username = row
-        try:
-            # 方案1：用access_hash构造实体（高效无缓存依赖）
-            user_entity = InputPeerUser(user_id=user_id, access_hash=access_hash)
-            user = await client.get_entity(user_entity)
-            display_name = f"@{user.username}" if user.username else f"ID {user_id}（{user.first_name}）"
-            members.append(f"✅ {display_name}")
-        except RPCError as e:
-            # 用错误代码+消息判断“找不到用户”（替代 PeerNotFoundError）
-            if hasattr(e, 'code') and e.code == 400 and "NOT_FOUND" in str(e).upper():
-                # 方案2：access_hash失效，用username重试
-                if username:
-                    try:
-                        user = await client.get_entity(f"@{username}")
-                        members.append(f"✅ @{username}（ID {user_id}，{user.first_name}）")
-                    except Exception:
-                        members.append(f"⚠ ID {user_id}（用户名 @{username} 无效，可能已改名）")
-                else:
-                    members.append(f"⚠ ID {user_id}（无用户名，需让用户给机器人发消息）")
-            else:
-                # 其他RPC错误
-                members.append(f"⚠ ID {user_id}（解析失败：{str(e)[:10]}...）")
-        except Exception as e:
-            # 非RPC错误（如参数错误）
-            members.append(f"⚠ ID {user_id}（解析失败：{str(e)[:10]}...）")
+    # 方案1：用access_hash批量解析（每200人一次RPC）
+    user_map = await _fetch_users_by_hash([(r[0], r[1]) for r in rows if r[0] and r[1]])
 
-    # 构建回复
-    text = f"📋 当前成员列表（共 {total_members} 人）：\n" + "\n".join(members)
-    await event.reply(text)
+    # 方案2：批量解析失败的成员，并发用username兜底
+    resolve_semaphore = asyncio.Semaphore(USERNAME_RESOLVE_CONCURRENCY)
+
+    refresh_rows = []  # username兜底解析成功、需要回写新access_hash的成员
+
+    async def _resolve_by_username(user_id, username):
+        if not username:
+            return f"⚠ ID {user_id}（无用户名，需让用户给机器人发消息）"
+        async with resolve_semaphore:
+            try:
+                user = await user_entity_cache.get(f"@{username}")
+            except Exception:
+                return f"⚠ ID {user_id}（用户名 @{username} 无效，可能已改名）"
+        # 仅当用户名仍指向同一用户时才回写，避免用户名被他人占用后写错数据
+        if user.id == user_id and user.access_hash:
+            refresh_rows.append((user.access_hash, user.username, user_id))
+        return f"✅ @{username}（ID {user_id}，{user.first_name}）"
+
+    fallback_rows = [r for r in rows if r[0] not in user_map]
+    fallback_lines = await asyncio.gather(
+        *(_resolve_by_username(user_id, username) for user_id, _, username in fallback_rows)
+    )
+    fallback_map = {r[0]: line for r, line in zip(fallback_rows, fallback_lines)}
+
+    # access_hash 已失效的成员：一次事务回写最新值，下次直接走批量解析，不再重复兜底
+    if refresh_rows:
+        db = await DB.get_conn()
+        await db.executemany(
+            "UPDATE staff SET access_hash = ?, username = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+            refresh_rows
+        )
+        await db.commit()
+        logger.info(f"[查看] 在群组 [{chat_id:>14}]：回写 {len(refresh_rows)} 名成员的最新 access_hash")
+
+    # 按数据库顺序组装成员信息：标题与各行放入同一列表，最后一次 join 生成回复
+    buf = [f"📋 当前成员列表（共 {total_members} 人）："]
+    append = buf.append
+    for user_id, _, _ in rows:
+        user = user_map.get(user_id)
+        if user:
+            append("✅ @" + user.username if user.username else f"✅ ID {user_id}（{user.first_name}）")
+        else:
+            append(fallback_map[user_id])
+
+    await event.reply("\n".join(buf))
 
     # 记录日志
     logger.info(f"[查看] 在群组 [{chat_id:>14}] 查看成员列表（共 {total_members} 人）：查看成功")
 
 
 # ============================== 4. 邀请成员进群（批量邀请staff成员）==============================
-@client.on(NewMessage(pattern=r"^邀请成员$", incoming=True))
+# staff 表一行：slots 属性访问，避免每行构造字典
+@dataclass(slots=True)
+class StaffMember:
+    user_id: int
+    access_hash: int
+    username: Optional[str]
+
+
+@client.on(NewMessage(func=lambda e: e.raw_text == "邀请成员", incoming=True))
+@with_breaker
 async def invite_member(event):
     # 仅管理员在群组内可用
-    if not event.is_group or not await is_admin(event.sender_id):
+    if not event.is_group or event.sender_id not in ADMIN_IDS:
         logger.info(f"[邀请] 权限拒绝：用户 [{event.sender_id:>14}] 尝试批量邀请，但无权限或非群组环境")
         return
 
     chat_id = event.chat_id
-    db = await DB.get_conn()
-    # 查询staff表完整数据
-    async with db.execute("SELECT user_id, access_hash, username FROM staff") as cursor:
-        rows = await cursor.fetchall()
-    # 过滤无效数据，转为字典列表
-    staff_list = [
-        {"user_id": r[0], "access_hash": r[1], "username": r[2]} 
-        for r in rows if r[0] and r[1]
-    ]
+    db = await DB.get_conn()  # 写连接：回写staff表
+    # 查询staff表完整数据（只读查询走连接池）
+    async with db_pool.acquire() as reader:
+        rows = await reader.execute_fetchall("SELECT user_id, access_hash, username FROM staff")
+    # 过滤无效数据，直接由查询元组构造成员对象
+    staff_list = [StaffMember(*r) for r in rows if r[0] and r[1]]
 
     # 无有效成员提示
     if not staff_list:
         logger.info(f"[邀请] 在群组 [{chat_id:>14}]：管理员 [{event.sender_id:>14}] 批量邀请：暂无成员可邀请")
         return await event.reply("ℹ️ 暂无成员可邀请，请先使用“添加成员 @用户名”")
 
-    # 验证成员有效性（支持username重试）
+    # 验证成员有效性：优先用access_hash批量验证，失败的再并发用username重试
+    verify_semaphore = asyncio.Semaphore(USERNAME_RESOLVE_CONCURRENCY)
+
+    async def _verify_by_username(member):
+        if not member.username:
+            return None
+        async with verify_semaphore:
+            try:
+                return await user_entity_cache.get(f"@{member.username}")
+            except Exception:
+                return None
+
+    async def _validate_all():
+        resolved = await _fetch_users_by_hash([(m.user_id, m.access_hash) for m in staff_list])
+        unresolved = [m for m in staff_list if m.user_id not in resolved]
+        retry_results = await asyncio.gather(*(_verify_by_username(m) for m in unresolved))
+        for member, user in zip(unresolved, retry_results):
+            if user:
+                resolved[member.user_id] = user  # 兜底解析到的实体也用于后续显示名称
+        return resolved
+
+    async def _load_chat():
+        """解析群组 peer；基础群组顺带一次 GetFullChatRequest 拿到全部成员（不依赖成员验证结果）"""
+        peer = await get_chat_peer(chat_id)
+        if isinstance(peer, InputPeerChannel):
+            return peer, None
+        try:
+            full = await client(GetFullChatRequest(chat_id=peer.chat_id))
+        except Exception as e:
+            if isinstance(e, (ChannelPrivateError, ChatIdInvalidError, PeerIdInvalidError)):
+                invalidate_chat_peer(chat_id)
+            logger.warning(f"[邀请] 在群组 [{chat_id:>14}]：获取群成员失败，默认按“无已知成员”处理")
+            return peer, set()
+        participants = getattr(full.full_chat.participants, 'participants', None) or []
+        return peer, {p.user_id for p in participants}
+
+    # 成员验证与群组解析互不依赖，并发执行
+    async with asyncio.TaskGroup() as tg:
+        t_valid = tg.create_task(_validate_all())
+        t_chat = tg.create_task(_load_chat())
+    user_map = t_valid.result()
+    chat_peer, current_member_ids = t_chat.result()
+
     invalid_ids = []
     valid_members = []
+    refresh_rows = []  # access_hash/用户名已变化、需要回写staff表的成员
     for member in staff_list:
-        try:
-            # 优先用access_hash验证
-            await client.get_entity(InputPeerUser(
-                user_id=member["user_id"],
-                access_hash=member["access_hash"]
-            ))
+        user = user_map.get(member.user_id)
+        if user:
+            if (user.id == member.user_id and user.access_hash
+                    and (user.access_hash, user.username) != (member.access_hash, member.username)):
+                member.access_hash, member.username = user.access_hash, user.username
+                refresh_rows.append((user.access_hash, user.username, member.user_id))
             valid_members.append(member)
-        except RPCError as e:
-            # 用错误特征判断“找不到用户”（替代 PeerNotFoundError）
-            if hasattr(e, 'code') and e.code == 400 and "NOT_FOUND" in str(e).upper():
-                if member["username"]:
-                    try:
-                        await client.get_entity(f"@{member['username']}")
-                        valid_members.append(member)
-                    except Exception:
-                        invalid_ids.append(member["user_id"])
-                else:
-                    invalid_ids.append(member["user_id"])
-            else:
-                invalid_ids.append(member["user_id"])
-        except Exception:
-            invalid_ids.append(member["user_id"])
+        else:
+            invalid_ids.append(member.user_id)
+
+    # 一个事务批量回写最新的access_hash和用户名
+    if refresh_rows:
+        await db.executemany(
+            "UPDATE staff SET access_hash = ?, username = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+            refresh_rows
+        )
+        await db.commit()
     # 记录无效成员日志
     for uid in invalid_ids:
-        logger.info(f"[邀请] 在群组 [{chat_id:>14}]：批量邀请验证：用户（ID: {uid}）无法找到，标记无效")
+        logger.info("[邀请] 在群组 [%14d]：批量邀请验证：用户（ID: %s）无法找到，标记无效", chat_id, uid)
 
-    # 获取当前群成员ID
-    try:
-        participants = await client.get_participants(chat_id)
-        current_member_ids = {user.id for user in participants}
-    except Exception:
+    # 获取当前群成员ID：超级群组只探测待邀请的成员，不下载整个群成员列表（基础群组已在上面取得）
+    if current_member_ids is None:
         current_member_ids = set()
-        logger.warning(f"[邀请] 在群组 [{chat_id:>14}]：获取群成员失败，默认按“无已知成员”处理")
+        probe_semaphore = asyncio.Semaphore(USERNAME_RESOLVE_CONCURRENCY)
+
+        async def _probe(member):
+            async with probe_semaphore:
+                return await _is_chat_member(chat_peer, user_map[member.user_id], member.user_id)
+
+        try:
+            flags = await asyncio.gather(*(_probe(m) for m in valid_members))
+            current_member_ids = {m.user_id for m, is_member in zip(valid_members, flags) if is_member}
+        except (ChannelPrivateError, ChatIdInvalidError, PeerIdInvalidError):
+            invalidate_chat_peer(chat_id)
+            logger.warning(f"[邀请] 在群组 [{chat_id:>14}]：获取群成员失败，默认按“无已知成员”处理")
+        except Exception:
+            logger.warning(f"[邀请] 在群组 [{chat_id:>14}]：获取群成员失败，默认按“无已知成员”处理")
+
+    def _render_names(uids):
+        """从已解析的实体中取显示名称并拼接，回复阶段不再发起任何 RPC"""
+        names = []
+        for uid in uids:
+            u = user_map.get(uid)
+            names.append(f"@{u.username}" if u and u.username else str(uid))
+        return ', '.join(names)
 
     # 分类：已在群内/待邀请
-    already_in = [m for m in valid_members if m["user_id"] in current_member_ids]
-    to_invite = [m for m in valid_members if m["user_id"] not in current_member_ids]
+    already_in, to_invite = [], []
+    for m in valid_members:  # 单次遍历完成分类
+        (already_in if m.user_id in current_member_ids else to_invite).append(m)
 
     # 无待邀请成员提示
     if not to_invite:
         if already_in:
             names = []
             for member in already_in:
-                try:
-                    u = await client.get_entity(member["user_id"])
-                    names.append(f"@{u.username}" if u.username else f"[{u.first_name}](tg://user?id={member['user_id']})")
-                    logger.info(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']} | @{u.username}）已在群内，跳过")
-                except:
-                    names.append(str(member["user_id"]))
-                    logger.info(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）已在群内，跳过")
+                u = user_map.get(member.user_id)
+                if u:
+                    names.append(f"@{u.username}" if u.username else f"[{u.first_name}](tg://user?id={member.user_id})")
+                    logger.info("[邀请] 在群组 [%14d]：用户（ID: %s | @%s）已在群内，跳过", chat_id, member.user_id, u.username)
+                else:
+                    names.append(str(member.user_id))
+                    logger.info("[邀请] 在群组 [%14d]：用户（ID: %s）已在群内，跳过", chat_id, member.user_id)
             text = "ℹ️ 暂无新成员可邀请，以下成员已在本群内：\n" + "、".join(names)
             logger.info(f"[邀请] 在群组 [{chat_id:>14}]：管理员 [{event.sender_id:>14}] 批量邀请：无新成员")
             return await event.reply(text, parse_mode="markdown")
@@ -5013,100 +5535,81 @@ async def invite_member(event):
     other_failed = []     # 其他失败
 
     # 构造正确的InputChannel
-    chat = await client.get_entity(chat_id)
-    input_channel = InputPeerChannel(
-        channel_id=chat.id,
-        access_hash=chat.access_hash
-    ) if hasattr(chat, 'access_hash') else utils.get_input_channel(chat)
-
-    # 逐个邀请
-    for member in to_invite:
-        try:
-            # 方案1：用存储的access_hash构造实体
-            user_entity = InputPeerUser(
-                user_id=member["user_id"],
-                access_hash=member["access_hash"]
-            )
-        except Exception:
-            # 方案2：access_hash失效，用username重新获取实体
-            if not member["username"]:
-                other_failed.append(member["user_id"])
-                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）无用户名，无法兜底邀请")
-                continue
-            try:
-                user = await client.get_entity(f"@{member['username']}")
-                user_entity = InputPeerUser(
-                    user_id=user.id,
-                    access_hash=user.access_hash
-                )
-            except Exception as e:
-                other_failed.append(member["user_id"])
-                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']} | @{member['username']}）兜底邀请失败：{str(e)}")
-                continue
+    input_channel = chat_peer
 
-        # 执行邀请
+    async def _invite_one(member, user_entity):
+        """单个邀请并按错误类型归类（批量失败时用于定位具体成员）"""
         try:
-            await client(InviteToChannelRequest(input_channel, [user_entity]))
-            invited.append(member["user_id"])
-            await asyncio.sleep(1)  # 减少限流概率
-            logger.info(f"[邀请] 在群组 [{chat_id:>14}]：批量邀请用户（ID: {member['user_id']}）：成功")
+            async with invite_bucket:
+                await client(InviteToChannelRequest(input_channel, [user_entity]))
+            invite_bucket.on_success()
+            telegram_breaker.record_success()
+            invited.append(member.user_id)
+            logger.info("[邀请] 在群组 [%14d]：批量邀请用户（ID: %s）：成功", chat_id, member.user_id)
         except RPCError as e:
             # 用错误特征判断隐私限制（替代 UserPrivacyRestrictedError）
             if "PRIVACY" in str(e).upper() or "USER_PRIVACY_RESTRICTED" in str(e):
-                privacy_failed.append(member["user_id"])
-                logger.info(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）：隐私限制，邀请失败")
+                privacy_failed.append(member.user_id)
+                logger.info("[邀请] 在群组 [%14d]：用户（ID: %s）：隐私限制，邀请失败", chat_id, member.user_id)
             # 限流错误
             elif isinstance(e, FloodWaitError):
-                flood_wait_failed.append(f"{member['user_id']}（需等{e.seconds}秒）")
-                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）：触发限流，需等{e.seconds}秒")
+                invite_bucket.on_flood()
+                telegram_breaker.record_flood(e.seconds)
+                flood_wait_failed.append(f"{member.user_id}（需等{e.seconds}秒）")
+                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member.user_id}）：触发限流，需等{e.seconds}秒")
             # 其他RPC错误
             else:
-                other_failed.append(member["user_id"])
-                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）：未知RPC错误，邀请失败：{str(e)}")
+                other_failed.append(member.user_id)
+                logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member.user_id}）：未知RPC错误，邀请失败：{str(e)}")
+        except Exception as e:
+            other_failed.append(member.user_id)
+            logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member.user_id}）：未知错误，邀请失败：{str(e)}")
+
+    # 分批邀请：每批一次 InviteToChannelRequest，失败的批次再逐个邀请定位问题成员
+    for i in range(0, len(to_invite), INVITE_BATCH_SIZE):
+        chunk = to_invite[i:i + INVITE_BATCH_SIZE]
+        user_entities = [
+            InputPeerUser(user_id=m.user_id, access_hash=m.access_hash) for m in chunk
+        ]
+        try:
+            async with invite_bucket:
+                result = await client(InviteToChannelRequest(input_channel, user_entities))
+        except FloodWaitError as e:
+            invite_bucket.on_flood()
+            telegram_breaker.record_flood(e.seconds)
+            for member in chunk:
+                flood_wait_failed.append(f"{member.user_id}（需等{e.seconds}秒）")
+            logger.error(f"[邀请] 在群组 [{chat_id:>14}]：批量邀请 {len(chunk)} 人触发限流，需等{e.seconds}秒")
+            continue
         except Exception as e:
-            other_failed.append(member["user_id"])
-            logger.error(f"[邀请] 在群组 [{chat_id:>14}]：用户（ID: {member['user_id']}）：未知错误，邀请失败：{str(e)}")
+            logger.info(f"[邀请] 在群组 [{chat_id:>14}]：批量邀请 {len(chunk)} 人失败，改为逐个邀请：{str(e)}")
+            for member, user_entity in zip(chunk, user_entities):
+                await _invite_one(member, user_entity)
+            continue
+
+        invite_bucket.on_success()
+        telegram_breaker.record_success()
+        # 新版接口会在 missing_invitees 中返回因隐私设置未能邀请的成员
+        missing_ids = {
+            getattr(mi, 'user_id', None) for mi in (getattr(result, 'missing_invitees', None) or [])
+        }
+        for member in chunk:
+            if member.user_id in missing_ids:
+                privacy_failed.append(member.user_id)
+                logger.info("[邀请] 在群组 [%14d]：用户（ID: %s）：隐私限制，邀请失败", chat_id, member.user_id)
+            else:
+                invited.append(member.user_id)
+                logger.info("[邀请] 在群组 [%14d]：批量邀请用户（ID: %s）：成功", chat_id, member.user_id)
 
     # 构建回复
-    parts = []
-    if invited:
-        names = []
-        for uid in invited:
-            try:
-                u = await client.get_entity(uid)
-                names.append(f"@{u.username}" if u.username else str(uid))
-            except:
-                names.append(str(uid))
-        parts.append(f"✅ 成功邀请：{', '.join(names)}")
-    if privacy_failed:
-        names = []
-        for uid in privacy_failed:
-            try:
-                u = await client.get_entity(uid)
-                names.append(f"@{u.username}" if u.username else str(uid))
-            except:
-                names.append(str(uid))
-        parts.append(f"⚠ 无法邀请（隐私设置）：{', '.join(names)}")
-    if flood_wait_failed:
-        parts.append(f"⚠ 邀请限流（需等待）：{', '.join(flood_wait_failed)}")
-    if other_failed:
-        names = []
-        for uid in other_failed:
-            try:
-                u = await client.get_entity(uid)
-                names.append(f"@{u.username}" if u.username else str(uid))
-            except:
-                names.append(str(uid))
-        parts.append(f"❌ 邀请失败（其他原因）：{', '.join(names)}")
-    if already_in:
-        names = []
-        for m in already_in:
-            try:
-                u = await client.get_entity(m["user_id"])
-                names.append(f"@{u.username}" if u.username else str(m["user_id"]))
-            except:
-                names.append(str(m["user_id"]))
-        parts.append(f"ℹ️ 已在群内，跳过：{', '.join(names)}")
+    sections = (
+        ("✅ 成功邀请", _render_names(invited)),
+        ("⚠ 无法邀请（隐私设置）", _render_names(privacy_failed)),
+        ("⚠ 邀请限流（需等待）", ', '.join(flood_wait_failed)),
+        ("❌ 邀请失败（其他原因）", _render_names(other_failed)),
+        ("ℹ️ 已在群内，跳过", _render_names(m.user_id for m in already_in)),
+    )
+    parts = [f"{label}：{names}" for label, names in sections if names]
     if invalid_ids:
         parts.append("❌ 无效成员（无法找到）：" + "、".join(str(uid) for uid in invalid_ids))
     if not parts:
@@ -5123,10 +5626,10 @@ async def invite_member(event):
 
 
 # ============================== 5. 踢出成员（一次@一位）==============================
-@client.on(NewMessage(pattern=r"^踢成员\s+@?(\w+)$", incoming=True))
+@client.on(NewMessage(pattern=KICK_MEMBER_RE, incoming=True))
 async def kick_member(event):
     # 仅管理员在群组内可用
-    if not event.is_group or not await is_admin(event.sender_id):
+    if not event.is_group or event.sender_id not in ADMIN_IDS:
         if not event.is_group:
             logger.info(f"[踢出] 非群组环境：用户 [{event.sender_id:>14}] 尝试踢成员")
         else:
@@ -5140,7 +5643,7 @@ async def kick_member(event):
 
     # 解析用户实体（用通用Exception捕获）
     try:
-        user = await client.get_entity(full_username)
+        user = await user_entity_cache.get(full_username)
     except Exception:
         await event.reply(f"❌ 无法找到用户 {full_username}")
         logger.info(f"[踢出] 在群组 [{chat_id:>14}] 踢出成员 {full_username} {operation_result}")
@@ -5170,9 +5673,37 @@ async def kick_member(event):
 
 
 # ---------------------------- 设置群成员为管理员 ----------------------------
+# 各群可授予的额外管理员权限缓存：{chat_id: (机器人自身权限指纹, {权限名: True}, 过期时间)}，逐项回退探测后写入；
+# 机器人自身权限变化（指纹不同）、超过 TTL 或出现权限类错误时失效，避免一直沿用过时的较小权限集
+ADMIN_RIGHTS_CACHE_TTL = 3600
+_admin_rights_cache = {}
+
+def _bot_rights_fingerprint(bot_permissions):
+    """机器人在本群的管理员权限指纹：权限被调整后指纹随之变化"""
+    rights = getattr(getattr(bot_permissions, 'participant', None), 'admin_rights', None)
+    if rights is None:
+        return None
+    return frozenset(k for k, v in rights.to_dict().items() if not k.startswith('_') and v)
+
+def get_cached_admin_rights(chat_id, fingerprint):
+    """取缓存的可用额外权限；指纹不一致或已过期时返回 None"""
+    entry = _admin_rights_cache.get(chat_id)
+    if entry is None:
+        return None
+    cached_fp, extras, expires_at = entry
+    if cached_fp != fingerprint or monotonic() >= expires_at:
+        _admin_rights_cache.pop(chat_id, None)
+        return None
+    return extras
+
+def set_cached_admin_rights(chat_id, fingerprint, extras):
+    """记录本群实际可用的额外权限（附带机器人权限指纹和过期时间）"""
+    _admin_rights_cache[chat_id] = (fingerprint, extras, monotonic() + ADMIN_RIGHTS_CACHE_TTL)
+
 @client.on(events.NewMessage(
     pattern=r'^设置管理员(?:\s+@([\w\d_]+))?$',
     incoming=True))
+@with_breaker
 async def set_admin(event: events.NewMessage.Event):
     """
     用法 1：设置管理员 @username
@@ -5205,6 +5736,7 @@ async def set_admin(event: events.NewMessage.Event):
             logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 机器人没有「添加管理员」的权限，无法设置管理员")
             return await event.reply("❌ 机器人没有「添加管理员」的权限，无法设置管理员")
     except ChatAdminRequiredError:
+        _admin_rights_cache.pop(full_chat_id, None)
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 无权限查看群权限，无法验证自身管理员身份")
         return await event.reply("❌ 机器人无权限查看群权限，请先将机器人设为管理员")
 
@@ -5253,9 +5785,9 @@ async def set_admin(event: events.NewMessage.Event):
     target_display_name = f"@{target_username}" if target_username else get_display_name(target_entity)
 
     # ---------------------------- 2. 检查目标成员是否在群组内 ----------------------------
+    # 一次 get_permissions 同时确认成员身份和管理员身份
     try:
-        # 检查目标成员是否为群组成员
-        await client.get_permissions(full_chat_id, target_entity)
+        permissions = await client.get_permissions(full_chat_id, target_entity)
     except UserNotParticipantError:
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员失败：{target_mention} 不是群组成员")
         return await event.reply(f"❌ 错误：{target_display_name} 不是本群成员，请先邀请其加入群组")
@@ -5264,15 +5796,10 @@ async def set_admin(event: events.NewMessage.Event):
         return await event.reply(f"❌ 错误：无法验证目标成员是否在群组内，请重试")
 
     # ---------------------------- 3. 检查目标成员是否已经是管理员 ----------------------------
-    try:
-        permissions = await client.get_permissions(full_chat_id, target_entity)
-        if permissions.is_admin:
-            # 合并日志为一条
-            logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员请求：目标 {target_mention} 已是管理员")
-            return await event.reply(f"✅ 无需重复设置：{target_display_name} 已是本群管理员")
-    except Exception as e:
-        logger.error(f"[管理] 在群组 [{full_chat_id:>14}] 检查目标成员是否为管理员失败：{str(e)}")
-        return await event.reply(f"❌ 错误：无法验证目标成员是否为管理员，请重试")
+    if permissions.is_admin:
+        # 合并日志为一条
+        logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员请求：目标 {target_mention} 已是管理员")
+        return await event.reply(f"✅ 无需重复设置：{target_display_name} 已是本群管理员")
 
     # ---------------------------- 4. 分群组类型设置管理员 ----------------------------
     try:
@@ -5300,33 +5827,49 @@ async def set_admin(event: events.NewMessage.Event):
             elif is_supergroup:
                 extra_rights = {"change_info": True, "post_messages": True, "edit_messages": True, "pin_messages": True, "manage_call": True}
 
-            # 执行基础权限设置
-            channel_entity = await client.get_entity(full_chat_id)
-            channel_peer = InputPeerChannel(channel_entity.id, channel_entity.access_hash)
+            channel_peer = await get_chat_peer(full_chat_id)
+            base_dict = {k: v for k, v in base_rights.to_dict().items() if not k.startswith('_')}
 
-            await client(EditAdminRequest(
-                channel=channel_peer,  # 使用正确的 InputPeerChannel
-                user_id=target_id,
-                admin_rights=base_rights,
-                rank="管理员"
-            ))
-
-            # 追加额外权限
-            for perm_name, value in extra_rights.items():
-                base_dict = {k: v for k, v in base_rights.to_dict().items() if not k.startswith('_')}
-                new_rights = ChatAdminRights(**base_dict)
-                setattr(new_rights, perm_name, value)
-                try:
-                    await client(EditAdminRequest(
-                        channel=channel_peer,
-                        user_id=target_id,
-                        admin_rights=new_rights,
-                        rank="管理员"
-                    ))
-                    base_rights = new_rights
-                except RightForbiddenError:
-                    logger.debug(f"[管理] 在群组 [{full_chat_id:>14}] 不支持 {perm_name} 权限，已跳过")
-                    continue
+            # 优先使用该群已探测出的可用额外权限，未探测过则尝试全部额外权限
+            bot_fp = _bot_rights_fingerprint(bot_permissions)
+            accepted_extras = get_cached_admin_rights(full_chat_id, bot_fp)
+            if accepted_extras is None:
+                accepted_extras = extra_rights
+            try:
+                # 一次请求设置最终权限（基础权限 + 额外权限）
+                await rpc_with_flood_retry(EditAdminRequest(
+                    channel=channel_peer,  # 使用正确的 InputPeerChannel
+                    user_id=target_id,
+                    admin_rights=ChatAdminRights(**{**base_dict, **accepted_extras}),
+                    rank="管理员"
+                ), max_retries=1)
+                set_cached_admin_rights(full_chat_id, bot_fp, accepted_extras)
+            except RightForbiddenError:
+                # 仅在失败时回退：先设置基础权限，再逐项追加额外权限，跳过不支持的项
+                _admin_rights_cache.pop(full_chat_id, None)
+                await rpc_with_flood_retry(EditAdminRequest(
+                    channel=channel_peer,
+                    user_id=target_id,
+                    admin_rights=base_rights,
+                    rank="管理员"
+                ), max_retries=1)
+                for perm_name, value in extra_rights.items():
+                    new_rights = ChatAdminRights(**{**base_dict, perm_name: value})
+                    try:
+                        await rpc_with_flood_retry(EditAdminRequest(
+                            channel=channel_peer,
+                            user_id=target_id,
+                            admin_rights=new_rights,
+                            rank="管理员"
+                        ), max_retries=1)
+                        base_dict[perm_name] = value
+                    except RightForbiddenError:
+                        logger.debug(f"[管理] 在群组 [{full_chat_id:>14}] 不支持 {perm_name} 权限，已跳过")
+                        continue
+                # 记录本群实际可用的额外权限，后续设置管理员一次请求完成
+                set_cached_admin_rights(full_chat_id, bot_fp, {
+                    k: v for k, v in extra_rights.items() if base_dict.get(k) == v
+                })
 
             logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 成功将 {target_mention} 设置为{group_type}管理员")
 
@@ -5338,12 +5881,14 @@ async def set_admin(event: events.NewMessage.Event):
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员请求无效：{target_mention} 已是管理员")
         await event.reply(f"✅ 无需重复设置：{target_display_name} 已是本群管理员")
     except ChatAdminRequiredError:
+        _admin_rights_cache.pop(full_chat_id, None)
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员失败：机器人非管理员")
         await event.reply("❌ 失败原因：机器人不是本群管理员，请先将机器人设为管理员")
     except RightForbiddenError:
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员失败：机器人缺少设置权限")
         await event.reply("❌ 失败原因：机器人权限不足（缺少“设置管理员”的权限），请提升机器人权限")
     except (ChatIdInvalidError, PeerIdInvalidError):
+        invalidate_chat_peer(full_chat_id)
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 设置管理员失败：群组ID无效（{group_type}）")
         await event.reply("❌ 失败原因：群组ID无效（可能是群组类型识别错误），建议升级为超级群组后重试")
     except UserNotParticipantError:
@@ -5363,6 +5908,7 @@ async def set_admin(event: events.NewMessage.Event):
 @client.on(events.NewMessage(
     pattern=r'^移除管理员(?:\s+@([\w\d_]+))?$',          # @username 可选
     incoming=True))
+@with_breaker
 async def remove_admin(event: events.NewMessage.Event):
     """
     用法 1：移除管理员 @username
@@ -5395,6 +5941,7 @@ async def remove_admin(event: events.NewMessage.Event):
             logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 机器人没有「添加/移除管理员」的权限")
             return await event.reply("❌ 机器人没有「管理管理员」的权限，无法执行此操作")
     except ChatAdminRequiredError:
+        _admin_rights_cache.pop(full_chat_id, None)
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 无权限查看群权限，无法验证自身管理员身份")
         return await event.reply("❌ 机器人无权限查看群权限，请先将机器人设为管理员")
 
@@ -5443,8 +5990,9 @@ async def remove_admin(event: events.NewMessage.Event):
     target_display_name = f"@{target_username}" if target_username else get_display_name(target_entity)
 
     # ---------------------------- 2. 检查目标成员是否在群组内 ----------------------------
+    # 一次 get_permissions 同时确认成员身份和管理员身份
     try:
-        await client.get_permissions(full_chat_id, target_entity)
+        perms = await client.get_permissions(full_chat_id, target_entity)
     except UserNotParticipantError:
         logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 移除管理员失败：{target_mention} 不是群组成员")
         return await event.reply(f"❌ 错误：{target_display_name} 不是本群成员")
@@ -5453,14 +6001,9 @@ async def remove_admin(event: events.NewMessage.Event):
         return await event.reply(f"❌ 错误：无法验证目标成员是否在群组内，请重试")
 
     # ---------------------------- 3. 检查目标是否是管理员 ----------------------------
-    try:
-        perms = await client.get_permissions(full_chat_id, target_entity)
-        if not getattr(perms, "is_admin", False):  # 检查是否为管理员
-            logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 移除管理员请求无效：{target_mention} 并非管理员")
-            return await event.reply(f"ℹ️ 无需操作：{target_display_name} 当前并非管理员")
-    except Exception as e:
-        logger.error(f"[管理] 在群组 [{full_chat_id:>14}] 检查目标成员是否为管理员失败：{str(e)}")
-        return await event.reply(f"❌ 错误：无法验证目标成员是否为管理员，请重试")
+    if not getattr(perms, "is_admin", False):  # 检查是否为管理员
+        logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 移除管理员请求无效：{target_mention} 并非管理员")
+        return await event.reply(f"ℹ️ 无需操作：{target_display_name} 当前并非管理员")
 
     # ---------------------------- 4. 执行移除管理员操作 ----------------------------
     try:
@@ -5472,16 +6015,15 @@ async def remove_admin(event: events.NewMessage.Event):
             # 构造空权限（降级为普通成员）
             no_rights = ChatAdminRights()  
 
-            # 超级群组/频道需要使用InputPeerChannel
-            channel_entity = await client.get_entity(full_chat_id)
-            channel_peer = InputPeerChannel(channel_entity.id, channel_entity.access_hash)
+            # 超级群组/频道需要使用InputPeerChannel（按 chat_id 缓存）
+            channel_peer = await get_chat_peer(full_chat_id)
 
-            await client(EditAdminRequest(
+            await rpc_with_flood_retry(EditAdminRequest(
                 channel=channel_peer,
                 user_id=target_id,
                 admin_rights=no_rights,
                 rank=""  # 清空管理员头衔
-            ))
+            ), max_retries=1)
             
             logger.info(f"[管理] 在群组 [{full_chat_id:>14}] 已取消 {target_mention} 的管理员权限")
             await event.reply(f"✅ 已成功在{group_type} [{chat_title}] 取消 {target_display_name} 的管理员权限")
@@ -5505,7 +6047,33 @@ async def remove_admin(event: events.NewMessage.Event):
 
 
 # ---------------------------- 拉群功能（创建群组并邀请成员） ----------------------------
+ADMIN_PROMOTE_CONCURRENCY = 5  # 拉群后并发设置管理员的最大请求数
+
+# 限流重试：Telethon 已自动等待 flood_sleep_threshold（默认60秒）以内的限流，
+# 这里再接住不超过 FLOOD_RETRY_SOFT_LIMIT 秒的中等限流，等待后自动重试
+FLOOD_RETRY_SOFT_LIMIT = 120
+FLOOD_RETRY_MAX = 3
+
+async def rpc_with_flood_retry(request, *, max_retries=FLOOD_RETRY_MAX, soft_limit=FLOOD_RETRY_SOFT_LIMIT):
+    """执行 Telegram 请求；短时限流时按要求等待（附加随机抖动）后重试，长时限流或重试次数用尽时抛出 FloodWaitError"""
+    for attempt in range(1, max_retries + 1):
+        try:
+            result = await client(request)
+            telegram_breaker.record_success()
+            return result
+        except FloodWaitError as e:
+            telegram_breaker.record_flood(e.seconds)
+            if e.seconds > soft_limit or attempt == max_retries:
+                raise
+            logger.warning(f"[限流] {type(request).__name__} 触发限流，等待 {e.seconds} 秒后第 {attempt} 次重试")
+            await asyncio.sleep(e.seconds + random.uniform(0, 1))
+
+def _short(e, n=30):
+    """截取异常信息的前 n 个字符，用于日志与回复中的简短提示"""
+    return str(e)[:n]
+
 @client.on(events.NewMessage(pattern=r'^拉群$', incoming=True))
+@with_breaker
 async def create_new_group(event):
     user_id = event.sender_id
     group_name = f"{datetime.now():%Y%m%d-%H%M%S} 对接群"
@@ -5523,6 +6091,7 @@ async def create_new_group(event):
     admin_result_msg = ""
     full_chat_id = ""  # 初始化群组ID，避免后续引用报错
     invite_link = "无法生成邀请链接"  # 初始化邀请链接，默认值
+    input_channel = None  # 新群组的 InputPeerChannel，创建成功后赋值
 
     try:
         db = await DB.get_conn()
@@ -5533,13 +6102,16 @@ async def create_new_group(event):
         staff_list = [{"user_id": r[0], "access_hash": r[1]} for r in rows if r[0] and r[1]]
         
         # 确保发起人（当前管理员）在邀请列表中
-        if not any(m["user_id"] == user_id for m in staff_list):
+        if user_id not in {m["user_id"] for m in staff_list}:
             try:
-                user = await client.get_entity(user_id)
-                staff_list.append({"user_id": user_id, "access_hash": user.access_hash})
+                # 发起人的 InputPeerUser 随消息一起下发（或在会话缓存中），通常无需 RPC
+                sender = await event.get_input_sender()
+                if not isinstance(sender, InputPeerUser):
+                    sender = utils.get_input_peer(await client.get_entity(user_id))
+                staff_list.append({"user_id": user_id, "access_hash": sender.access_hash})
                 logger.info(f"[拉群] 已补充发起人 {user_id} 到邀请列表")
             except Exception as e:
-                logger.warning(f"[拉群] 无法获取发起人 {user_id} 的信息，可能无法加入群组：{str(e)[:30]}...")
+                logger.warning(f"[拉群] 无法获取发起人 {user_id} 的信息，可能无法加入群组：{_short(e)}...")
                 await reply_msg.edit(f"⚠️ 注意：无法获取您的账号信息，创建群组后需手动加入\n⏳ 继续创建群组中...")
 
         # 1. 创建新超级群组
@@ -5548,6 +6120,19 @@ async def create_new_group(event):
         ))
         new_channel = result.chats[0]
         full_chat_id = get_peer_id(new_channel)  # 赋值群组ID
+        # 只构造一次 InputPeerChannel，后续所有请求复用，避免每次重新推导/解析
+        input_channel = InputPeerChannel(new_channel.id, new_channel.access_hash)
+
+        # 生成24小时有效邀请链接（只生成一次：邀请限流、权限设置失败及最终反馈共用）
+        try:
+            invite = await rpc_with_flood_retry(ExportChatInviteRequest(
+                peer=input_channel,
+                expire_date=int(time.time()) + 24 * 3600
+            ))
+            invite_link = invite.link
+        except Exception as e:
+            invite_link = "无法生成邀请链接"
+            logger.error(f"[拉群] 生成邀请链接失败：{str(e)}")
         logger.info(f"[拉群] 创建群 [{full_chat_id:>14}] 成功，群组名称：{group_name}")
         await reply_msg.edit(f"✅ 群组创建成功：{group_name}\n⏳ 正在邀请成员加入...")
 
@@ -5564,37 +6149,27 @@ async def create_new_group(event):
                 user_entities.append(entity)
             except Exception as e:
                 invalid_ids.append(str(member["user_id"]))
-                logger.warning(f"[拉群] 无法构造用户 {member['user_id']} 的实体：{str(e)[:20]}...")
+                logger.warning(f"[拉群] 无法构造用户 {member['user_id']} 的实体：{_short(e, 20)}...")
 
         # 3. 邀请成员（核心：优化限速提示）
-        invite_link = ""  # 初始化邀请链接变量
+        flood_hit = False  # 邀请是否触发频率限制
         if user_entities:
             try:
-                await client(InviteToChannelRequest(
-                    channel=new_channel, 
+                await rpc_with_flood_retry(InviteToChannelRequest(
+                    channel=input_channel,
                     users=user_entities
                 ))
                 logger.info(f"[邀请] 已在群 [{full_chat_id:>14}] 成功邀请 {len(user_entities)} 位成员")
                 await reply_msg.edit(f"✅ 群组创建成功：{group_name}\n✅ 已邀请 {len(user_entities)} 位成员加入\n⏳ 正在设置管理员权限...")
             # 专门处理 Telegram 频率限制错误
             except FloodWaitError as e:
+                flood_hit = True
                 wait_time = e.seconds
                 logger.error(f"[拉群] 在群组 [{full_chat_id:>14}] 邀请成员触发频率限制，需等待 {wait_time} 秒")
-                
-                # 生成邀请链接（备选方案）
-                try:
-                    invite = await client(ExportChatInviteRequest(
-                        peer=new_channel, 
-                        expire_date=int(time.time()) + 24 * 3600  # 24小时有效
-                    ))
-                    invite_link = invite.link
-                except Exception as inner_e:
-                    invite_link = "无法生成邀请链接（权限不足）"
-                    logger.error(f"[拉群] 生成邀请链接失败：{str(inner_e)}")
             # 处理其他邀请错误
             except Exception as e:
                 logger.error(f"[拉群] 邀请成员失败：{str(e)}", exc_info=True)
-                await reply_msg.edit(f"✅ 群组创建成功，但邀请成员失败：{str(e)[:30]}...\n⏳ 尝试设置管理员权限...")
+                await reply_msg.edit(f"✅ 群组创建成功，但邀请成员失败：{_short(e)}...\n⏳ 尝试设置管理员权限...")
         # 无有效成员可邀请的处理
         else:
             logger.warning(f"[拉群] 无有效成员可邀请（无效用户ID：{','.join(invalid_ids) if invalid_ids else '无'}）")
@@ -5602,7 +6177,7 @@ async def create_new_group(event):
 
         # 4. 为成员分配管理员权限（核心修改：结果存入 admin_result_msg）
         # 只有在未触发频率限制且有有效成员时执行
-        if user_entities and not (isinstance(locals().get('e'), FloodWaitError)):
+        if user_entities and not flood_hit:
             rights = ChatAdminRights(
                 change_info=True, post_messages=True, edit_messages=True,
                 delete_messages=True, ban_users=True, invite_users=True,
@@ -5611,44 +6186,42 @@ async def create_new_group(event):
             success_admins = []
             fail_admins = []
 
-            # 生成24小时有效邀请链接（用于权限设置失败时备用）
-            try:
-                invite = await client(ExportChatInviteRequest(
-                    peer=new_channel, 
-                    expire_date=int(time.time()) + 24 * 3600
-                ))
-                invite_link = invite.link
-            except Exception as e:
-                invite_link = "无法生成邀请链接"
-                logger.error(f"[拉群] 生成管理员备用邀请链接失败：{str(e)}")
+            # 并发设置管理员（信号量限制同时进行的请求数）
+            promote_semaphore = asyncio.Semaphore(ADMIN_PROMOTE_CONCURRENCY)
 
-            # 遍历成员设置管理员
-            for member in staff_list:
+            async def _promote(member):
                 sid = member["user_id"]
-                try:
-                    await client(EditAdminRequest(
-                        channel=new_channel, 
-                        user_id=sid,
-                        admin_rights=rights, 
-                        rank="管理员"
-                    ))
-                    success_admins.append(str(sid))
-                except Exception as e:
-                    fail_admins.append(str(sid))
-                    logger.warning(f"⚠️ 无法将用户 {sid} 设置为管理员：{str(e)[:30]}...")
-                    # 隐私设置导致失败时，向用户发送提醒
-                    if "privacy" in str(e).lower() or "mutual" in str(e).lower():
-                        try:
-                            await client.send_message(
-                                sid,
-                                "⚠️ 机器人无法将你设为群管理员，请检查隐私设置：\n"
-                                "1. 打开 Telegram → 设置 → 隐私与安全\n"
-                                "2. 找到“群组与频道” → “谁可以将我添加至群组”\n"
-                                "3. 设置为“所有人”或“我的联系人”\n\n"
-                                f"📱 临时加入链接（24h有效）：{invite_link}"
-                            )
-                        except Exception:
-                            logger.warning(f"⚠️ 无法向用户 {sid} 发送隐私提醒")
+                async with promote_semaphore:
+                    try:
+                        await rpc_with_flood_retry(EditAdminRequest(
+                            channel=input_channel,
+                            user_id=sid,
+                            admin_rights=rights,
+                            rank="管理员"
+                        ))
+                        return sid, None
+                    except Exception as e:
+                        error = e
+                err_text = str(error)  # 只转换一次，日志与隐私判断共用
+                logger.warning(f"⚠️ 无法将用户 {sid} 设置为管理员：{err_text[:30]}...")
+                # 隐私设置导致失败时，向用户发送提醒（同样并发进行）
+                err_lower = err_text.lower()
+                if "privacy" in err_lower or "mutual" in err_lower:
+                    try:
+                        await client.send_message(
+                            sid,
+                            "⚠️ 机器人无法将你设为群管理员，请检查隐私设置：\n"
+                            "1. 打开 Telegram → 设置 → 隐私与安全\n"
+                            "2. 找到“群组与频道” → “谁可以将我添加至群组”\n"
+                            "3. 设置为“所有人”或“我的联系人”\n\n"
+                            f"📱 临时加入链接（24h有效）：{invite_link}"
+                        )
+                    except Exception:
+                        logger.warning(f"⚠️ 无法向用户 {sid} 发送隐私提醒")
+                return sid, error
+
+            for sid, error in await asyncio.gather(*(_promote(m) for m in staff_list)):
+                (fail_admins if error else success_admins).append(str(sid))
 
             # 核心修改：将管理员设置结果存入 admin_result_msg（不再单独发送）
             admin_result_msg = "✅ 管理员设置完成：\n"
@@ -5657,16 +6230,6 @@ async def create_new_group(event):
             if fail_admins:
                 admin_result_msg += f"⚠️ 无法设置 {len(fail_admins)} 位管理员（ID：{','.join(fail_admins[:5])}{'...' if len(fail_admins)>5 else ''}）\n"
             logger.info(f"[拉群] 在群组 [{full_chat_id:>14}] 管理员设置完成（成功{len(success_admins)}人/失败{len(fail_admins)}人）")
-        # 频率限制时补充生成邀请链接
-        elif not invite_link:
-            try:
-                invite = await client(ExportChatInviteRequest(
-                    peer=new_channel, 
-                    expire_date=int(time.time()) + 24 * 3600
-                ))
-                invite_link = invite.link
-            except Exception:
-                invite_link = "无法生成邀请链接"
 
         # 5. 向发起人发送最终结果（核心修改：合并 admin_result_msg）
         try:
@@ -5706,15 +6269,16 @@ async def create_new_group(event):
         if isinstance(e, FloodWaitError):
             wait_time = e.seconds
             logger.error(f"[拉群] 创建群组触发频率限制，需等待 {wait_time} 秒")
-            # 生成邀请链接（若已创建群组）
-            try:
-                invite = await client(ExportChatInviteRequest(
-                    peer=new_channel, 
-                    expire_date=int(time.time()) + 24 * 3600
-                ))
-                invite_link = invite.link
-            except Exception:
-                invite_link = "无法生成邀请链接"
+            # 生成邀请链接（仅当群组已创建且前面未生成成功时）
+            if input_channel is not None and invite_link == "无法生成邀请链接":
+                try:
+                    invite = await client(ExportChatInviteRequest(
+                        peer=input_channel,
+                        expire_date=int(time.time()) + 24 * 3600
+                    ))
+                    invite_link = invite.link
+                except Exception:
+                    pass
             # 合并异常场景的最终反馈
             final_msg = (
                 f"✅ 拉群操作已完成！\n"
@@ -5726,18 +6290,19 @@ async def create_new_group(event):
             )
             await reply_msg.edit(final_msg)
         else:
-            error_msg = f"❌ 群创建或邀请时出错：{str(e)[:50]}...\n请查看日志获取详细信息"
+            error_msg = f"❌ 群创建或邀请时出错：{_short(e, 50)}...\n请查看日志获取详细信息"
             logger.error(f"[拉群] 全局异常：{str(e)}", exc_info=True)
             try:
                 await reply_msg.edit(error_msg)
             except Exception:
                 await event.reply(error_msg)
-        logger.warning(f"[拉群] 管理员 {user_id} 拉群操作失败：{str(e)[:30]}...")
+        logger.warning(f"[拉群] 管理员 {user_id} 拉群操作失败：{_short(e)}...")
 
     
 
 # ---------------------------- 更改群名功能 ----------------------------
-@client.on(events.NewMessage(pattern=r'更改群名\s+(.+)'))
+@client.on(events.NewMessage(pattern=r'^更改群名\s+(.+)$', incoming=True))
+@with_breaker
 async def change_group_name(event):
     logger.info(f"收到命令：{event.raw_text}")  # 确认事件是否触发
 
@@ -5745,9 +6310,9 @@ async def change_group_name(event):
     chat_id = event.chat_id
     new_group_name = event.pattern_match.group(1)  # 从命令中提取新群名
 
-    # 获取群组信息，代替 chat_id
-    group = await client.get_entity(chat_id)
-    group_name = group.title if isinstance(group, (Channel, Chat)) else "未知群组"
+    # 群组实体随消息更新一起下发，直接复用；InputPeer 来自事件本身，无需 get_entity
+    group = await event.get_chat()
+    group_name = getattr(group, 'title', None) or "未知群组"
 
     logger.info(f"用户 {user_id} 请求更改群名：来自群组 {group_name}，新群名：{new_group_name}")
 
@@ -5763,17 +6328,18 @@ async def change_group_name(event):
 
     try:
         # 获取群组的详细信息
-        logger.info(f"成功获取群组信息：{group.title}")
+        logger.info(f"成功获取群组信息：{group_name}")
 
-        # 创建 InputPeerChannel
-        channel = InputPeerChannel(group.id, group.access_hash)
+        # 事件自带的 InputPeerChannel
+        channel = await event.get_input_chat()
 
         # 使用 EditTitleRequest 来更改群名
-        response = await client(functions.channels.EditTitleRequest(
+        response = await rpc_with_flood_retry(functions.channels.EditTitleRequest(
             channel=channel,    # 目标群组
             title=new_group_name  # 新的群名称
         ))
 
+        invalidate_group_info(chat_id)  # 群名已变，下次重新读取
         logger.info(f"群组 {group_name} 名称已成功更改为：{new_group_name}")
 
         # 回复管理员
@@ -5794,9 +6360,51 @@ async def change_group_name(event):
 
 
 # ---------------------------- 群组操作公共工具函数 ----------------------------
+PENDING_TTL = 300          # 待确认操作的有效期（秒），超时未确认自动失效
+PENDING_MAXSIZE = 10000    # 最多保留的待确认操作数
+
+class PendingStore:
+    """带过期时间的待确认操作缓存：按写入顺序排列（即过期顺序），访问时从头部清理过期项"""
+
+    def __init__(self, ttl=PENDING_TTL, maxsize=PENDING_MAXSIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # {key: (value, 过期时间)}
+
+    def _expire(self):
+        now = monotonic()
+        while self._data:
+            _, (_, expires_at) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)  # 重新写入时移到末尾，保持过期顺序
+        self._data[key] = (value, monotonic() + self.ttl)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._data
+
+    def __getitem__(self, key):
+        self._expire()
+        return self._data[key][0]
+
+    def get(self, key, default=None):
+        self._expire()
+        item = self._data.get(key)
+        return item[0] if item else default
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[0] if item else default
+
 def create_pending_store():
-    """创建用于存储待确认操作的临时缓存"""
-    return {}
+    """创建用于存储待确认操作的临时缓存（超过 PENDING_TTL 秒未确认自动失效）"""
+    return PendingStore()
 
 async def verify_operation_permissions(event, user_id, chat_id, pending_store, operation_type):
     """
@@ -5812,27 +6420,45 @@ async def verify_operation_permissions(event, user_id, chat_id, pending_store, o
     if not await is_admin(user_id):
         return (False, "❌ 你没有权限执行此操作")
     
-    # 检查是否有对应的待确认请求
-    if chat_id not in pending_store or pending_store.get(chat_id) != user_id:
+    # 检查是否有对应的待确认请求（记录为 (发起人ID, 群组InputPeer, 群组名称)）
+    pending = pending_store.get(chat_id)
+    if not pending or pending[0] != user_id:
         base_command = "解散群组" if operation_type == "disband" else "退群"
         return (False, f"ℹ️ 尚未检测到你的“{base_command}”请求，若要{base_command}请先发送“{base_command}”。")
     
     return (True, None)
 
-async def get_group_info(client, chat_id):
-    """获取群组信息并返回群组对象和名称"""
-    group = await client.get_entity(chat_id)
-    if isinstance(group, (Channel, Chat)):
-        group_name = group.title
-    elif hasattr(group, 'title'):
-        group_name = group.title
-    else:
-        group_name = "未知群组"
-    return group, group_name
+# 群组信息缓存：{chat_id: (InputPeer, 群组名称, 过期时间)}，同一群内连续指令直接复用
+GROUP_INFO_TTL = 600  # 缓存有效期（秒），群名可能被修改，到期后重新读取
+_group_info_cache: dict[int, tuple] = {}
+
+async def get_group_info(event):
+    """返回群组的 InputPeer 和名称：两者都取自事件携带的实体，不再调用 get_entity"""
+    chat_id = event.chat_id
+    cached = _group_info_cache.get(chat_id)
+    now = monotonic()
+    if cached and cached[2] > now:
+        return cached[0], cached[1]
+    input_peer = await event.get_input_chat()
+    group = await event.get_chat()
+    group_name = getattr(group, 'title', None) or "未知群组"
+    _group_info_cache[chat_id] = (input_peer, group_name, now + GROUP_INFO_TTL)
+    return input_peer, group_name
+
+def invalidate_group_info(chat_id):
+    """群组解散/退出或改名后清除缓存"""
+    _group_info_cache.pop(chat_id, None)
+
+async def get_pending_group_info(event, pending_store):
+    """确认/取消阶段优先复用发起请求时保存的群组信息，没有待确认记录时再读取"""
+    pending = pending_store.get(event.chat_id)
+    if pending:
+        return pending[1], pending[2]
+    return await get_group_info(event)
 
 async def handle_operation_cancellation(event, user_id, chat_id, pending_store, operation_name, operation_type):
     """处理操作取消的公共逻辑"""
-    group, group_name = await get_group_info(client, chat_id)
+    group, group_name = await get_pending_group_info(event, pending_store)
     
     # 记录取消日志
     logger.info(f"[取消] 在群组 [{chat_id:>14}] ({group_name}) 的{operation_name}请求已取消，管理员 {user_id}")
@@ -5860,7 +6486,7 @@ async def disband_group_start(event):
     chat_id = event.chat_id
     user_id = event.sender_id
     
-    group, group_name = await get_group_info(client, chat_id)
+    group, group_name = await get_group_info(event)
     logger.info(f"[解散] 解散群 [{event.chat_id:>14}] 群组名称：{group_name}")
     
     # 权限校验
@@ -5880,12 +6506,12 @@ async def disband_group_start(event):
         return await event.reply("❌ 检查权限时出错，请稍后重试")
     
     # 检查是否已有待确认请求
-    if chat_id in pending_disband and pending_disband[chat_id] == user_id:
+    if chat_id in pending_disband and pending_disband[chat_id][0] == user_id:
         logger.info(f"群组 {chat_id} 已有待确认的解散请求，通知用户")
         return await event.reply("ℹ️ 你之前已经发起了解散请求，请回复“确认解散”或“取消解散”。")
     
     # 记录待确认状态
-    pending_disband[chat_id] = user_id
+    pending_disband[chat_id] = (user_id, group, group_name)
     
     # 发送确认提示
     await event.reply(
@@ -5900,7 +6526,7 @@ async def disband_group_confirm(event):
     chat_id = event.chat_id
     user_id = event.sender_id
     
-    group, group_name = await get_group_info(client, chat_id)
+    group, group_name = await get_pending_group_info(event, pending_disband)
     logger.info(f"[确认] 已确认 [{event.chat_id:>14}] 收到解散群组请求：{group_name}")
     
     # 验证操作权限，传入 operation_type="disband"
@@ -5910,7 +6536,9 @@ async def disband_group_confirm(event):
     
     try:
         # 执行解散操作
-        await client(DeleteChannelRequest(channel=chat_id))
+        await client(DeleteChannelRequest(channel=group))
+        invalidate_group_info(chat_id)
+        invalidate_chat_peer(chat_id)
         await GroupJoinTimeManager.delete_join_time(chat_id)
         logger.info(f"[删除] 已删除 [{chat_id}] 群组的加入时间，并已在数据库更新完成")
         
@@ -5952,7 +6580,7 @@ async def leave_group_start(event):
     user_id = event.sender_id
     chat_id = event.chat_id
     
-    group, group_name = await get_group_info(client, chat_id)
+    group, group_name = await get_group_info(event)
     logger.info(f"[退群] 请求群 [{chat_id:>14}] 退群，群组名称：{group_name}")
     
     # 验证权限，传入 operation_type="leave"
@@ -5968,7 +6596,7 @@ async def leave_group_start(event):
     )
     
     # 记录待确认状态
-    pending_leave[chat_id] = user_id
+    pending_leave[chat_id] = (user_id, group, group_name)
     logger.info(f"[检查] 已记录 [{chat_id:>14}] 的退群请求，请等待管理员确认")
 
 @client.on(events.NewMessage(pattern=r"^确认退群$", incoming=True))
@@ -5977,7 +6605,7 @@ async def leave_group_confirm(event):
     chat_id = event.chat_id
     user_id = event.sender_id
     
-    group, group_name = await get_group_info(client, chat_id)
+    group, group_name = await get_pending_group_info(event, pending_leave)
     logger.info(f"[确认] 已确认 [{event.chat_id:>14}] 收到确认退群请求：{group_name}")
     
     # 验证操作权限，传入 operation_type="leave"
@@ -5991,11 +6619,12 @@ async def leave_group_confirm(event):
         await event.reply(farewell_message)
         
         # 执行退群操作
-        if isinstance(group, Channel):
-            peer = InputPeerChannel(group.id, group.access_hash)
-            await client(LeaveChannelRequest(peer))
+        if isinstance(group, InputPeerChannel):
+            await client(LeaveChannelRequest(group))
         else:
             await client.delete_dialog(chat_id)
+        invalidate_group_info(chat_id)
+        invalidate_chat_peer(chat_id)
         
         # 更新数据库
         await GroupJoinTimeManager.delete_join_time(chat_id)
@@ -6051,14 +6680,28 @@ async def verify_group_and_permissions(event):
     
     return (True, None)
 
-async def get_existing_users(db, chat_id):
-    """获取群组中已存在的通知用户列表"""
-    async with db.execute("SELECT usernames FROM mentions WHERE group_id = ?", (chat_id,)) as cursor:
-        row = await cursor.fetchone()
-        if not row or not row[0].strip():
-            return []
-        # 清洗数据：拆分、去空、去重
-        return [u.strip() for u in row[0].split(',') if u.strip()]
+# 通知指令中的用户名（@可省略），一次 findall 完成拆分、去@和过滤空值
+_MENTION_RE = re.compile(r'@?(\w+)')
+
+def split_usernames(username_str):
+    """拆分旧版 mentions.usernames 的逗号分隔字符串（迁移用），每个元素只 strip 一次并过滤空值"""
+    if not username_str:
+        return []
+    return [u for u in map(str.strip, username_str.split(',')) if u]
+
+async def get_existing_users(db, chat_id, usernames=None):
+    """获取群组中已存在的通知用户列表（按添加顺序）；传入 usernames 时只查询其中已存在的用户"""
+    if usernames is None:
+        rows = await db.execute_fetchall(
+            "SELECT username FROM mention_users WHERE group_id = ? ORDER BY rowid", (chat_id,)
+        )
+    else:
+        placeholders = ",".join("?" * len(usernames))
+        rows = await db.execute_fetchall(
+            f"SELECT username FROM mention_users WHERE group_id = ? AND username IN ({placeholders})",
+            (chat_id, *usernames)
+        )
+    return [r[0] for r in rows]
 
 
 # ---------------------------- 消息通知功能（添加通知用户） ----------------------------
@@ -6074,8 +6717,7 @@ async def add_mentions(event):
     chat_id = event.chat_id
     
     # 提取@用户（去除@符号和空格）
-    input_usernames = [u.lstrip('@').strip() for u in event.pattern_match.group(1).split()]
-    input_usernames = [u for u in input_usernames if u]  # 过滤空值
+    input_usernames = _MENTION_RE.findall(event.pattern_match.group(1))
     if not input_usernames:
         return await event.reply("❌ 未识别到有效用户名，请使用@用户名格式")
 
@@ -6083,24 +6725,23 @@ async def add_mentions(event):
     already_added = []
     newly_added = []
 
-    # 查询现有用户列表（使用公共函数）
-    existing_users = await get_existing_users(db, chat_id)
+    # 只查询本次输入中已存在的用户（主键索引查找，无需读取整个列表）
+    existing_set = set(await get_existing_users(db, chat_id, input_usernames))
 
-    # 去重处理（区分已存在和新添加）
+    # 去重处理（区分已存在和新添加；集合判断，输入中的重复用户也只添加一次）
     for username in input_usernames:
-        if username in existing_users:
+        if username in existing_set:
             already_added.append(username)
         else:
-            existing_users.append(username)
+            existing_set.add(username)
             newly_added.append(username)
 
-    # 保存更新后的用户列表（用逗号拼接）
+    # 只插入新增用户，不再整行重写
     if newly_added:
-        updated_usernames = ','.join(existing_users)
-        await db.execute("""
-            INSERT OR REPLACE INTO mentions (group_id, usernames) 
-            VALUES (?, ?)
-        """, (chat_id, updated_usernames))
+        await db.executemany(
+            "INSERT OR IGNORE INTO mention_users (group_id, username) VALUES (?, ?)",
+            [(chat_id, u) for u in newly_added]
+        )
         await db.commit()
 
     # 构建响应消息
@@ -6154,11 +6795,11 @@ async def delete_mention(event):
     chat_id = event.chat_id
     
     # 解析要删除的用户名（支持@用户名或引用消息）
-    mentions = event.raw_text.strip().split()
+    mentions = event.raw_text.strip().split(maxsplit=1)
     usernames = []
     if len(mentions) > 1:
         # 从指令中提取@用户名（如“删除通知 @user1 @user2”）
-        usernames = [u.lstrip('@').strip() for u in mentions[1:] if u.lstrip('@').strip()]
+        usernames = _MENTION_RE.findall(mentions[1])
     else:
         # 从引用消息中提取用户名
         reply = await event.get_reply_message()
@@ -6173,32 +6814,30 @@ async def delete_mention(event):
     deleted_users = []
     not_found_users = []
 
-    # 查询现有用户列表（使用公共函数）
-    existing_users = await get_existing_users(db, chat_id)
+    # 只查询本次要删除的用户中实际存在的部分
+    existing_set = set(await get_existing_users(db, chat_id, usernames))
 
-    if not existing_users:
+    # 一个都没命中时才判断群组是否有通知用户（正常删除路径少一次查询）
+    if not existing_set and not await fetchone(
+        db, "SELECT 1 FROM mention_users WHERE group_id = ? LIMIT 1", (chat_id,)
+    ):
         return await event.reply("❌ 当前群组没有消息通知用户，无需删除")
 
-    # 筛选要删除的用户
+    # 筛选要删除的用户（集合判断与移除）
     for username in usernames:
-        if username in existing_users:
+        if username in existing_set:
             deleted_users.append(username)
-            existing_users.remove(username)  # 从列表中移除
+            existing_set.discard(username)  # 同一用户重复输入时只删除一次
         else:
             not_found_users.append(username)
 
-    # 更新数据库（若剩余用户为空则删除行，否则更新字符串）
+    # 一条 DELETE 删除全部命中的用户
     if deleted_users:
-        if existing_users:
-            updated_usernames = ','.join(existing_users)
-            await db.execute("""
-                UPDATE mentions 
-                SET usernames = ? 
-                WHERE group_id = ?
-            """, (updated_usernames, chat_id))
-        else:
-            # 全部删除时，直接删掉这一行
-            await db.execute("DELETE FROM mentions WHERE group_id = ?", (chat_id,))
+        placeholders = ",".join("?" * len(deleted_users))
+        await db.execute(
+            f"DELETE FROM mention_users WHERE group_id = ? AND username IN ({placeholders})",
+            (chat_id, *deleted_users)
+        )
         await db.commit()
 
     # 构建响应消息
@@ -6234,20 +6873,43 @@ CREDENTIALS_FILES = {
 # 缓存配置
 TASK_CACHE = {}  # 任务状态缓存：存储任务哈希及状态
 
-# 连接池配置
+# 连接池配置（last_used 按最后使用时间从旧到新排列，清理时只需从头部检查）
 GMAIL_SERVICE_POOL = {
     'connections': {},        # 存储实际连接
-    'last_used': {},          # 记录最后使用时间
+    'last_used': OrderedDict(),  # 记录最后使用时间（LRU顺序）
     'max_connections': 5,     # 最大连接数
     'timeout': 300            # 连接超时时间(秒)
 }
 FASTMAIL_CONN_POOL = {
     'connections': {},
-    'last_used': {},
+    'last_used': OrderedDict(),
     'max_connections': 5,
     'timeout': 300
 }
 
+def pool_touch(pool, key, conn):
+    """放入/刷新连接，并移到 last_used 末尾（最新使用）"""
+    pool['connections'][key] = conn
+    pool['last_used'][key] = time.time()
+    pool['last_used'].move_to_end(key)
+
+def pool_discard(pool, key):
+    """从连接池移除连接（不存在时忽略），返回被移除的连接"""
+    pool['last_used'].pop(key, None)
+    return pool['connections'].pop(key, None)
+
+def pool_pop_expired(pool, now):
+    """从最久未使用的一端弹出过期连接，遇到未过期的即停止；返回 [(key, conn, 闲置秒数)]"""
+    expired = []
+    last_used = pool['last_used']
+    while last_used:
+        key, ts = next(iter(last_used.items()))
+        if now - ts <= pool['timeout']:
+            break
+        last_used.popitem(last=False)
+        expired.append((key, pool['connections'].pop(key, None), now - ts))
+    return expired
+
 # 正则表达式
 NAME_PATTERN = re.compile(r'^[\u4e00-\u9fa5a-zA-Z·\-\']+[·\-\']?[\u4e00-\u9fa5a-zA-Z]*$')  # 姓名验证
 
@@ -6296,46 +6958,55 @@ def get_script_directory():
     """获取当前脚本所在的目录"""
     return os.path.dirname(os.path.abspath(__file__))
 
+# 临时目录池：用过的空目录放回池中复用，避免每个任务都创建/删除目录
+TEMP_DIR_POOL_SIZE = 8  # 池中最多保留的空闲目录数，超出的直接删除
+_temp_dir_pool = deque()
+_temp_base_dir = None
+
 def create_temp_dirs(prefixes: list) -> dict:
     """
-    创建临时目录到脚本目录的temp文件夹中
-    每个前缀生成一个唯一的子目录
+    从脚本目录下temp文件夹的目录池中取出临时目录
+    每个前缀分配一个独立的空目录，池中没有空闲目录时才新建
     """
-    # 获取脚本所在目录
-    script_dir = get_script_directory()
-    # 定义temp文件夹路径（脚本目录下的temp）
-    base_temp_dir = os.path.join(script_dir, "temp")
-    
-    # 确保基础temp文件夹存在
-    os.makedirs(base_temp_dir, exist_ok=True)
-    
+    global _temp_base_dir
+    if _temp_base_dir is None:
+        # 定义temp文件夹路径（脚本目录下的temp），只需确保存在一次
+        _temp_base_dir = os.path.join(get_script_directory(), "temp")
+        os.makedirs(_temp_base_dir, exist_ok=True)
+
     dirs = {}
     for prefix in prefixes:
-        # 生成唯一的目录名（前缀+随机字符串，避免冲突）
-        unique_id = uuid.uuid4().hex[:8]  # 8位随机字符串
-        temp_dir_name = f"{prefix}_{unique_id}"
-        temp_dir_path = os.path.join(base_temp_dir, temp_dir_name)
-        
-        # 创建子目录
-        os.makedirs(temp_dir_path, exist_ok=True)
-        
+        if _temp_dir_pool:
+            temp_dir_path = _temp_dir_pool.pop()
+        else:
+            # 生成唯一的目录名（随机字符串，避免冲突）
+            temp_dir_path = os.path.join(_temp_base_dir, f"slot_{uuid.uuid4().hex[:8]}")
+            os.makedirs(temp_dir_path, exist_ok=True)
+
         dirs[prefix] = {
             'path': temp_dir_path,
             'obj': None  # 不再需要TemporaryDirectory对象
         }
-        # 删掉下面这行日志输出代码即可
-        # logger.info(f"创建临时目录: {temp_dir_path}")
     return dirs
 
 def cleanup_temp_dirs(dirs: dict) -> None:
-    """清理临时目录（脚本目录下的temp子目录）"""
+    """清空临时目录的内容并放回目录池（池已满时直接删除目录）"""
     cleaned = []
     for prefix, dir_info in dirs.items():
         dir_path = dir_info['path']
         if dir_path and os.path.exists(dir_path):
             try:
-                # 递归删除目录及内容
-                shutil.rmtree(dir_path)
+                if len(_temp_dir_pool) >= TEMP_DIR_POOL_SIZE:
+                    shutil.rmtree(dir_path)
+                else:
+                    # 只删除目录内容，目录本身保留复用
+                    with os.scandir(dir_path) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                shutil.rmtree(entry.path)
+                            else:
+                                os.unlink(entry.path)
+                    _temp_dir_pool.append(dir_path)
                 cleaned.append(os.path.basename(dir_path))
             except Exception as e:
                 logger.warning(f"⚠️ 清理{prefix}临时目录失败: {e}")
@@ -6343,10 +7014,6 @@ def cleanup_temp_dirs(dirs: dict) -> None:
         logger.info(f"✓ 已清理临时目录：{', '.join(cleaned)}")
     
 
-def fullwidth_to_halfwidth(text):
-    """将全角字符转换为半角字符"""
-    return ''.join([unicodedata.normalize('NFKC', char) for char in text])
-
 def fuzzy_match(target, text, threshold=0.6):
     """模糊匹配函数，使用简单的字符串相似性比较（不依赖外部库）"""
     if not target or not text:
@@ -6358,40 +7025,37 @@ def fuzzy_match(target, text, threshold=0.6):
     # 检查是否有直接包含关系
     if target in text or text in target:
         return True
-        
-    # 计算最长公共子串
-    def longest_common_substring(s1, s2):
-        m, n = len(s1), len(s2)
-        dp = [[0]*(n+1) for _ in range(m+1)]
-        max_length = 0
-        for i in range(1, m+1):
-            for j in range(1, n+1):
-                if s1[i-1] == s2[j-1]:
-                    dp[i][j] = dp[i-1][j-1] + 1
-                    max_length = max(max_length, dp[i][j])
-                else:
-                    dp[i][j] = 0
-        return max_length
-    
-    lcs_length = longest_common_substring(target, text)
+
+    # 长度上限过滤：公共子串不可能长于较短的字符串，比例不够时直接判定不匹配
     max_length = max(len(target), len(text))
-    return max_length > 0 and (lcs_length / max_length) >= threshold
+    if min(len(target), len(text)) / max_length < threshold:
+        return False
+
+    # 计算最长公共子串（difflib 基于字符索引查找，无需构造 m*n 矩阵）
+    lcs_length = SequenceMatcher(None, target, text, autojunk=False).find_longest_match(
+        0, len(target), 0, len(text)
+    ).size
+    return (lcs_length / max_length) >= threshold
+
+# Markdown 特殊字符转义表（模块加载时构建一次，translate 单次遍历完成全部替换）
+_MD_ESCAPE_TABLE = str.maketrans({
+    c: '\\' + c
+    for c in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+})
 
 def escape_special_chars(text):
     """处理Telegram中可能被误解的特殊字符"""
-    if not text:
-        return ""
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
+    return text.translate(_MD_ESCAPE_TABLE) if text else ""
+
+# 姓名/其他机器人指令校验正则（模块加载时编译一次）
+_NAME_RE = re.compile(r'^[a-zA-Z\u4e00-\u9fa5\s\-\.]{1,50}$')
+_BOTCMD_RE = re.compile(r'^[a-zA-Z0-9]+$')
 
 def is_valid_name(name):
     """验证姓名格式，支持汉字、英文、空格、连字符和点号"""
     if name.isdigit():
         return False
-    pattern = r'^[a-zA-Z\u4e00-\u9fa5\s\-\.]{1,50}$'
-    return re.fullmatch(pattern, name) is not None
+    return _NAME_RE.fullmatch(name) is not None
 
 def is_valid_count(count_str):
     """验证数量是否为有效的正整数"""
@@ -6401,8 +7065,7 @@ def is_valid_count(count_str):
 
 def is_other_bot_command(s):
     """判断是否为其他机器人的指令（纯字母、纯数字或字母数字混合）"""
-    s = s.strip()
-    return bool(re.fullmatch(r'^[a-zA-Z0-9]+$', s))
+    return _BOTCMD_RE.fullmatch(s.strip()) is not None
 
 
 # —— 日志工具函数 —— #
@@ -6431,6 +7094,50 @@ def log_email_skip(reason, msg_id, source):
 
 
 # —— PDF处理与回单生成 —— #
+def _build_receipt_normalize_table() -> dict:
+    """回单文本归一化表：逐字符NFKC（全角转半角、康熙部首转常用汉字等）并去除反斜杠"""
+    table = {ord('\\'): None}
+    for cp in range(0x30000):  # NFKC兼容映射全部位于 U+30000 以下
+        if 0xD800 <= cp < 0xE000:  # 代理区不是有效字符
+            continue
+        ch = chr(cp)
+        norm = unicodedata.normalize('NFKC', ch)
+        if norm != ch:
+            table[cp] = norm.replace('\\', '') or None
+    return table
+
+# 模块加载时构建一次，解析时一次 translate 完成全部归一化
+_RECEIPT_NORMALIZE_TABLE = _build_receipt_normalize_table()
+
+# 回单字段正则（模块加载时编译一次，解析每份PDF时直接复用）
+_RECEIPT_FLAGS = re.MULTILINE | re.IGNORECASE
+_PAT_PAYER = re.compile(r'付款方[\s\S]*?账户名[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_PAYER_ACCOUNT = re.compile(r'付款方[\s\S]*?账号[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_PAYER_TYPE = re.compile(r'付款方[\s\S]*?账户类型[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_PAYEE = re.compile(r'收款方[\s\S]*?账户名[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_PAYEE_ACCOUNT = re.compile(r'收款方[\s\S]*?账号[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_PAYEE_TYPE = re.compile(r'收款方[\s\S]*?账户类型[:：]\s*([^\n]+)', _RECEIPT_FLAGS)
+_PAT_AMOUNT = (
+    re.compile(r'小写[:：]?\s*([0-9]+\.[0-9]{2})', _RECEIPT_FLAGS),
+    re.compile(r'付款金额[\s\S]*?小写[:：]?\s*([0-9]+\.[0-9]{2})', _RECEIPT_FLAGS),
+)
+_PAT_AMOUNT_WORDS = (
+    re.compile(r'大写[:：]?\s*([零壹贰叁肆伍陆柒捌玖拾佰仟万亿]+元[整角分]?)', _RECEIPT_FLAGS),
+    re.compile(r'付款金额[\s\S]*?大写[:：]?\s*([零壹贰叁肆伍陆柒捌玖拾佰仟万亿]+元[整角分]?)', _RECEIPT_FLAGS),
+)
+_PAT_PAY_TIME = (
+    re.compile(r'支付时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})', _RECEIPT_FLAGS),
+    re.compile(r'付款时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})', _RECEIPT_FLAGS),
+)
+_PAT_RECEIPT_TIME = (
+    re.compile(r'凭证生成时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})', _RECEIPT_FLAGS),
+    re.compile(r'回单生成时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})', _RECEIPT_FLAGS),
+)
+_PAT_FLOW_NO = (
+    re.compile(r'支付宝流水号[:：]?\s*([^\n]+)', _RECEIPT_FLAGS),
+    re.compile(r'交易流水号[:：]?\s*([^\n]+)', _RECEIPT_FLAGS),
+)
+
 def parse_pdf_receipt_info(pdf_path: str) -> tuple:
     """
     公共PDF回单解析：从PDF第一页提取完整回单信息（核心函数）
@@ -6438,76 +7145,73 @@ def parse_pdf_receipt_info(pdf_path: str) -> tuple:
            小写金额, 大写金额, 支付时间, 凭证生成时间, 支付宝流水号)
     """
     # 先检查缓存，添加超时机制（24小时）
-    cache_entry = _pdf_text_cache.get(pdf_path)
+    # 缓存内容为元组：已解析的结果；为字符串：附件处理阶段已提取的原始文本，无需再打开PDF
+    text = None
+    cache_entry = _pdf_cache_get(pdf_path)
     if cache_entry and (time.time() - cache_entry['timestamp'] < 86400):
-        return cache_entry['data']
-    
-    if not os.path.exists(pdf_path):
-        raise FileNotFoundError(f"PDF文件不存在: {pdf_path}")
-    
-    try:
-        doc = fitz.open(pdf_path)
-        if doc.page_count == 0:
-            raise Exception("PDF无有效页面")
-        text = doc.load_page(0).get_text()
-        doc.close()
-        
-        # 更新缓存，添加时间戳
-        _pdf_text_cache[pdf_path] = {
-            'data': text,
-            'timestamp': time.time()
-        }
-    except Exception as e:
-        logger.error(f"PDF处理失败: {e}")
-        raise
+        if isinstance(cache_entry['data'], tuple):
+            return cache_entry['data']
+        text = cache_entry['data']
 
-    # 第一步：将所有全角字符转换为半角字符
-    text = fullwidth_to_halfwidth(text)
-    
-    # 清理文本中可能存在的转义字符
-    text = text.replace("\\", "")
+    if text is None:
+        # 不预先 stat：文件不存在时 fitz.open 自身会抛出 FileNotFoundError
+        try:
+            doc = fitz.open(pdf_path)
+            if doc.page_count == 0:
+                raise Exception("PDF无有效页面")
+            text = doc.load_page(0).get_text()
+            doc.close()
+        except Exception as e:
+            logger.error(f"PDF处理失败: {e}")
+            raise
 
-    def find(pattern: str) -> str:
-        """内部辅助：正则匹配提取内容，返回strip后的结果，无匹配则返回空字符串"""
-        match = re.search(pattern, text, re.MULTILINE | re.IGNORECASE)
-        if match and match.group(1):
-            result = match.group(1).strip()
-            return result.replace("\\", "")
+    # 全角转半角并清理转义字符（一次 translate）
+    text = text.translate(_RECEIPT_NORMALIZE_TABLE)
+
+    def find(*patterns) -> str:
+        """内部辅助：依次尝试预编译正则，返回第一个匹配strip后的结果，无匹配则返回空字符串"""
+        for pattern in patterns:
+            match = pattern.search(text)
+            if match and match.group(1):
+                return match.group(1).strip()
         return ''
 
     # 付款方信息：严格匹配"付款方"模块内的字段
-    payer = find(r'付款方[\s\S]*?账户名[:：]\s*([^\n]+)') or '未知'
-    pacc = find(r'付款方[\s\S]*?账号[:：]\s*([^\n]+)') or '未知'
-    payer_type_raw = find(r'付款方[\s\S]*?账户类型[:：]\s*([^\n]+)')
+    payer = find(_PAT_PAYER) or '未知'
+    pacc = find(_PAT_PAYER_ACCOUNT) or '未知'
+    payer_type_raw = find(_PAT_PAYER_TYPE)
     payer_type = f"（{payer_type_raw}）" if payer_type_raw else ""
 
     # 收款方信息：严格匹配"收款方"模块内的字段
-    payee = find(r'收款方[\s\S]*?账户名[:：]\s*([^\n]+)') or '未知'
-    eacc = find(r'收款方[\s\S]*?账号[:：]\s*([^\n]+)') or '未知'
-    payee_type_raw = find(r'收款方[\s\S]*?账户类型[:：]\s*([^\n]+)')
+    payee = find(_PAT_PAYEE) or '未知'
+    eacc = find(_PAT_PAYEE_ACCOUNT) or '未知'
+    payee_type_raw = find(_PAT_PAYEE_TYPE)
     payee_type = f"（{payee_type_raw}）" if payee_type_raw else ""
 
     # 金额信息提取
-    amount = find(r'小写[:：]?\s*([0-9]+\.[0-9]{2})') or find(r'付款金额[\s\S]*?小写[:：]?\s*([0-9]+\.[0-9]{2})') or '未知'
-    amount_in_words = find(r'大写[:：]?\s*([零壹贰叁肆伍陆柒捌玖拾佰仟万亿]+元[整|角分]?)') or find(r'付款金额[\s\S]*?大写[:：]?\s*([零壹贰叁肆伍陆柒捌玖拾佰仟万亿]+元[整|角分]?)') or '未知'
+    amount = find(*_PAT_AMOUNT) or '未知'
+    amount_in_words = find(*_PAT_AMOUNT_WORDS) or '未知'
 
     # 时间信息提取
-    pay_time = format_chinese_datetime(find(r'支付时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})') or find(r'付款时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})') or '未知')
-    receipt_time = format_chinese_datetime(find(r'凭证生成时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})') or find(r'回单生成时间[:：]?\s*(\d{4}-\d{2}-\d{2}\s\d{2}:\d{2}:\d{2})') or '未知')
+    pay_time = format_chinese_datetime(find(*_PAT_PAY_TIME) or '未知')
+    receipt_time = format_chinese_datetime(find(*_PAT_RECEIPT_TIME) or '未知')
 
     # 支付宝流水号提取
-    alipay_flow_no = find(r'支付宝流水号[:：]?\s*([^\n]+)') or find(r'交易流水号[:：]?\s*([^\n]+)') or '未知'
+    alipay_flow_no = find(*_PAT_FLOW_NO) or '未知'
 
     result = (payer, pacc, payer_type, payee, eacc, payee_type, amount, amount_in_words, pay_time, receipt_time, alipay_flow_no)
     
     # 更新缓存，存储解析结果而非原始文本
-    _pdf_text_cache[pdf_path] = {
-        'data': result,
-        'timestamp': time.time()
-    }
+    _pdf_cache_set(pdf_path, result)
     
     return result
 
+# 回单文本转义表：去除原有反斜杠并转义Markdown特殊字符，一次 translate 完成
+_RECEIPT_ESCAPE_CHARS = r'_[]()~`>#+=|{}!-'
+_RECEIPT_ESCAPE_TABLE = str.maketrans({'\\': None, **{c: '\\' + c for c in _RECEIPT_ESCAPE_CHARS}})
+# 日期时间字段保留“-”不转义
+_RECEIPT_ESCAPE_TABLE_DT = str.maketrans({'\\': None, **{c: '\\' + c for c in _RECEIPT_ESCAPE_CHARS if c != '-'}})
+
 def generate_receipt_caption(
     source: str,          # 来源邮箱标识
     payer: str,           # 付款人名称
@@ -6530,20 +7234,14 @@ def generate_receipt_caption(
     def preserve_raw_account(account: str) -> str:
         if not account:
             return "未知账号"
-        return account.replace("\\", "")
+        # 绝大多数账号不含反斜杠，先用 in 判断，避免无谓的复制
+        return account.replace("\\", "") if "\\" in account else account
 
     # 转义函数：仅处理非账号字段
     def safe_escape(text, is_datetime=False):
         if not text:
             return ""
-        text = text.replace("\\", "")
-        must_escape = r'_[]()~`>#+=|{}!-'
-        if is_datetime:
-            must_escape = must_escape.replace('-', '')
-        for char in must_escape:
-            if char in text:
-                text = text.replace(char, f'\{char}')
-        return text
+        return text.translate(_RECEIPT_ESCAPE_TABLE_DT if is_datetime else _RECEIPT_ESCAPE_TABLE)
 
     # 时间格式转换：将YYYY-MM-DD转换为YYYY年MM月DD日
     def format_time_with_chinese(time_str):
@@ -6578,6 +7276,49 @@ def generate_receipt_caption(
     caption = "\n".join(parts)
     return caption
 
+def _reset_pdf_pool(pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    """进程池损坏时丢弃，此后在当前线程渲染（运行期间不再 fork 新进程）"""
+    global _PDF_POOL
+    logger.warning("[PDF] 渲染进程池已损坏，后续改为在当前线程渲染")
+    with _pdf_pool_lock:
+        if _PDF_POOL is pool:
+            _PDF_POOL = None
+
+def submit_pdf_render(pdf_bytes: bytes, img_path: str) -> Optional[tuple]:
+    """
+    把渲染任务提交到进程池后立即返回，调用方可在渲染期间做文件写入
+    返回：(进程池, future)，进程池不可用时返回 None
+    """
+    pool = _PDF_POOL
+    if pool is None:
+        return None
+    try:
+        return (pool, pool.submit(_render_pdf_worker, pdf_bytes, img_path))
+    except concurrent.futures.process.BrokenProcessPool:
+        _reset_pdf_pool(pool)
+        return None
+
+def render_pdf(pdf_bytes: bytes, img_path: str, submitted: Optional[tuple] = None) -> str:
+    """
+    渲染PDF到 img_path 并返回页面文本：优先使用进程池（可传入 submit_pdf_render 的返回值），
+    进程池不可用或崩溃时在当前线程执行
+    """
+    if submitted is None:
+        submitted = submit_pdf_render(pdf_bytes, img_path)
+    if submitted is not None:
+        pool, future = submitted
+        try:
+            return future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            _reset_pdf_pool(pool)
+    return _render_pdf_worker(pdf_bytes, img_path)
+
+def receipt_output_paths(out_dir: str, original_filename: str) -> tuple[str, str]:
+    """按附件原始文件名计算本地输出路径，返回：(PDF路径, 图片路径)"""
+    # 使用原始文件名（去除扩展名），并清理文件名中的非法字符
+    base_name = re.sub(r'[\\/*?:"<>|]', '_', os.path.splitext(original_filename)[0])
+    return (os.path.join(out_dir, f"{base_name}.pdf"), os.path.join(out_dir, f"{base_name}.png"))
+
 def process_pdf_attachment(pdf_bytes: bytes, out_dir: str, source: str, original_filename: str) -> tuple[None|str, None|str, None|str]:
     """
     公共PDF附件处理：生成高清图片、保存PDF、提取文本（Gmail/FastMail 通用）
@@ -6590,46 +7331,46 @@ def process_pdf_attachment(pdf_bytes: bytes, out_dir: str, source: str, original
         # 将来源标识转换为大写形式（首字母大写）
         source = source.capitalize()
         
-        # 使用原始文件名（去除扩展名）
-        base_name = os.path.splitext(original_filename)[0]
-        # 清理文件名中的非法字符
-        base_name = re.sub(r'[\\/*?:"<>|]', '_', base_name)
-        
-        pdf_path = os.path.join(out_dir, f"{base_name}.pdf")
-        img_path = os.path.join(out_dir, f"{base_name}.png")
+        pdf_path, img_path = receipt_output_paths(out_dir, original_filename)
 
         # 检查文件是否已存在（避免重复处理）
-        if os.path.exists(pdf_path) and os.path.exists(img_path):
+        # PNG 只在 PDF 完整落盘后才改名到最终路径，存在即说明PDF完整，只需检查 PNG；
+        # PDF 缺失或损坏时 fitz.open 抛错，回落到重新渲染
+        if os.path.exists(img_path):
             try:
-                doc = fitz.open(pdf_path)
-                pdf_text = doc.load_page(0).get_text()
-                doc.close()
-                _pdf_text_cache[f"{source}_{img_path}"] = {
-                    'data': pdf_text,
-                    'timestamp': time.time()
-                }
+                cache_entry = _pdf_cache_get(pdf_path)
+                if cache_entry and isinstance(cache_entry['data'], str):
+                    # 原始文本已缓存，无需再打开PDF
+                    pdf_text = cache_entry['data']
+                else:
+                    doc = fitz.open(pdf_path)
+                    pdf_text = doc.load_page(0).get_text()
+                    doc.close()
+                    if not cache_entry:
+                        _pdf_cache_set(pdf_path, pdf_text)
                 log_attachment_processing(pdf_path, source, "重用")
                 return (img_path, pdf_path, pdf_text)
+            except (FileNotFoundError, fitz.FileDataError):
+                pass
             except Exception as e:
                 log_error(f"重用现有文件失败，将重新处理: {e}", source)
 
-        # 保存PDF
-        with open(pdf_path, "wb") as f:
+        # 先提交渲染任务（PNG写到临时文件），子进程渲染的同时在当前线程保存PDF；
+        # 两者都写临时文件再 os.replace：先PDF后PNG，保证最终路径上的PNG总有完整的PDF对应
+        tmp_img_path = os.path.splitext(img_path)[0] + ".rendering.png"  # 保留 .png 后缀，PyMuPDF 按后缀选格式
+        tmp_pdf_path = pdf_path + ".part"
+        submitted = submit_pdf_render(pdf_bytes, tmp_img_path)
+        with open(tmp_pdf_path, "wb") as f:
             f.write(pdf_bytes)
+        os.replace(tmp_pdf_path, pdf_path)
         log_attachment_processing(pdf_path, source, "下载")
 
-        # 生成300DPI高清图片
-        doc = fitz.open(pdf_path)
-        pix = doc.load_page(0).get_pixmap(matrix=fitz.Matrix(3.0, 3.0), dpi=300)
-        pix.save(img_path)
-        pdf_text = doc.load_page(0).get_text()
-        doc.close()
+        # 生成200DPI图片：子进程渲染后直接写入PNG，只回传文本；PDF 已落盘后再改名到最终路径
+        pdf_text = render_pdf(pdf_bytes, tmp_img_path, submitted)
+        os.replace(tmp_img_path, img_path)
 
-        # 文本缓存
-        _pdf_text_cache[f"{source}_{img_path}"] = {
-            'data': pdf_text,
-            'timestamp': time.time()
-        }
+        # 文本缓存：与 parse_pdf_receipt_info 使用同一个键（PDF路径），解析时不再重复打开PDF
+        _pdf_cache_set(pdf_path, pdf_text)
         log_attachment_processing(img_path, source, "渲染")
         return (img_path, pdf_path, pdf_text)
     except Exception as e:
@@ -6673,29 +7414,29 @@ async def load_credentials_from_files(credential_type: str) -> dict:
 async def save_google_credentials(credential_type: str, credentials: dict):
     cs = json.dumps(credentials['client_secret'])
     tk = json.dumps(credentials.get('token', {}))
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO google_api_credentials(type, client_secret, token)
-            VALUES (?, ?, ?)
-            ON CONFLICT(type) DO UPDATE SET
-              client_secret = excluded.client_secret,
-              token         = excluded.token,
-              updated_at    = CURRENT_TIMESTAMP
-            """,
-            (credential_type,)
-        )
-        await db.commit()
+    db = await DB.get_conn()
+    await db.execute(
+        """
+        INSERT INTO google_api_credentials(type, client_secret, token)
+        VALUES (?, ?, ?)
+        ON CONFLICT(type) DO UPDATE SET
+          client_secret = excluded.client_secret,
+          token         = excluded.token,
+          updated_at    = CURRENT_TIMESTAMP
+        """,
+        (credential_type, cs, tk)
+    )
+    await db.commit()
     logger.info(f"已保存 {credential_type} 凭证到数据库")
 
 async def get_google_credentials(credential_type: str) -> dict:
-    # 尝试从数据库读取
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT client_secret, token FROM google_api_credentials WHERE type = ?",
-            (credential_type,)
-        )
-        row = await cur.fetchone()
+    # 尝试从数据库读取（复用全局连接，不再每次新建）
+    db = await DB.get_conn()
+    row = await fetchone(
+        db,
+        "SELECT client_secret, token FROM google_api_credentials WHERE type = ?",
+        (credential_type,)
+    )
     if row:
         return {
             'client_secret': json.loads(row[0]),
@@ -6718,16 +7459,14 @@ async def get_google_credentials(credential_type: str) -> dict:
     return creds
 
 async def delete_google_credentials(credential_type: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM google_api_credentials WHERE type = ?",
-            (credential_type,)
-        )
-        await db.commit()
+    db = await DB.get_conn()
+    await db.execute(
+        "DELETE FROM google_api_credentials WHERE type = ?",
+        (credential_type,)
+    )
+    await db.commit()
     # 从连接池移除
-    if credential_type in GMAIL_SERVICE_POOL['connections']:
-        del GMAIL_SERVICE_POOL['connections'][credential_type]
-        del GMAIL_SERVICE_POOL['last_used'][credential_type]
+    pool_discard(GMAIL_SERVICE_POOL, credential_type)
     logger.info(f"已删除 {credential_type} 凭证")
 
 # 服务初始化
@@ -6812,28 +7551,15 @@ async def get_gmail_service(credential_type: str, event=None, max_retries=3):
                         logger.info(f"需要获取新的 {credential_type} Google API 凭证…")
                         creds = await initialize_credentials(credential_type, event)
 
-                    # 保存更新后的凭证到数据库
-                    if credentials_data:
-                        credentials_data['token'] = {
-                            'token': creds.token,
-                            'refresh_token': creds.refresh_token,
-                            'token_uri': creds.token_uri,
-                            'client_id': creds.client_id,
-                            'client_secret': creds.client_secret,
-                            'scopes': creds.scopes
-                        }
-                    else:
-                        credentials_data = {
-                            'client_secret': (await get_google_credentials(credential_type))['client_secret'],
-                            'token': {
-                                'token': creds.token,
-                                'refresh_token': creds.refresh_token,
-                                'token_uri': creds.token_uri,
-                                'client_id': creds.client_id,
-                                'client_secret': creds.client_secret,
-                                'scopes': creds.scopes
-                            }
-                        }
+                    # 保存更新后的凭证到数据库（credentials_data 已在上方读取且非空，无需再次查询）
+                    credentials_data['token'] = {
+                        'token': creds.token,
+                        'refresh_token': creds.refresh_token,
+                        'token_uri': creds.token_uri,
+                        'client_id': creds.client_id,
+                        'client_secret': creds.client_secret,
+                        'scopes': creds.scopes
+                    }
                     
                     await save_google_credentials(credential_type, credentials_data)
                     logger.info(f"{credential_type} 凭证已更新并保存到数据库")
@@ -6842,8 +7568,7 @@ async def get_gmail_service(credential_type: str, event=None, max_retries=3):
                 service = build("gmail", "v1", credentials=creds)
                 
                 # 更新连接池和最后使用时间
-                GMAIL_SERVICE_POOL['connections'][credential_type] = service
-                GMAIL_SERVICE_POOL['last_used'][credential_type] = time.time()
+                pool_touch(GMAIL_SERVICE_POOL, credential_type, service)
                 
                 return service
 
@@ -6875,34 +7600,40 @@ async def get_gmail_service(credential_type: str, event=None, max_retries=3):
         raise Exception(f"获取Gmail服务失败，已达到最大重试次数 {max_retries}")
 
 # 邮件与附件处理
+def _iter_pdf_parts(payload: dict):
+    """递归遍历邮件 payload，按出现顺序产出带 attachmentId 的 PDF 附件部分（兼容嵌套 multipart）"""
+    for part in payload.get("parts", []):
+        if part.get("filename", "").lower().endswith(".pdf") and part.get("body", {}).get("attachmentId"):
+            yield part
+        yield from _iter_pdf_parts(part)
+
 def process_attachment(service, msg, out_dir: str) -> str:
     """
-    下载邮件里的第一份 PDF。
-    - PDF：先保存到本地，再渲染高清 PNG，同时把 PDF 里的文字塞进 _pdf_text_cache
+    下载邮件里的第一份 PDF（第一份处理失败时依次尝试后续 PDF）。
+    - PDF：先保存到本地，再渲染高清 PNG，同时把 PDF 里的文字按PDF路径塞进 _pdf_text_cache
     返回：生成的图片的本地路径；如果啥都没有，就返回 None
     """
-    for part in msg.get("payload", {}).get("parts", []):
-        fn  = part.get("filename", "")
-        aid = part.get("body", {}).get("attachmentId")
-
-        # 处理 PDF
-        if fn.lower().endswith(".pdf") and aid:
-            try:
-                att = service.users().messages().attachments().get(
-                    userId="me", messageId=msg["id"], id=aid
-                ).execute()
-                pdf_bytes = base64.urlsafe_b64decode(att["data"])
-                
-                img_path, _, _ = process_pdf_attachment(pdf_bytes, out_dir, source="gmail", original_filename=fn)
-                if img_path:
-                    _pdf_text_cache[msg["id"]] = {
-                        'data': _pdf_text_cache.get(f"gmail_{img_path}", {}).get('data', ""),
-                        'timestamp': time.time()
-                    }
-                    return img_path
-            except Exception as e:
-                logger.error(f"处理PDF附件失败: {e}")
-            continue
+    for part in _iter_pdf_parts(msg.get("payload", {})):
+        fn  = part["filename"]
+        aid = part["body"]["attachmentId"]
+
+        # 本地已渲染过同名回单（PNG 只在 PDF 完整落盘后才出现）：直接复用，省去附件下载和 base64 解码（文本由解析阶段按PDF路径读取）
+        pdf_path, img_path = receipt_output_paths(out_dir, fn)
+        if os.path.exists(img_path) and os.path.exists(pdf_path):
+            log_attachment_processing(pdf_path, "Gmail", "重用")
+            return img_path
+        try:
+            att = service.users().messages().attachments().get(
+                userId="me", messageId=msg["id"], id=aid
+            ).execute()
+            # 取出 base64 文本解码后立即释放，避免渲染期间同时持有编码串和解码结果
+            pdf_bytes = base64.urlsafe_b64decode(att.pop("data"))
+            
+            img_path, _, _ = process_pdf_attachment(pdf_bytes, out_dir, source="gmail", original_filename=fn)
+            if img_path:
+                return img_path
+        except Exception as e:
+            logger.error(f"处理PDF附件失败: {e}")
 
     return None
 
@@ -6915,6 +7646,66 @@ def parse_payback_info(img_path: str):
         logger.warning(f"❗ 解析回单信息失败（来源：Gmail）: {e}")
         return ('', '', '', '', '', '', '', '', '未知', '未知', '未知')
 
+# Gmail 批量请求：每个 messages.get 消耗5配额单位，每批20个（100单位）低于每用户每秒250单位的上限
+GMAIL_BATCH_SIZE = 20
+GMAIL_BATCH_MAX_RETRIES = 3  # 子请求被限流/服务端错误时的最大重试轮数
+# 只取回单处理用到的字段：Date/From 头 + 附件的文件名和 attachmentId（含两层嵌套 multipart）
+_GMAIL_PART_FIELDS = "filename,body/attachmentId"
+GMAIL_MESSAGE_FIELDS = (
+    f"id,payload(headers,parts({_GMAIL_PART_FIELDS},"
+    f"parts({_GMAIL_PART_FIELDS},parts({_GMAIL_PART_FIELDS}))))"
+)
+# 从 "名称 <地址>" 形式的发件人中提取邮箱地址
+_EMAIL_ANGLE_RE = re.compile(r'<([^>]+)>')
+
+def _is_retryable_gmail_error(exception) -> bool:
+    """限流（429 / 403 rateLimitExceeded）和服务端 5xx 错误可重试"""
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    # 403 的 reason 为 rateLimitExceeded / userRateLimitExceeded
+    return status == 429 or status >= 500 or (status == 403 and 'ateLimitExceeded' in str(exception))
+
+def batch_get_messages(service, message_ids: list) -> dict:
+    """
+    批量获取邮件详情：每 GMAIL_BATCH_SIZE 封合并成一次 HTTP 请求
+    被限流或服务端出错的子请求按指数退避重新打包重试；仍失败或不可重试的邮件记录日志后跳过
+    返回：{邮件ID: 邮件内容}
+    """
+    results = {}
+    retry_ids = []
+
+    def _on_msg(request_id, response, exception):
+        if exception is None:
+            results[request_id] = response
+        elif _is_retryable_gmail_error(exception):
+            retry_ids.append(request_id)
+        else:
+            logger.error(f"获取邮件失败 ({request_id}): {exception}")
+
+    pending = list(message_ids)
+    for attempt in range(GMAIL_BATCH_MAX_RETRIES + 1):
+        if attempt:
+            # 在线程中执行，直接阻塞等待即可
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logger.warning(f"[Gmail] {len(pending)} 封邮件获取被限流，{delay:.1f} 秒后第 {attempt} 次重试")
+            time.sleep(delay)
+        retry_ids.clear()
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=_on_msg)
+            for mid in pending[start:start + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(userId='me', id=mid, fields=GMAIL_MESSAGE_FIELDS),
+                    request_id=mid
+                )
+            batch.execute()
+        if not retry_ids:
+            break
+        pending = list(retry_ids)
+    else:
+        logger.error(f"[Gmail] {len(pending)} 封邮件重试 {GMAIL_BATCH_MAX_RETRIES} 次后仍获取失败: {pending}")
+    return results
+
 # 回单获取
 async def get_payback_items(service, name: str, max_results: int, out_dir: str):
     """查询 Gmail，返回回单信息列表"""
@@ -6936,29 +7727,18 @@ async def get_payback_items(service, name: str, max_results: int, out_dir: str):
     # 统计邮件总数
     total_messages = len(resp.get('messages', []))
     
-    # 处理单封邮件
-    async def process_message(ref):
+    # 处理单封邮件（邮件详情已批量获取）
+    async def process_message(m):
         nonlocal items
         if task_state.terminate:
             return
             
         try:
-            m = await asyncio.to_thread(
-                service.users().messages().get, 
-                userId='me', 
-                id=ref['id']
-            )
-            
-            raw_date = next((h['value']
-                             for h in m.get('payload', {}).get('headers', [])
-                             if h['name'] == 'Date'),
-                            '未知时间')
+            hdrs = {h['name']: h['value'] for h in m.get('payload', {}).get('headers', [])}
+            raw_date = hdrs.get('Date', '未知时间')
             
             # 提取发件人邮箱
-            sender_email = next((h['value']
-                                for h in m.get('payload', {}).get('headers', [])
-                                if h['name'] == 'From'),
-                               '未知邮箱')
+            sender_email = hdrs.get('From', '未知邮箱')
             
             # 处理附件
             img_path = await asyncio.to_thread(
@@ -6991,13 +7771,14 @@ async def get_payback_items(service, name: str, max_results: int, out_dir: str):
     # 控制并发数量
     semaphore = asyncio.Semaphore(5)
     
-    async def bounded_process_message(ref):
+    async def bounded_process_message(m):
         async with semaphore:
-            await process_message(ref)
+            await process_message(m)
     
-    # 并发处理所有邮件
+    # 批量获取邮件详情，再并发处理附件
     messages = resp.get('messages', [])
-    await asyncio.gather(*[bounded_process_message(ref) for ref in messages])
+    fetched = await asyncio.to_thread(batch_get_messages, service, [ref['id'] for ref in messages])
+    await asyncio.gather(*[bounded_process_message(fetched[ref['id']]) for ref in messages if ref['id'] in fetched])
     
     return items, total_messages
 
@@ -7044,6 +7825,9 @@ def get_payback_items_with_payee(
         if not messages:
             break
         
+        # 当前页邮件详情一次批量获取
+        fetched = batch_get_messages(service, [ref['id'] for ref in messages])
+        
         # 处理当前页邮件
         for ref in messages:
             if found_enough or task_control.terminate:
@@ -7051,15 +7835,16 @@ def get_payback_items_with_payee(
                 
             total_searched += 1
             try:
-                m = service.users().messages().get(userId='me', id=ref['id']).execute()
+                m = fetched.get(ref['id'])
+                if m is None:
+                    continue
                 processed_emails += 1
                 
                 # 验证发件人
-                sender_email = next(
-                    (h['value'] for h in m.get('payload', {}).get('headers', []) if h['name'] == 'From'), 
-                    '未知邮箱'
-                )
-                actual_email = re.search(r'<([^>]+)>', sender_email).group(1) if re.search(r'<([^>]+)>', sender_email) else sender_email.strip()
+                hdrs = {h['name']: h['value'] for h in m.get('payload', {}).get('headers', [])}
+                sender_email = hdrs.get('From', '未知邮箱')
+                addr_match = _EMAIL_ANGLE_RE.search(sender_email)
+                actual_email = addr_match.group(1) if addr_match else sender_email.strip()
                 if actual_email != required_email:
                     logger.warning(f"跳过非官方邮箱邮件 ({processed_emails}): {sender_email}")
                     continue
@@ -7095,10 +7880,7 @@ def get_payback_items_with_payee(
                 # 匹配成功时更新计数
                 if payee_match and payer_match:
                     task_control.matched_count += 1
-                    raw_date = next(
-                        (h['value'] for h in m.get('payload', {}).get('headers', []) if h['name'] == 'Date'), 
-                        '未知时间'
-                    )
+                    raw_date = hdrs.get('Date', '未知时间')
                     items.append((
                         img_path, raw_date, sender_email, payer, pacc, payer_type, payee, eacc, payee_type, 
                         amount, amount_in_words, pay_time, receipt_time, alipay_flow_no, "gmail", recipient_email
@@ -7123,13 +7905,13 @@ def get_payback_items_with_payee(
 # 凭证管理
 async def get_fastmail_credentials(credential_type: str = 'pay') -> dict:
     try:
-        async with aiosqlite.connect("database.db") as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("""
-                SELECT user, app_password FROM fastmail_api_credentials 
-                WHERE type = ? LIMIT 1
-            """, (credential_type,))
-            return await cursor.fetchone() or None
+        db = await DB.get_conn()
+        row = await fetchone(db, """
+            SELECT user, app_password FROM fastmail_api_credentials 
+            WHERE type = ? LIMIT 1
+        """, (credential_type,))
+        # 全局连接不设置 row_factory，这里转成字典保持按字段名取值
+        return {'user': row[0], 'app_password': row[1]} if row else None
     except Exception as e:
         logger.error(f"获取凭证失败：{e}")
         raise
@@ -7137,19 +7919,26 @@ async def get_fastmail_credentials(credential_type: str = 'pay') -> dict:
 async def has_fastmail_credentials() -> bool:
     """检查是否存在有效的FastMail凭证"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute(
-                "SELECT 1 FROM fastmail_api_credentials WHERE type = 'pay' LIMIT 1"
-            )
-            row = await cur.fetchone()
-            return row is not None
+        db = await DB.get_conn()
+        row = await fetchone(db, "SELECT 1 FROM fastmail_api_credentials WHERE type = 'pay' LIMIT 1")
+        return row is not None
     except Exception as e:
         logger.error(f"检查FastMail凭证时出错: {e}")
         return False
 
 # 连接管理
+def _logout_quietly(conn) -> None:
+    """断开IMAP连接，忽略已断开等异常"""
+    try:
+        conn.logout()
+    except Exception:
+        pass
+
 async def connect_fastmail_imap(event=None) -> imaplib.IMAP4_SSL:
-    """连接FastMail IMAP服务器，带重试机制"""
+    """
+    获取FastMail IMAP连接，带重试机制：
+    优先取出连接池中的空闲连接（NOOP 校验可用），否则新建；用完需调用 release_fastmail_imap 放回
+    """
     max_retries = 3
     retry_delay = 1  # 初始重试延迟（秒）
     for attempt in range(max_retries):
@@ -7161,20 +7950,26 @@ async def connect_fastmail_imap(event=None) -> imaplib.IMAP4_SSL:
                     await event.reply(msg)
                 raise ValueError(msg)
 
+            # 使用期间连接不留在池中，避免并发任务共用同一个IMAP会话
+            conn = pool_discard(FASTMAIL_CONN_POOL, 'fastmail')
+            if conn is not None:
+                if getattr(conn, '_fastmail_user', None) == creds["user"]:
+                    try:
+                        await asyncio.to_thread(conn.noop)
+                        return conn
+                    except Exception as e:
+                        logger.info(f"[Fastmail] 空闲连接已失效，重新连接: {e}")
+                await asyncio.to_thread(_logout_quietly, conn)
+
             def _create_conn():
                 conn = imaplib.IMAP4_SSL("imap.fastmail.com", 993)
                 conn._encoding = 'utf-8'
                 conn.login(creds["user"], creds["app_password"])
                 conn.select("INBOX", readonly=True)
+                conn._fastmail_user = creds["user"]
                 return conn
 
-            conn = await asyncio.to_thread(_create_conn)
-            
-            # 更新连接池和最后使用时间
-            FASTMAIL_CONN_POOL['connections']['fastmail'] = conn
-            FASTMAIL_CONN_POOL['last_used']['fastmail'] = time.time()
-            
-            return conn
+            return await asyncio.to_thread(_create_conn)
         except Exception as e:
             msg = f"❌ 连接失败：{str(e)}"
             if event and attempt == max_retries - 1:
@@ -7187,6 +7982,13 @@ async def connect_fastmail_imap(event=None) -> imaplib.IMAP4_SSL:
     
     raise Exception(f"连接FastMail失败，已达到最大重试次数 {max_retries}")
 
+async def release_fastmail_imap(conn: imaplib.IMAP4_SSL) -> None:
+    """任务结束后把连接放回连接池供下次复用；池中已有空闲连接时断开当前这个"""
+    if FASTMAIL_CONN_POOL['connections'].get('fastmail') is not None:
+        await asyncio.to_thread(_logout_quietly, conn)
+        return
+    pool_touch(FASTMAIL_CONN_POOL, 'fastmail', conn)
+
 # 邮件与附件处理
 def parse_fastmail_payback_info(pdf_path: str):
     """FastMail回单解析：调用公共PDF解析函数"""
@@ -7204,33 +8006,34 @@ def process_fastmail_attachment(msg_bytes: bytes, out_dir: str) -> tuple:
         logger.error(f"❌ 邮件解析失败：{str(e)}")
         return (None, None, None)
 
-    # 优先处理PDF附件
-    pdf_attachments = []
-    for part in msg.walk():
-        if part.get_content_disposition() != "attachment":
-            continue
-
-        filename = part.get_filename()
-        if not filename:
-            continue
-            
-        # 处理文件名编码问题
-        if isinstance(filename, bytes):
-            decoded = False
-            for encoding in ['utf-8', 'gbk', 'gb2312', 'iso-8859-1', 'big5']:
-                try:
-                    filename = filename.decode(encoding)
-                    decoded = True
-                    break
-                except UnicodeDecodeError:
-                    continue
-            if not decoded:
-                filename = filename.decode('utf-8', errors='replace')
+    def collect_pdf_parts(parts) -> list:
+        """内部辅助：从给定MIME部分中收集 (文件名, part) 形式的PDF附件"""
+        found = []
+        for part in parts:
+            filename = part.get_filename()
+            if not filename:
+                continue
+                
+            # 处理文件名编码问题：policy.default 已返回解码后的 str，
+            # 仅在仍残留 RFC 2047 编码字（=?charset?...?=）时再解码一次
+            if '=?' in filename:
+                filename = ''.join(
+                    s.decode(enc or 'utf-8', errors='replace') if isinstance(s, bytes) else s
+                    for s, enc in decode_header(filename)
+                )
 
-        # 收集所有PDF附件
-        if filename.lower().endswith(".pdf"):
-            pdf_attachments.append((filename, part))
-            logger.debug(f"发现PDF附件: {filename}")
+            if filename.lower().endswith(".pdf"):
+                found.append((filename, part))
+                logger.debug(f"发现PDF附件: {filename}")
+        return found
+
+    # 优先处理PDF附件：iter_attachments 只返回顶层附件，不遍历正文部分；
+    # 附件嵌套在更深层 multipart 中（如转发邮件）时再回退到 walk() 全量遍历
+    pdf_attachments = collect_pdf_parts(msg.iter_attachments())
+    if not pdf_attachments:
+        pdf_attachments = collect_pdf_parts(
+            part for part in msg.walk() if part.get_content_disposition() == "attachment"
+        )
 
     # 优先处理名称中包含"receipt"或"回单"的PDF
     target_attachment = None
@@ -7393,10 +8196,8 @@ async def get_fastmail_pay_receipts(
                             resp_code, data = imap_conn.fetch(msg_id, "(RFC822)")
                             return data[0][1] if resp_code == "OK" and data else None
                         except (imaplib.IMAP4.abort, imaplib.IMAP4.error) as e:
+                            # 使用中的连接不在池中；失效连接在下次取用时由 NOOP 校验淘汰
                             logger.error(f"获取邮件内容失败: {str(e)}")
-                            if 'fastmail' in FASTMAIL_CONN_POOL['connections']:
-                                del FASTMAIL_CONN_POOL['connections']['fastmail']
-                                del FASTMAIL_CONN_POOL['last_used']['fastmail']
                             return None
 
                     msg_bytes = await asyncio.to_thread(_fetch_mail)
@@ -7409,7 +8210,8 @@ async def get_fastmail_pay_receipts(
                     mail_date = msg["date"] or "1970-01-01"
                     
                     # 验证发件人
-                    actual_email = re.search(r'<([^>]+)>', sender_email).group(1) if re.search(r'<([^>]+)>', sender_email) else sender_email.strip()
+                    addr_match = _EMAIL_ANGLE_RE.search(sender_email)
+                    actual_email = addr_match.group(1) if addr_match else sender_email.strip()
                     if actual_email != required_email:
                         continue
                     
@@ -7463,9 +8265,6 @@ async def get_fastmail_pay_receipts(
     
     except Exception as e:
         logger.error(f"搜索流程异常：{str(e)}")
-        if 'fastmail' in FASTMAIL_CONN_POOL['connections']:
-            del FASTMAIL_CONN_POOL['connections']['fastmail']
-            del FASTMAIL_CONN_POOL['last_used']['fastmail']
         return items, 0
 
 async def get_fastmail_pay_receipts_with_payee(
@@ -7564,12 +8363,13 @@ async def periodic_cleanup_pdf_cache():
     while True:
         now = time.time()
         # 清理超过24小时的缓存项
-        expired_keys = [
-            key for key, entry in _pdf_text_cache.items()
-            if now - entry['timestamp'] > 86400  # 24小时
-        ]
-        for key in expired_keys:
-            del _pdf_text_cache[key]
+        with _pdf_text_cache_lock:
+            expired_keys = [
+                key for key, entry in _pdf_text_cache.items()
+                if now - entry['timestamp'] > 86400  # 24小时
+            ]
+            for key in expired_keys:
+                del _pdf_text_cache[key]
         if expired_keys:
             logger.info(f"清理了 {len(expired_keys)} 个过期的PDF缓存项")
         # 每小时执行一次清理
@@ -7581,34 +8381,24 @@ async def periodic_cleanup_connection_pools():
         now = time.time()
         
         # 清理Gmail连接池
-        gmail_expired = [
-            key for key, last_used in GMAIL_SERVICE_POOL['last_used'].items()
-            if now - last_used > GMAIL_SERVICE_POOL['timeout']
-        ]
-        for key in gmail_expired:
+        gmail_expired = pool_pop_expired(GMAIL_SERVICE_POOL, now)
+        for key, conn, _ in gmail_expired:
             try:
                 # 关闭连接
-                GMAIL_SERVICE_POOL['connections'][key].close()
+                conn.close()
             except Exception as e:
                 logger.error(f"关闭Gmail连接 {key} 失败: {e}")
-            del GMAIL_SERVICE_POOL['connections'][key]
-            del GMAIL_SERVICE_POOL['last_used'][key]
         if gmail_expired:
             logger.info(f"清理了 {len(gmail_expired)} 个过期的Gmail连接")
         
         # 清理FastMail连接池
-        fastmail_expired = [
-            key for key, last_used in FASTMAIL_CONN_POOL['last_used'].items()
-            if now - last_used > FASTMAIL_CONN_POOL['timeout']
-        ]
-        for key in fastmail_expired:
+        fastmail_expired = pool_pop_expired(FASTMAIL_CONN_POOL, now)
+        for key, conn, _ in fastmail_expired:
             try:
                 # 关闭连接
-                FASTMAIL_CONN_POOL['connections'][key].close()
+                conn.close()
             except Exception as e:
                 logger.error(f"关闭FastMail连接 {key} 失败: {e}")
-            del FASTMAIL_CONN_POOL['connections'][key]
-            del FASTMAIL_CONN_POOL['last_used'][key]
         if fastmail_expired:
             logger.info(f"清理了 {len(fastmail_expired)} 个过期的FastMail连接")
         
@@ -7717,6 +8507,7 @@ async def fetch_combined_receipts(event, payer_name, payee_name, count, email_ty
                     await asyncio.sleep(0.5)
             
             termination_task = asyncio.create_task(check_termination())
+            conn = None
             
             try:
                 conn = await connect_fastmail_imap(event)
@@ -7734,6 +8525,8 @@ async def fetch_combined_receipts(event, payer_name, payee_name, count, email_ty
                 fastmail_control.terminate = True
                 termination_task.cancel()
                 await asyncio.gather(termination_task, return_exceptions=True)
+                if conn:
+                    await release_fastmail_imap(conn)
         
         # Gmail任务处理
         async def fetch_gmail():
@@ -8002,9 +8795,7 @@ async def process_payback_request(event, name, count, credential_type):
         # 处理凭证过期
         logger.error(f"{credential_type} Google API 凭证刷新失败: {e}")
         await delete_google_credentials(credential_type)
-        if credential_type in GMAIL_SERVICE_POOL['connections']:
-            del GMAIL_SERVICE_POOL['connections'][credential_type]
-            del GMAIL_SERVICE_POOL['last_used'][credential_type]
+        pool_discard(GMAIL_SERVICE_POOL, credential_type)
 
         error_msg = (
             f"❌ 代付回单查询失败：Google API凭证已过期或被撤销\n\n"
@@ -8049,9 +8840,8 @@ async def set_fastmail_credentials(event):
     """处理设置FastMail代付凭证的指令：设置FastMail代付凭证 邮箱地址 App专用密码"""
     # 验证管理员权限
     user_id = event.sender_id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-        is_admin = await cursor.fetchone() is not None
+    db = await DB.get_conn()
+    is_admin = await fetchone(db, "SELECT 1 FROM admins WHERE user_id = ?", (user_id,)) is not None
     
     if not is_admin:
         return await event.reply("❌ 权限不足，仅管理员可设置FastMail凭证")
@@ -8066,22 +8856,20 @@ async def set_fastmail_credentials(event):
     
     try:
         # 保存到数据库
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT OR REPLACE INTO fastmail_api_credentials 
-                (type, user, app_password, updated_at) 
-                VALUES ('pay', ?, ?, CURRENT_TIMESTAMP)
-            """, (email, app_password))
-            await db.commit()
+        await db.execute("""
+            INSERT OR REPLACE INTO fastmail_api_credentials 
+            (type, user, app_password, updated_at) 
+            VALUES ('pay', ?, ?, CURRENT_TIMESTAMP)
+        """, (email, app_password))
+        await db.commit()
         
         # 重置连接池
-        if 'fastmail' in FASTMAIL_CONN_POOL['connections']:
+        old_conn = pool_discard(FASTMAIL_CONN_POOL, 'fastmail')
+        if old_conn is not None:
             try:
-                FASTMAIL_CONN_POOL['connections']['fastmail'].close()
+                old_conn.close()
             except:
                 pass
-            del FASTMAIL_CONN_POOL['connections']['fastmail']
-            del FASTMAIL_CONN_POOL['last_used']['fastmail']
         
         logger.info(f"✅ FastMail代付凭证已更新：{email}")
         await event.reply(f"✅ FastMail代付凭证设置成功\n邮箱：{email}")
@@ -8209,37 +8997,18 @@ async def cleanup_stale_connections():
     while True:
         current_time = time.time()
         
-        # 清理Gmail连接池
-        # 使用列表复制避免迭代中修改字典引发的异常
-        for cred_type in list(GMAIL_SERVICE_POOL['connections'].keys()):
-            # 计算连接闲置时间
-            idle_time = current_time - GMAIL_SERVICE_POOL['last_used'].get(cred_type, 0)
-            
-            # 当闲置时间超过超时阈值时清理
-            if idle_time > GMAIL_SERVICE_POOL['timeout']:
-                try:
-                    # 移除连接池和最后使用时间记录
-                    del GMAIL_SERVICE_POOL['connections'][cred_type]
-                    del GMAIL_SERVICE_POOL['last_used'][cred_type]
-                    logger.info(f"[Gmail] 清理过期的Gmail连接 (闲置时间: {idle_time:.1f}秒)")
-                except Exception as e:
-                    logger.warning(f"清理Gmail连接 {cred_type} 失败: {str(e)}")
+        # 清理Gmail连接池（按最后使用时间从旧到新弹出，遇到未过期的即停止）
+        for cred_type, _, idle_time in pool_pop_expired(GMAIL_SERVICE_POOL, current_time):
+            logger.info(f"[Gmail] 清理过期的Gmail连接 (闲置时间: {idle_time:.1f}秒)")
         
         # 清理FastMail连接池
-        for conn_key in list(FASTMAIL_CONN_POOL['connections'].keys()):
-            idle_time = current_time - FASTMAIL_CONN_POOL['last_used'].get(conn_key, 0)
-            
-            if idle_time > FASTMAIL_CONN_POOL['timeout']:
-                try:
-                    # 先关闭连接再移除记录
-                    conn = FASTMAIL_CONN_POOL['connections'][conn_key]
-                    conn.close()
-                    
-                    del FASTMAIL_CONN_POOL['connections'][conn_key]
-                    del FASTMAIL_CONN_POOL['last_used'][conn_key]
-                    logger.info(f"[Fastmail] 清理过期的FastMail连接 (闲置时间: {idle_time:.1f}秒)")
-                except Exception as e:
-                    logger.warning(f"清理FastMail连接 {conn_key} 失败: {str(e)}")
+        for conn_key, conn, idle_time in pool_pop_expired(FASTMAIL_CONN_POOL, current_time):
+            try:
+                # 连接已移出连接池，关闭即可
+                conn.close()
+                logger.info(f"[Fastmail] 清理过期的FastMail连接 (闲置时间: {idle_time:.1f}秒)")
+            except Exception as e:
+                logger.warning(f"清理FastMail连接 {conn_key} 失败: {str(e)}")
 
         # 每30分钟检查一次（1800秒）
         await asyncio.sleep(1800)
@@ -8705,8 +9474,9 @@ async def main():
         # 1. 显示启动横幅
         await startup_banner()
 
-        # 2. 提示是否已有管理员
+        # 2. 提示是否已有管理员，并在开始监听前加载管理员ID
         await check_admin_tip()
+        await load_admin_ids()
 
         # 3. 连接并登录 Telegram
         ok = await connect_client()
@@ -8726,6 +9496,7 @@ async def main():
 
         # 6. 加载群组数据
         await load_payback_groups()
+        await reload_appendices()
         await load_group_data_on_startup()  # 合并加载加入时间和实体
         
         # 7. 启动各种定时任务并保存任务引用
@@ -8752,7 +9523,8 @@ async def main():
     except Exception as e:
         logger.error(f"主程序运行出错: {str(e)}", exc_info=True)
     finally:
-        # 取消所有后台任务
+        # 取消所有后台任务（含未完成的图片合并发送）
+        tasks.extend(_bg_tasks)
         for task in tasks:
             if not task.done():
                 task.cancel()
@@ -8760,6 +9532,7 @@ async def main():
                     await task
                 except asyncio.CancelledError:
                     logger.info(f"任务 {task.get_name()} 已成功取消")
+        shutdown_pdf_pool()
         logger.info("所有任务已清理，程序退出")
     
 
@@ -9006,7 +9779,7 @@ async def load_group_data_on_startup():
                 async for row in cursor:
                     chat_id, entity_data = row
                     try:
-                        entity = pickle.loads(entity_data)
+                        entity = unpack_entity(entity_data)
                         global_group_entities[chat_id] = entity
                         entities_count += 1
                     except Exception as e: